@@ -0,0 +1,83 @@
+"""Benchmark of the blocking clients.
+
+Runs an echo NewLiner server in a separate process and compares requests per
+second of `pserver.example.EchoClientSync`, `pserver.blocking.NewLinerConnection`
+(one request at a time) and `NewLinerConnection.send_many` (batches of
+--batch requests sent with a single syscall).
+
+    python -m benchmarks.bench_blocking_client [--requests N] [--size BYTES] [--json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+
+from tornado.testing import get_unused_port
+
+from pserver.blocking import NewLinerConnection
+from pserver.example import EchoClientSync
+from benchmarks.loadgen import run_server
+
+
+def bench_example(port, payload, num_requests):
+    client = EchoClientSync(port=port)
+    client.connect()
+    client.sock.settimeout(5)
+    for _ in range(num_requests):
+        client.send(payload)
+        client.recv()
+
+
+def bench_blocking(port, payload, num_requests):
+    conn = NewLinerConnection("127.0.0.1", port, timeout=5)
+    for _ in range(num_requests):
+        conn.request(payload)
+    conn.close()
+
+
+def bench_send_many(port, payload, num_requests, batch):
+    conn = NewLinerConnection("127.0.0.1", port, timeout=5)
+    for _ in range(num_requests // batch):
+        conn.send_many([payload] * batch)
+    conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=100, help="payload size")
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--json", action="store_true", help="machine readable output")
+    args = parser.parse_args(argv)
+
+    port = get_unused_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=run_server,
+                                     args=(port, "newliner", args.batch, ready))
+    server.start()
+    ready.wait(5)
+    payload = 'x' * args.size
+    results = {}
+    try:
+        for name, bench, extra in (("example.EchoClientSync", bench_example, ()),
+                                   ("blocking.NewLinerConnection", bench_blocking, ()),
+                                   ("blocking.send_many", bench_send_many, (args.batch,))):
+            start = time.time()
+            bench(port, payload, args.requests, *extra)
+            results[name] = args.requests / (time.time() - start)
+    finally:
+        server.terminate()
+        server.join()
+
+    if args.json:
+        json.dump({"requests_per_second": results}, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        for name in sorted(results):
+            print("{:>30}: {:>10.0f} req/s".format(name, results[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Memory used by idle keep-alive connections.
+
+Opens --connections (default 100k) NetStringConn connections over in-memory
+streams, and reports the bytes used per connection right after it's
+accepted, and after it served a request and went idle again. Memory is measured as the growth of the
+process RSS, so run it with a big number of connections. Memory of the
+streams themselves (and of sockets and kernel buffers) is not included, so
+the numbers show what PServer adds on top of tornado's IOStream.
+
+    python -m benchmarks.bench_idle_connections [--connections N] [--json]
+"""
+
+import argparse
+import gc
+import json
+import os
+
+from pserver import PServer, NetStringConn
+from benchmarks.loadgen import rss_kb
+from benchmarks.util import FakeIOLoop, FakeStream
+
+
+def echo_handler(request):
+    request.write(request.body)
+
+
+def run(num_connections, stats):
+    server = PServer(echo_handler, NetStringConn, stats=stats)
+    io_loop = FakeIOLoop()
+    streams = [FakeStream(io_loop) for _ in range(num_connections)]
+    gc.collect()
+    before = rss_kb(os.getpid())
+    for i, stream in enumerate(streams):
+        server.handle_stream(stream, ("127.0.0.1", i))
+    io_loop.run_callbacks()
+    gc.collect()
+    accepted = rss_kb(os.getpid())
+    for stream in streams:
+        stream.feed(b"5:hello,")
+    gc.collect()
+    served = rss_kb(os.getpid())
+    return {"connections": num_connections,
+            "stats": stats,
+            "bytes_per_connection": (accepted - before) * 1024.0 / num_connections,
+            "bytes_per_connection_served": (served - before) * 1024.0 / num_connections}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--connections", type=int, default=100000)
+    parser.add_argument("--json", action="store_true", help="machine readable output")
+    args = parser.parse_args(argv)
+
+    for stats in (False, True):
+        result = run(args.connections, stats)
+        if args.json:
+            print(json.dumps(result, sort_keys=True))
+        else:
+            print("stats %-5s  %7.0f B/connection idle, %7.0f B/connection after a request"
+                  % (stats, result["bytes_per_connection"],
+                     result["bytes_per_connection_served"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Benchmark of the NetString response path.
+
+Compares the old `NetStringReq.write` implementation (joining the response
+and writing header and body separately) with the current one, which passes
+chunks to the connection untouched. Responses are written to a real
+IOStream over a socket which accepts --send-size bytes per send. For every
+response size it reports how many bytes were copied before reaching the
+IOStream, how many the IOStream copied while sending them (slicing and
+merging its write buffer), and the time per response.
+
+    python -m benchmarks.bench_netstring_write [--chunks N] [--send-size N] [--json]
+"""
+
+import argparse
+import json
+import sys
+import timeit
+from tornado import iostream
+
+from pserver.base import write_chunks
+from pserver.protocols import NetStringReq
+
+
+class PartialSendSocket(object):
+    """Socket which is always writable, and accepts at most <send_size>
+    bytes per send"""
+    def __init__(self, send_size):
+        self.send_size = send_size
+
+    def setblocking(self, flag):
+        pass
+
+    def fileno(self):
+        return -1
+
+    def send(self, data):
+        return min(len(data), self.send_size)
+
+    def close(self):
+        pass
+
+
+class FlushingStream(iostream.IOStream):
+    """IOStream which sends everything in `write`, without an IOLoop"""
+    def _add_io_state(self, state):
+        pass
+
+    def _maybe_add_error_listener(self):
+        pass
+
+
+class StreamConnection(object):
+    """Stands for PConnection, writes to the <stream> and records what was
+    passed to it"""
+    def __init__(self, stream):
+        self.stream = stream
+        self.written = []
+
+    def write(self, chunk, callback=None, request=None):
+        if isinstance(chunk, list):
+            self.written.extend(chunk)
+            write_chunks(self.stream, chunk)
+        else:
+            self.written.append(chunk)
+            self.stream.write(chunk)
+
+    def finish(self, keep_alive=True, request=None):
+        pass
+
+
+class CopyCounter(object):
+    """Counts bytes copied by `iostream._merge_prefix`: strings which are in
+    the write buffer after the call, but weren't there before"""
+    def __init__(self):
+        self.copied = 0
+        self._merge_prefix = iostream._merge_prefix
+
+    def __call__(self, buf, size):
+        before = set(id(c) for c in buf)
+        self._merge_prefix(buf, size)
+        self.copied += sum(len(c) for c in buf if id(c) not in before)
+
+    def __enter__(self):
+        iostream._merge_prefix = self
+        return self
+
+    def __exit__(self, *exc_info):
+        iostream._merge_prefix = self._merge_prefix
+
+
+def legacy_write(request, chunks):
+    """NetStringReq.write_chunk/write as implemented in pserver 0.1"""
+    response_data = list(chunks[:-1])
+    response_data.append(chunks[-1])
+    response_data.append(',')
+    data = ''.join(response_data)
+    request.connection.write(str(len(data)-1) + ':')
+    request.connection.write(data)
+
+
+def current_write(request, chunks):
+    for chunk in chunks[:-1]:
+        request.write_chunk(chunk)
+    request.write(chunks[-1])
+
+
+def bytes_copied(written, chunks):
+    """number of bytes written which are not the handler's own chunk objects"""
+    originals = set(id(c) for c in chunks)
+    return sum(len(c) for c in written if id(c) not in originals)
+
+
+def run_case(write, size, num_chunks, send_size, number):
+    chunk = 'x' * (size // num_chunks)
+    chunks = [chunk] * num_chunks
+
+    def one():
+        conn = StreamConnection(FlushingStream(PartialSendSocket(send_size),
+                                               io_loop=object()))
+        write(NetStringReq(chunk, connection=conn, protocol='tcp'), chunks)
+        assert not conn.stream._write_buffer
+        return conn
+
+    with CopyCounter() as counter:
+        copied = bytes_copied(one().written, chunks)
+    seconds = min(timeit.repeat(one, number=number, repeat=3)) / number
+    return {"payload": len(chunk) * num_chunks, "bytes_copied": copied,
+            "bytes_copied_in_stream": counter.copied,
+            "usec_per_response": seconds * 1e6}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--chunks", type=int, default=1,
+                        help="number of write_chunk calls per response")
+    parser.add_argument("--send-size", type=int, default=64 * 1024,
+                        help="bytes accepted by a single socket send")
+    parser.add_argument("--json", action="store_true", help="machine readable output")
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in (16, 1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024):
+        number = max(10, 2000000 // (size + 1000))
+        for name, write in (("legacy", legacy_write), ("current", current_write)):
+            result = run_case(write, size, args.chunks, args.send_size, number)
+            result["impl"] = name
+            results.append(result)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+    print("{:>8} {:>10} {:>14} {:>16} {:>12}".format(
+        "impl", "payload", "bytes copied", "copied in stream", "usec/resp"))
+    for r in results:
+        print("{impl:>8} {payload:>10} {bytes_copied:>14} {bytes_copied_in_stream:>16} "
+              "{usec_per_response:>12.2f}".format(**r))
+
+
+if __name__ == '__main__':
+    main()
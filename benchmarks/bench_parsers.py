@@ -0,0 +1,89 @@
+"""Benchmark of the frame parsers.
+
+Reports the time per frame of decoding a buffer of --frames frames with the
+parsers of `pserver.framing`, and of serving the same buffer, received in
+a single read, by a connection which decodes it with its parser and by one
+which reads frame by frame with IOStream callbacks (parser = None).
+
+    python -m benchmarks.bench_parsers [--frames N] [--json]
+"""
+
+import argparse
+import json
+import sys
+import timeit
+
+from pserver import PServer, NetStringConn, NewLinerConn, LengthPrefixConn
+from pserver.framing import NetStringParser, NewLinerParser, LengthPrefixParser
+from pserver.protocols import length_prefix_frame
+from benchmarks.util import FakeIOLoop, FakeStream
+
+PROTOCOLS = {
+    "netstring": (NetStringParser(), NetStringConn,
+                  lambda body: [str(len(body)) + ':', body, ',']),
+    "newliner": (NewLinerParser(), NewLinerConn, lambda body: [body, '\n']),
+    "lengthprefix": (LengthPrefixParser(), LengthPrefixConn, length_prefix_frame),
+}
+
+
+def echo_handler(request):
+    request.write(request.body)
+
+
+def run_parse(parser, buf, num_frames, number):
+    def one():
+        frames, offset = parser.parse(buf)
+        assert len(frames) == num_frames
+    return min(timeit.repeat(one, number=number, repeat=3)) / number / num_frames
+
+
+def run_serve(conn_cls, buf, num_frames, number):
+    server = PServer(echo_handler, conn_cls, stats=False)
+
+    def one():
+        io_loop = FakeIOLoop()
+        stream = FakeStream(io_loop)
+        server.handle_stream(stream, ("127.0.0.1", 0))
+        io_loop.run_callbacks()
+        stream.feed(buf)
+        assert not stream._read_buffer
+    return min(timeit.repeat(one, number=number, repeat=3)) / number / num_frames
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--frames", type=int, default=200,
+                        help="number of frames in the buffer")
+    parser.add_argument("--json", action="store_true", help="machine readable output")
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in sorted(PROTOCOLS):
+        frame_parser, conn_cls, frame = PROTOCOLS[name]
+        callback_cls = type("Callback" + conn_cls.__name__, (conn_cls,),
+                            {"__slots__": (), "parser": None})
+        for size in (16, 1024, 16 * 1024):
+            buf = b"".join(b"".join(frame(b"x" * size)) for _ in range(args.frames))
+            number = max(3, 20000000 // (len(buf) + 100000))
+            result = {"protocol": name, "size": size, "frames": args.frames}
+            result["usec_per_frame_parse"] = 1e6 * run_parse(
+                frame_parser, bytearray(buf), args.frames, number * 10)
+            result["usec_per_frame_parser"] = 1e6 * run_serve(
+                conn_cls, buf, args.frames, number)
+            result["usec_per_frame_callbacks"] = 1e6 * run_serve(
+                callback_cls, buf, args.frames, number)
+            results.append(result)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+    print("{:>12} {:>6} {:>10} {:>14} {:>16}".format(
+        "protocol", "size", "parse us", "serve us", "callbacks us"))
+    for r in results:
+        print("{protocol:>12} {size:>6} {usec_per_frame_parse:>10.2f} "
+              "{usec_per_frame_parser:>14.2f} {usec_per_frame_callbacks:>16.2f}".format(**r))
+
+
+if __name__ == '__main__':
+    main()
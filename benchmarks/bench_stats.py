@@ -0,0 +1,93 @@
+"""Overhead of the stats subsystem.
+
+Drives NetStringConn over an in-memory stream with an echo handler, with
+stats enabled and disabled, and reports time per request. The overhead is
+the median over --rounds pairs of runs. Exits with status 1 when it
+exceeds --budget percent.
+
+    python -m benchmarks.bench_stats [--requests N] [--rounds N] [--budget PCT] [--json]
+"""
+
+import argparse
+import json
+import sys
+import timeit
+
+from pserver import PServer, NetStringConn
+from pserver.stats import Histogram
+from benchmarks.util import FakeStream
+
+
+def echo_handler(request):
+    request.write(request.body)
+
+
+def make_driver(stats, num_requests, pipeline):
+    server = PServer(echo_handler, NetStringConn, stats=stats)
+    stream = FakeStream()
+    NetStringConn(stream, ("127.0.0.1", 0), server.request_callback,
+                  max_pipeline=pipeline, server=server)
+    data = b"5:hello," * pipeline
+    rounds = num_requests // pipeline
+
+    def drive():
+        for _ in range(rounds):
+            stream.feed(data)
+    return drive
+
+
+def run(num_requests, pipeline, rounds):
+    """Returns the time per request without and with stats, and the median
+    relative overhead of stats. Every round builds new servers (so the
+    result doesn't depend on how the objects of a single pair are laid out
+    in memory) and times both of them alternately, so they are equally
+    affected by the noise of the machine."""
+    requests = num_requests // pipeline * pipeline
+    times = [[], []]
+    for round_ in range(rounds):
+        order = (0, 1) if round_ % 2 else (1, 0)
+        drivers = [None, None]
+        for i in order:
+            drivers[i] = make_driver(i == 1, num_requests, pipeline)
+        best = [float("inf")] * 2
+        for _ in range(3):
+            for i in order:
+                best[i] = min(best[i], timeit.timeit(drivers[i], number=1))
+        for i in order:
+            times[i].append(best[i] / requests)
+    overheads = sorted(with_ / without for without, with_ in zip(*times))
+    return min(times[0]), min(times[1]), (overheads[rounds // 2] - 1) * 100
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--pipeline", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=25)
+    parser.add_argument("--budget", type=float, default=5.0,
+                        help="allowed overhead, in percent")
+    parser.add_argument("--json", action="store_true", help="machine readable output")
+    args = parser.parse_args(argv)
+
+    without, with_stats, overhead = run(args.requests, args.pipeline, args.rounds)
+    histogram = Histogram()
+    record = min(timeit.repeat(lambda: histogram.record(12345), number=100000,
+                               repeat=3)) / 100000
+    result = {"usec_per_request_without_stats": without * 1e6,
+              "usec_per_request_with_stats": with_stats * 1e6,
+              "overhead_percent": overhead,
+              "usec_per_histogram_record": record * 1e6,
+              "budget_percent": args.budget}
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        for key in sorted(result):
+            print("{:>36}: {:.3f}".format(key, result[key]))
+    if result["overhead_percent"] > args.budget:
+        print("stats overhead exceeds the budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
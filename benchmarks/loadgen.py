@@ -0,0 +1,211 @@
+"""Load generator benchmark for PServer protocols.
+
+Starts an echo `PServer` in a separate process and drives it with many
+concurrent connections, for every combination of protocol, payload size and
+pipelining depth. Each connection keeps <depth> requests in flight. For
+every case it reports requests per second, latency percentiles (in
+microseconds) and the RSS of the server process, as JSON lines::
+
+    python -m benchmarks.loadgen --protocols netstring,newliner \\
+        --sizes 16,1024,65536 --depths 1,16 --connections 50 --duration 3
+
+Use --output to write results to a file, to compare them between versions.
+With --backends tornado,asyncio every case is run against both the tornado
+PServer and `pserver.aio.AsyncioPServer` (with uvloop, if it's installed).
+"""
+
+import argparse
+import collections
+import json
+import multiprocessing
+import socket
+import subprocess
+import sys
+import time
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from tornado.testing import get_unused_port
+
+from pserver import PServer, NetStringConn, NewLinerConn, LengthPrefixConn
+from pserver.protocols import length_prefix_frame, LP_HEADER
+from pserver.stats import Histogram
+
+PROTOCOLS = {"netstring": NetStringConn,
+             "newliner": NewLinerConn,
+             "lengthprefix": LengthPrefixConn}
+
+
+def echo_handler(request):
+    request.write(request.body)
+
+
+def run_server(port, protocol, max_pipeline, ready, backend="tornado"):
+    if backend == "asyncio":
+        from pserver.aio import AsyncioPServer, install_loop_policy
+        install_loop_policy()
+        server = AsyncioPServer(echo_handler, PROTOCOLS[protocol],
+                                max_pipeline=max_pipeline, stats=False)
+        server.listen(port, "127.0.0.1")
+        ready.set()
+        server.loop.run_forever()
+        return
+    server = PServer(echo_handler, PROTOCOLS[protocol], max_pipeline=max_pipeline,
+                     stats=False)
+    server.listen(port, "127.0.0.1")
+    ready.set()
+    IOLoop.instance().start()
+
+
+def rss_kb(pid):
+    """Returns resident set size of the process <pid> in kB."""
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    try:
+        return int(subprocess.check_output(["ps", "-o", "rss=", "-p", str(pid)]))
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+
+def make_frame(protocol, payload):
+    if protocol == "netstring":
+        return str(len(payload)) + ':' + payload + ','
+    if protocol == "newliner":
+        return payload + '\n'
+    return b"".join(length_prefix_frame(payload))
+
+
+class LoadConnection(object):
+    """Keeps <depth> requests in flight on a single connection until the
+    <deadline>, and records latency of every response."""
+    def __init__(self, io_loop, address, protocol, frame, depth, deadline,
+                 histogram, done):
+        self.io_loop = io_loop
+        self.protocol = protocol
+        self.frame = frame
+        self.depth = depth
+        self.deadline = deadline
+        self.histogram = histogram
+        self.done = done
+        self.sent = collections.deque()
+        self.stream = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0),
+                               io_loop)
+        self.stream.connect(address, self.start)
+
+    def start(self):
+        for _ in range(self.depth):
+            self.send()
+        self.read()
+
+    def send(self):
+        self.sent.append(time.time())
+        self.stream.write(self.frame)
+
+    def read(self):
+        if self.protocol == "netstring":
+            self.stream.read_until(':', self._on_netstring_head)
+        elif self.protocol == "newliner":
+            self.stream.read_until('\n', self.on_response)
+        else:
+            self.stream.read_bytes(LP_HEADER.size, self._on_lp_head)
+
+    def _on_netstring_head(self, head):
+        self.stream.read_bytes(int(head[:-1]) + 1, self.on_response)
+
+    def _on_lp_head(self, head):
+        num_bytes = LP_HEADER.unpack(head)[1]
+        if num_bytes:
+            self.stream.read_bytes(num_bytes, self.on_response)
+        else:
+            self.on_response(b"")
+
+    def on_response(self, data):
+        now = time.time()
+        self.histogram.record_time(now - self.sent.popleft())
+        if now < self.deadline:
+            self.send()
+        if self.sent:
+            self.read()
+        else:
+            self.stream.close()
+            self.done()
+
+
+def run_case(port, protocol, size, depth, connections, duration):
+    io_loop = IOLoop()
+    histogram = Histogram()
+    frame = make_frame(protocol, 'x' * size)
+    remaining = [connections]
+
+    def done():
+        remaining[0] -= 1
+        if not remaining[0]:
+            io_loop.stop()
+
+    start = time.time()
+    deadline = start + duration
+    for _ in range(connections):
+        LoadConnection(io_loop, ("127.0.0.1", port), protocol, frame, depth,
+                       deadline, histogram, done)
+    io_loop.start()
+    elapsed = time.time() - start
+    io_loop.close(all_fds=True)
+    snapshot = histogram.snapshot()
+    return {"requests": snapshot["count"],
+            "rps": snapshot["count"] / elapsed,
+            "p50_us": snapshot["p50"],
+            "p99_us": snapshot["p99"],
+            "p999_us": snapshot["p999"],
+            "max_us": snapshot["max"]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--protocols", default="netstring,newliner")
+    parser.add_argument("--sizes", default="16,1024,65536",
+                        help="comma separated payload sizes, in bytes")
+    parser.add_argument("--depths", default="1,16",
+                        help="comma separated pipelining depths")
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=3,
+                        help="seconds per case")
+    parser.add_argument("--backends", default="tornado",
+                        help="comma separated server backends: tornado, asyncio")
+    parser.add_argument("--output", help="file to write JSON lines to (default stdout)")
+    args = parser.parse_args(argv)
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    cases = [(backend, protocol) for protocol in args.protocols.split(",")
+             for backend in args.backends.split(",")]
+    for backend, protocol in cases:
+        depths = [int(d) for d in args.depths.split(",")]
+        port = get_unused_port()
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=run_server,
+                                         args=(port, protocol, max(depths), ready, backend))
+        server.start()
+        try:
+            ready.wait(5)
+            for size in [int(s) for s in args.sizes.split(",")]:
+                for depth in depths:
+                    result = run_case(port, protocol, size, depth,
+                                      args.connections, args.duration)
+                    result.update({"backend": backend, "protocol": protocol, "payload": size,
+                                   "depth": depth, "connections": args.connections,
+                                   "server_rss_kb": rss_kb(server.pid)})
+                    out.write(json.dumps(result, sort_keys=True) + "\n")
+                    out.flush()
+        finally:
+            server.terminate()
+            server.join()
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Helpers shared by benchmarks."""
+
+import collections
+import socket
+
+
+class FakeSocket(object):
+    family = socket.AF_INET
+
+
+class FakeIOLoop(object):
+    """Runs callbacks when `run_callbacks` is called, ignores timeouts"""
+    def __init__(self):
+        self.callbacks = collections.deque()
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def add_timeout(self, deadline, callback):
+        return object()
+
+    def remove_timeout(self, timeout):
+        pass
+
+    def run_callbacks(self):
+        callbacks = self.callbacks
+        while callbacks:
+            callbacks.popleft()()
+
+
+class FakeStream(object):
+    """In-memory replacement of IOStream, with just enough of its API to drive
+    PConnection without sockets. Data passed to `feed` is delivered to
+    pending `read_*` calls, written data is counted and dropped."""
+    def __init__(self, io_loop=None):
+        self.socket = FakeSocket()
+        self.io_loop = io_loop or FakeIOLoop()
+        self._read_buffer = bytearray()
+        self._read_delimiter = None
+        self._read_bytes = None
+        self._read_callback = None
+        self._write_buffer = collections.deque()
+        self._closed = False
+        self.bytes_written = 0
+
+    def set_close_callback(self, callback):
+        self._close_callback = callback
+
+    def read_until(self, delimiter, callback):
+        self._read_delimiter, self._read_callback = delimiter, callback
+        self._read_from_buffer()
+
+    def read_bytes(self, num_bytes, callback):
+        self._read_bytes, self._read_callback = num_bytes, callback
+        self._read_from_buffer()
+
+    def _read_from_buffer(self):
+        buf = self._read_buffer
+        if self._read_delimiter is not None:
+            loc = buf.find(self._read_delimiter)
+            if loc == -1:
+                return
+            size = loc + len(self._read_delimiter)
+        elif self._read_bytes is not None and len(buf) >= self._read_bytes:
+            size = self._read_bytes
+        else:
+            return
+        data = bytes(buf[:size])
+        del buf[:size]
+        callback = self._read_callback
+        self._read_delimiter = self._read_bytes = self._read_callback = None
+        self.io_loop.add_callback(lambda: callback(data))
+
+    def feed(self, data):
+        self._read_buffer += data
+        if self._read_callback is not None:
+            self._read_from_buffer()
+        self.io_loop.run_callbacks()
+
+    def write(self, data, callback=None):
+        self.bytes_written += len(data) + sum(len(c) for c in self._write_buffer)
+        self._write_buffer.clear()
+        if callback is not None:
+            self.io_loop.add_callback(callback)
+
+    def writing(self):
+        return False
+
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.io_loop.add_callback(self._close_callback)
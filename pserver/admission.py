@@ -0,0 +1,149 @@
+# Copyright 2012 Robert Zaremba
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Admission control and load shedding.
+
+Without it an overloaded server keeps queuing requests, and the latency
+grows for all of them. `AdmissionController` watches the number of
+in-flight requests and the recent latency, and when one of them exceeds
+its budget, new requests are answered right away with the protocol's
+"busy" response (`PConnection.busy_response`), without calling the
+handler::
+
+    admission = AdmissionController(max_in_flight=1000, max_latency=0.05)
+    server = PServer(handle_request, NetStringConn, admission=admission)
+
+With <pause_accepting> the server also stops accepting new connections
+while it's overloaded. Counters are in `PServer.stats()["admission"]`.
+"""
+
+import time
+from tornado.ioloop import IOLoop
+
+from . import logger
+from .stats import Histogram
+
+
+class AdmissionController(object):
+    """Decides if a new request can be handled.
+
+    The server is overloaded when <max_in_flight> requests (admitted and
+    not answered yet) are being handled, or when the <percentile> of
+    `request_time()` of requests answered within the last <window>
+    seconds exceeds <max_latency> seconds. Either budget can be None.
+    A window without answered requests resets the latency, so after a
+    while of shedding requests are admitted again, and measured anew.
+
+    Requests which arrive when the server is overloaded are rejected with
+    a busy response if <reject> is True, and admitted otherwise. With
+    <pause_accepting> the server stops accepting connections while it's
+    overloaded (not supported by `aio.AsyncioPServer`).
+    """
+    def __init__(self, max_in_flight=None, max_latency=None, percentile=99, window=1.0,
+                 reject=True, pause_accepting=False):
+        assert reject or pause_accepting, "overload must either reject requests or pause accepting"
+        self.max_in_flight = max_in_flight
+        self.max_latency = max_latency
+        self.percentile = percentile
+        self.window = window
+        self.reject = reject
+        self.pause_accepting = pause_accepting
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.pauses = 0         # number of times accepting was paused
+        self.latency = 0.0      # <percentile> of the last complete window, in seconds
+        self._samples = Histogram()
+        self._window_end = time.time() + window
+
+    def overloaded(self):
+        if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+            return True
+        if self.max_latency is not None:
+            self._roll(time.time())
+            return self.latency > self.max_latency
+        return False
+
+    def admit(self, request):
+        """Counts the <request> as in-flight until it's answered."""
+        self.in_flight += 1
+        self.admitted += 1
+        request.observe_response(self._on_response)
+
+    def _on_response(self, request, chunks):
+        self.in_flight -= 1
+        if self.max_latency is not None:
+            self._roll(time.time())
+            self._samples.record_time(request.request_time())
+
+    def _roll(self, now):
+        if now < self._window_end:
+            return
+        if now < self._window_end + self.window and self._samples.count:
+            self.latency = self._samples.percentile(self.percentile) / 1e6
+        else:
+            self.latency = 0.0  # no requests were answered recently
+        self._samples = Histogram()
+        self._window_end = now + self.window
+
+    def snapshot(self):
+        return {"in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "pauses": self.pauses,
+                "latency": int(self.latency * 1e6)}
+
+
+class AdmissionDispatcher(object):
+    """Passes requests admitted by the <controller> to <callback>, answers
+    others with the busy response, and pauses accepting connections of
+    the <server> while it's overloaded, if the controller says so."""
+    def __init__(self, callback, controller, server):
+        self.callback = callback
+        self.controller = controller
+        self.server = server
+        self._resume_check = None
+
+    def __call__(self, request):
+        controller = self.controller
+        if controller.overloaded() and controller.reject:
+            controller.rejected += 1
+            request.set_cacheable(False)
+            request.write(request.connection.busy_response)
+            self._maybe_pause()
+            return None
+        controller.admit(request)
+        self._maybe_pause()
+        return self.callback(request)
+
+    def _maybe_pause(self):
+        if (self.controller.pause_accepting and self._resume_check is None
+                and self.controller.overloaded()):
+            logger.warning("server is overloaded, pausing accepting connections")
+            self.controller.pauses += 1
+            self.server.pause_accepting()
+            self._schedule_check()
+
+    def _schedule_check(self):
+        io_loop = self.server.io_loop or IOLoop.instance()
+        self._resume_check = io_loop.add_timeout(
+            time.time() + min(self.controller.window, 0.1), self._on_resume_check)
+
+    def _on_resume_check(self):
+        if self.controller.overloaded():
+            self._schedule_check()
+        else:
+            self._resume_check = None
+            logger.info("resuming accepting connections")
+            self.server.resume_accepting()
@@ -0,0 +1,278 @@
+# Copyright 2012 Robert Zaremba
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""asyncio backend of PServer.
+
+`AsyncioPServer` accepts connections with an asyncio event loop instead of
+tornado's IOLoop. Every connection is an `asyncio.Protocol` which provides
+the part of the IOStream API used by connections, so the same protocols
+(`PConnection` subclasses), requests and handlers run unchanged::
+
+    from pserver.aio import AsyncioPServer, install_loop_policy
+
+    install_loop_policy()       # uvloop, if it's installed
+    server = AsyncioPServer(handle_request, NetStringConn)
+    server.listen(8888)
+    asyncio.get_event_loop().run_forever()
+
+Received data is delivered to pending reads directly from `data_received`,
+without IOLoop callbacks and stack contexts. On Python 2 the trollius port
+of asyncio is used.
+"""
+
+import time
+try:
+    import asyncio
+except ImportError:     # Python 2
+    import trollius as asyncio
+
+from . import logger
+from .base import PServer
+
+
+def install_loop_policy(policy=None):
+    """Sets the asyncio event loop <policy>. By default uses uvloop if it's
+    installed, and keeps the current policy otherwise. Returns the policy."""
+    if policy is None:
+        try:
+            import uvloop
+        except ImportError:
+            return asyncio.get_event_loop_policy()
+        policy = uvloop.EventLoopPolicy()
+    asyncio.set_event_loop_policy(policy)
+    return policy
+
+
+class LoopAdapter(object):
+    """The part of tornado IOLoop API used by connections and dispatchers,
+    on top of an asyncio <loop>. Deadlines are `time.time()` based, like
+    in tornado."""
+    def __init__(self, loop):
+        self.loop = loop
+
+    def add_callback(self, callback):
+        self.loop.call_soon_threadsafe(callback)
+
+    def add_timeout(self, deadline, callback):
+        return self.loop.call_later(max(0, deadline - time.time()), callback)
+
+    def remove_timeout(self, timeout):
+        timeout.cancel()
+
+    def ensure_future(self, awaitable):
+        return asyncio.ensure_future(awaitable, loop=self.loop)
+
+
+class AsyncioStream(asyncio.Protocol):
+    """A connection accepted by AsyncioPServer, with the IOStream API used by
+    `PConnection`: `read_until`, `read_until_regex`, `read_bytes`, `write`
+    with a callback run when the output is flushed, `writing`, `close` and
+    a close callback.
+
+    Like IOStream, the stream is closed when its read buffer exceeds
+    `max_buffer_size`. Data which is received while no read is pending
+    (the pipeline of the connection is full or its reads are paused by flow
+    control) is buffered up to `read_ahead` bytes, then the transport stops
+    reading until the next read."""
+    max_buffer_size = 104857600
+    read_ahead = 64 * 1024
+
+    def __init__(self, server):
+        self.server = server
+        self.io_loop = server.io_loop
+        self.socket = None
+        self.transport = None
+        self._read_buffer = bytearray()
+        self._read_buffer_size = 0
+        self._read_delimiter = None
+        self._read_regex = None
+        self._read_bytes = None
+        self._read_callback = None
+        self._write_buffer = []     # chunks put by `write_chunks`, sent by next `write`
+        self._write_callback = None
+        self._close_callback = None
+        self._closed = False
+        self._reading_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.socket = transport.get_extra_info("socket")
+        # pause_writing / resume_writing tell when the output is flushed
+        transport.set_write_buffer_limits(0)
+        self.server.handle_stream(self, transport.get_extra_info("peername"))
+
+    def data_received(self, data):
+        self._read_buffer += data
+        self._read_buffer_size += len(data)
+        if self._read_callback is not None:
+            self._read_from_buffer(False)
+        if self._closed:
+            return
+        if self._read_buffer_size >= self.max_buffer_size:
+            logger.error("Reached maximum read buffer size")
+            self.close()
+        elif (self._read_callback is None and not self._reading_paused
+                and self._read_buffer_size >= self.read_ahead):
+            self._reading_paused = True
+            self.transport.pause_reading()
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            logger.debug("connection lost: %s", exc)
+        self._closed = True
+        self._read_callback = self._write_callback = None
+        callback, self._close_callback = self._close_callback, None
+        if callback is not None:
+            callback()
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        callback, self._write_callback = self._write_callback, None
+        if callback is not None:
+            callback()
+
+    def set_close_callback(self, callback):
+        self._close_callback = callback
+
+    def read_until(self, delimiter, callback):
+        assert self._read_callback is None, "Already reading"
+        self._read_delimiter, self._read_callback = delimiter, callback
+        self._read_from_buffer(True)
+        self._maybe_resume_reading()
+
+    def read_until_regex(self, regex, callback):
+        assert self._read_callback is None, "Already reading"
+        self._read_regex, self._read_callback = regex, callback
+        self._read_from_buffer(True)
+        self._maybe_resume_reading()
+
+    def read_bytes(self, num_bytes, callback):
+        assert self._read_callback is None, "Already reading"
+        self._read_bytes, self._read_callback = num_bytes, callback
+        self._read_from_buffer(True)
+        self._maybe_resume_reading()
+
+    def _maybe_resume_reading(self):
+        """Resumes reading paused by `data_received`, when the buffer doesn't
+        have enough data for the pending read."""
+        if self._reading_paused and self._read_callback is not None and not self._closed:
+            self._reading_paused = False
+            self.transport.resume_reading()
+
+    def _read_from_buffer(self, defer):
+        """Completes the pending read if the buffer has enough data. Reads
+        which are completed right away (<defer>) run their callback in the
+        next loop iteration, like IOStream does, so protocols reading frame
+        after frame don't recurse."""
+        buf = self._read_buffer
+        if self._read_delimiter is not None:
+            loc = buf.find(self._read_delimiter)
+            if loc == -1:
+                return
+            size = loc + len(self._read_delimiter)
+        elif self._read_regex is not None:
+            m = self._read_regex.search(buf)
+            if m is None:
+                return
+            size = m.end()
+        elif len(buf) >= self._read_bytes:
+            size = self._read_bytes
+        else:
+            return
+        data = self._consume(size)
+        callback = self._read_callback
+        self._read_delimiter = self._read_regex = self._read_bytes = None
+        self._read_callback = None
+        if defer:
+            self.server.loop.call_soon(callback, data)
+        else:
+            callback(data)
+
+    def _consume(self, num_bytes):
+        data = bytes(self._read_buffer[:num_bytes])
+        del self._read_buffer[:num_bytes]
+        self._read_buffer_size -= num_bytes
+        return data
+
+    def _unread(self, data):
+        self._read_buffer[:0] = data
+        self._read_buffer_size += len(data)
+
+    def write(self, data, callback=None):
+        if self._closed:
+            raise IOError("Stream is closed")
+        chunks = self._write_buffer
+        if chunks:
+            chunks.append(data)
+            self.transport.writelines(chunks)
+            del chunks[:]
+        elif data:
+            self.transport.write(data)
+        self._write_callback = callback
+        if callback is not None and not self.transport.get_write_buffer_size():
+            self._write_callback = None
+            self.server.loop.call_soon(callback)
+
+    def get_write_buffer_size(self):
+        return self.transport.get_write_buffer_size() if self.transport else 0
+
+    def writing(self):
+        return bool(self.get_write_buffer_size())
+
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        if not self._closed and self.transport is not None:
+            self.transport.close()
+        self._closed = True
+
+
+class AsyncioPServer(PServer):
+    """PServer running on the asyncio event <loop> (by default the current
+    loop, see `install_loop_policy`). Takes the same arguments as PServer,
+    except <io_loop>. TLS handshakes are done by asyncio, they are not
+    counted in stats. Admission control can't pause accepting connections."""
+    def __init__(self, request_callback, protocol_conn, loop=None, **kwargs):
+        assert "io_loop" not in kwargs, "AsyncioPServer runs on an asyncio loop"
+        admission = kwargs.get("admission")
+        assert admission is None or not admission.pause_accepting, \
+            "AsyncioPServer can't pause accepting connections"
+        self.loop = loop or asyncio.get_event_loop()
+        self._servers = []
+        PServer.__init__(self, request_callback, protocol_conn,
+                         io_loop=LoopAdapter(self.loop), **kwargs)
+
+    def add_sockets(self, sockets):
+        for sock in sockets:
+            self._sockets[sock.fileno()] = sock
+            task = self.loop.create_task(self.loop.create_server(
+                lambda: AsyncioStream(self), sock=sock, ssl=self.ssl_context))
+            task.add_done_callback(self._on_server)
+
+    def _on_server(self, task):
+        if task.exception() is not None:
+            logger.error("can't start the server: %s", task.exception())
+        else:
+            self._servers.append(task.result())
+
+    def stop(self):
+        for server in self._servers:
+            server.close()
+        self._servers = []
+        for sock in self._sockets.values():
+            sock.close()
+        self._sockets = {}
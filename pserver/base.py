@@ -20,14 +20,25 @@ stream definied by:
 The code is based on HTTP server implementation
 """
 
+import collections
+import errno
+import functools
 import socket
 import time
 import ssl # Python 2.6+
+from tornado.ioloop import IOLoop
 from tornado.iostream import  SSLIOStream
-from tornado.netutil import TCPServer
+from tornado.netutil import TCPServer, add_accept_handler
 from tornado import stack_context
 
 from . import logger
+from .admission import AdmissionDispatcher
+from .cache import CachingDispatcher
+from .framing import ProtocolError
+from .dispatch import (RequestBatcher, ExecutorDispatcher, CoalescingDispatcher,
+                       FairScheduler)
+from .stats import ProtocolStats, TLSStats
+from .tls import TLSStream, make_ssl_context
 
 
 class PServer(TCPServer):
@@ -61,28 +72,292 @@ class PServer(TCPServer):
     `PServer` constructor, which will ensure the connection is not closed
     on every request. This can be overwrited by request_handler on request object
 
+    By default a connection handles one request at a time. Clients which send
+    many requests back to back can be served with ``max_pipeline`` argument:
+    connection keeps dispatching already buffered requests (up to
+    ``max_pipeline`` in-flight requests) and writes responses in the request order.
+
     `PServer` are the same as initialization methods defined on
     `tornado.netutil.TCPServer`:
         http://www.tornadoweb.org/documentation/netutil.html#tornado.netutil.TCPServer
     """
     def __init__(self, request_callback, protocol_conn, keep_alive=True, io_loop=None,
-                 ssl_options=None):
+                 ssl_options=None, max_pipeline=1, batch_callback=None,
+                 batch_size=100, batch_delay=0, request_timeout=None,
+                 executor=None, executor_max_pending=None, executor_max_queue=1024,
+                 write_high_water=None, write_low_water=None, max_output_buffer=None, stats=True,
+                 cache=None, coalesce=False, coalesce_key=None, ssl_session_tickets=True,
+                 admission=None, fair_scheduling=False, classify=None,
+                 class_weights=None, dispatch_budget=64, stats_sample=64):
         """Initialize PServer with protocol specified by <protocol_connection>, and
         <request_callback> as na callable to handle requests objects (which is build by protocol_conn)
+
+        <max_pipeline> is a maximum number of requests which a single connection
+        can handle concurrently. With value greater than 1 connection keeps reading
+        frames which client sent back to back, and responses are written in the
+        request order.
+
+        If <batch_callback> is given, requests from all connections are
+        collected and passed to it as a list (see `dispatch.RequestBatcher`),
+        up to <batch_size> requests, waiting at most <batch_delay> seconds.
+        In that case <request_callback> is not used.
+
+        <request_callback> may return a Future, see
+        `PConnection.make_request`. Requests which aren't finished within
+        <request_timeout> seconds are abandoned and their connection is closed.
+
+        If <executor> is given, <request_callback> must be a function which
+        takes request body and returns the response. It's run in the executor
+        (see `dispatch.ExecutorDispatcher`), with at most <executor_max_pending>
+        requests submitted at once, and at most <executor_max_queue> waiting.
+        Requests which don't fit in the queue get the busy response.
+
+        Flow control: a connection stops reading requests when more than
+        <write_high_water> bytes of its responses are waiting in the stream
+        buffer, and resumes when it drops to <write_low_water> (by default
+        half of the high water mark). The level is checked when requests of
+        the connection finish and when the stream reports a flush, which
+        IOStream of tornado < 4 does only once its buffer is empty, so
+        a connection without requests in flight resumes only when all of
+        its output is flushed. <max_output_buffer> limits the total size of
+        unflushed output of all connections in the same way.
+
+        With <stats> connections collect counters and latency histograms,
+        available through `stats` method. Latencies are measured for every
+        <stats_sample>-th request only (1 measures all of them).
+
+        <cache> is a `cache.ResponseCache`. When given, responses are cached
+        by the protocol and the request body, and repeated requests are
+        answered without calling the handler.
+
+        With <coalesce> concurrent requests with the same protocol and body
+        (or the same <coalesce_key(request)>) share one handler execution,
+        see `dispatch.CoalescingDispatcher`.
+
+        <ssl_options> (a dict of `ssl.wrap_socket` arguments or an SSLContext)
+        enables TLS. A single SSLContext is used for all connections, so
+        clients can resume their sessions, from the session cache or, unless
+        <ssl_session_tickets> is False, with session tickets. See `tls`.
+
+        <admission> is an `admission.AdmissionController`. When given,
+        requests which arrive while the server is overloaded are answered
+        with a busy response, or the server stops accepting connections.
+
+        With <fair_scheduling> requests are queued per connection and
+        dispatched by weighted fair queuing, at most <dispatch_budget> in
+        one IOLoop iteration. <classify(request)> assigns requests to
+        priority classes (see `dispatch.classify_by_ip`), weighted by
+        <class_weights>. See `dispatch.FairScheduler`.
         """
+        self.executor_dispatcher = None
+        if batch_callback is not None:
+            assert executor is None, "batch_callback can't be used with executor"
+            request_callback = RequestBatcher(batch_callback, batch_size,
+                                              batch_delay, io_loop)
+        elif executor is not None:
+            request_callback = self.executor_dispatcher = ExecutorDispatcher(
+                request_callback, executor, executor_max_pending, io_loop,
+                executor_max_queue)
+        self.coalescer = None
+        if coalesce or coalesce_key is not None:
+            request_callback = self.coalescer = CoalescingDispatcher(
+                request_callback, coalesce_key)
+        self.scheduler = None
+        if fair_scheduling or classify is not None:
+            request_callback = self.scheduler = FairScheduler(
+                request_callback, classify, class_weights, dispatch_budget, io_loop)
+        self.admission = admission
+        if admission is not None:
+            request_callback = AdmissionDispatcher(request_callback, admission, self)
+        self.cache = cache
+        if cache is not None:
+            request_callback = CachingDispatcher(request_callback, cache)
         self.request_callback = request_callback
         self.protocol_conn = protocol_conn
         self.keep_alive = keep_alive
-        TCPServer.__init__(self, io_loop=io_loop, ssl_options=ssl_options)
+        self.max_pipeline = max_pipeline
+        self.request_timeout = request_timeout
+        self.write_high_water = write_high_water
+        self.write_low_water = write_low_water
+        self.max_output_buffer = max_output_buffer
+        self.buffered_bytes = 0   # unflushed output of all connections
+        self._request_pools = {}  # request class -> finished requests for reuse
+        self._released_requests = []   # (request, pool size) to pool in the next iteration
+        self._paused_readers = set()   # connections paused by max_output_buffer
+        self.stats_enabled = stats
+        self.stats_sample = stats_sample
+        self._protocol_stats = {}     # protocol connection class name -> ProtocolStats
+        self._connections = set()
+        self._drain_callback = None
+        self._drain_timeout = None
+        self._accepting_paused = False
+        self.ssl_context = None
+        self.tls_stats = None
+        if ssl_options is not None:
+            self.ssl_context = make_ssl_context(ssl_options, ssl_session_tickets)
+            if stats:
+                self.tls_stats = TLSStats()
+        # connections are wrapped with ssl_context by `_handle_connection`,
+        # TCPServer would check ssl_options as a dict
+        TCPServer.__init__(self, io_loop=io_loop)
+        self.ssl_options = ssl_options
         logger.debug("PServer initialized")
 
     def sockets_names(self):
         return [s.getsockname() for s in self._sockets.values()]
 
+    def _handle_connection(self, connection, address):
+        if self.ssl_context is None:
+            return TCPServer._handle_connection(self, connection, address)
+        try:
+            connection = self.ssl_context.wrap_socket(connection, server_side=True,
+                                                      do_handshake_on_connect=False)
+        except ssl.SSLError as err:
+            if err.args[0] == ssl.SSL_ERROR_EOF:
+                return connection.close()
+            raise
+        except socket.error as err:
+            if err.args[0] == errno.ECONNABORTED:
+                return connection.close()
+            raise
+        try:
+            stream = TLSStream(connection, io_loop=self.io_loop, tls_stats=self.tls_stats)
+            self.handle_stream(stream, address)
+        except Exception:
+            logger.exception("Error in connection callback")
+
     def handle_stream(self, stream, address):
-        logger.info("handling new stream - a connection with %s", address)
-        self.protocol_conn(stream, address, self.request_callback,
-                           self.keep_alive)
+        logger.debug("handling new stream - a connection with %s", address)
+        conn = self.protocol_conn(stream, address, self.request_callback,
+                                  self.keep_alive, max_pipeline=self.max_pipeline,
+                                  request_timeout=self.request_timeout,
+                                  write_high_water=self.write_high_water,
+                                  write_low_water=self.write_low_water, server=self)
+        self._connections.add(conn)
+
+    def _pool_released_requests(self):
+        released, self._released_requests = self._released_requests, []
+        pools = self._request_pools
+        for request, pool_size in released:
+            pool = pools.setdefault(type(request), [])
+            if len(pool) < pool_size:
+                request.body = request.connection = None   # don't keep them alive
+                pool.append(request)
+
+    def protocol_stats(self, conn_cls):
+        """Returns ProtocolStats for connections of <conn_cls>, or None
+        if stats are disabled."""
+        if not self.stats_enabled:
+            return None
+        name = conn_cls.__name__
+        stats = self._protocol_stats.get(name)
+        if stats is None:
+            stats = self._protocol_stats[name] = ProtocolStats(self.stats_sample)
+        return stats
+
+    def stats(self):
+        """Returns snapshot of the server counters as a dict. Latencies are
+        given in microseconds, see `stats.ProtocolStats`."""
+        protocols = dict((name, stats.snapshot())
+                         for name, stats in self._protocol_stats.items())
+        result = {"connections": len(self._connections),
+                  "in_flight": self.in_flight(),
+                  "buffered_bytes": self.buffered_bytes,
+                  "executor_queue_depth": self.executor_queue_depth(),
+                  "protocols": protocols}
+        if self.executor_dispatcher is not None:
+            result["executor_rejected"] = self.executor_dispatcher.rejected
+        if self.cache is not None:
+            result["cache"] = self.cache.snapshot()
+        if self.coalescer is not None:
+            result["coalesced"] = self.coalescer.coalesced
+        if self.scheduler is not None:
+            result["scheduler"] = self.scheduler.snapshot()
+        if self.admission is not None:
+            result["admission"] = self.admission.snapshot()
+        if self.tls_stats is not None:
+            result["tls"] = self.tls_stats.snapshot()
+        for key in ("requests", "bytes_in", "bytes_out"):
+            result[key] = sum(p[key] for p in protocols.values())
+        return result
+
+    def _resume_readers(self):
+        """Resumes reading of connections paused by <max_output_buffer>, when
+        the output of all connections drops below it."""
+        if self._paused_readers and self.buffered_bytes <= self.max_output_buffer:
+            readers, self._paused_readers = self._paused_readers, set()
+            for conn in readers:
+                conn.stream.io_loop.add_callback(conn._maybe_read)
+
+    def in_flight(self):
+        """Returns number of requests being handled by all connections."""
+        return sum(len(conn._requests) for conn in self._connections)
+
+    def executor_queue_depth(self):
+        """Returns number of requests waiting for, or being processed by the executor."""
+        if self.executor_dispatcher is None:
+            return 0
+        return self.executor_dispatcher.queue_depth
+
+    def stop(self):
+        TCPServer.stop(self)
+        self._sockets = {}
+        self._accepting_paused = False
+
+    def pause_accepting(self):
+        """Stops accepting new connections until `resume_accepting`. The
+        listening sockets stay open, so connecting clients wait in their
+        backlog."""
+        if self._accepting_paused:
+            return
+        self._accepting_paused = True
+        for fd in self._sockets:
+            self.io_loop.remove_handler(fd)
+
+    def resume_accepting(self):
+        if not self._accepting_paused:
+            return
+        self._accepting_paused = False
+        for sock in self._sockets.values():
+            add_accept_handler(sock, self._handle_connection, io_loop=self.io_loop)
+
+    def drain(self, callback=None, timeout=None):
+        """Stops accepting new connections and closes existing ones when
+        their in-flight requests are finished.
+
+        <callback> is called when all connections are closed. If <timeout>
+        (in seconds) is given, connections which are still open after that
+        time are closed forcefully."""
+        self.stop()
+        self._drain_callback = callback or (lambda: None)
+        for conn in list(self._connections):
+            conn.close_gracefully()
+        if timeout is not None and self._connections:
+            io_loop = self.io_loop or IOLoop.instance()
+            self._drain_timeout = io_loop.add_timeout(time.time() + timeout,
+                                                      self._on_drain_timeout)
+        self._check_drained()
+
+    def _on_drain_timeout(self):
+        self._drain_timeout = None
+        logger.warning("closing %d connections which didn't finish in time",
+                       len(self._connections))
+        for conn in list(self._connections):
+            conn.stream.close()
+        self._check_drained()
+
+    def _check_drained(self):
+        if self._drain_callback is None or self._connections:
+            return
+        if self._drain_timeout is not None:
+            (self.io_loop or IOLoop.instance()).remove_timeout(self._drain_timeout)
+            self._drain_timeout = None
+        callback, self._drain_callback = self._drain_callback, None
+        callback()
+
+    def _connection_closed(self, conn):
+        self._connections.discard(conn)
+        self._check_drained()
 
 
 class PConnection(object):
@@ -100,12 +375,41 @@ class PConnection(object):
       be anything you want.
       * implement approprite `write` method.
       * implement `on_request` which takes needs to be called from the first
-      `stream.read_*` function
-
+      `stream.read_*` function, and which should call `_start_frame` to
+      record the parse time and keep `close_gracefully` from closing the
+      connection in the middle of the frame
+      * optionally set `parser` to a `framing.FrameParser` of the protocol.
+      Complete frames which are already buffered by the stream are then
+      parsed in one pass and passed to `on_frame`, without `stream.read_*`
+      callbacks. `read` is used only when the buffer has no complete frame.
+
+    Connections and requests have `__slots__`, so that a big number of idle
+    connections takes little memory. Derived classes should define
+    `__slots__` with their own attributes, too.
     """
+    __slots__ = ("stream", "address", "request_callback", "keep_alive", "max_pipeline",
+                 "request_timeout", "server", "write_high_water", "write_low_water",
+                 "_flow_control", "_buffered", "_paused", "_requests",
+                 "_reading", "_batching", "_in_frame", "_write_callbacks", "_stats",
+                 "_frame_start", "_flush_start", "__weakref__")
     ReqCls  = NotImplementedError
-
-    def __init__(self, stream, address, request_callback, keep_alive=True):
+    # With ordered = False responses are written as soon as they are ready,
+    # regardless of the request order. Protocol must match responses with
+    # requests itself (e.g. by request ids).
+    ordered = True
+    # Finished requests are kept by the server for reuse, up to this many per
+    # request class. Requests which outlive their handler in the server
+    # (retained by a Future, the executor, the coalescer or a streamed
+    # response) are not reused. Enable it only if handlers don't keep
+    # references to finished requests.
+    request_pool_size = 0
+    parser = None   # framing.FrameParser, shared by all connections of the class
+    # Response to requests rejected by admission control (see `admission`).
+    busy_response = b"BUSY"
+
+    def __init__(self, stream, address, request_callback, keep_alive=True,
+                 max_pipeline=1, request_timeout=None, write_high_water=None,
+                 write_low_water=None, server=None):
         self.stream = stream
         if self.stream.socket.family not in (socket.AF_INET, socket.AF_INET6):
             # Unix (or other) socket; fake the remote address
@@ -113,71 +417,484 @@ class PConnection(object):
         self.address = address
         self.request_callback = request_callback
         self.keep_alive = keep_alive
-        self._request = None
-        self._request_finished = False
-        self._write_callback = None
-        # Save stack context here, outside of any request.  This keeps
-        # contexts from one request from leaking into the next.
-        self._on_request = self.on_request   # make safe copy
-        self.on_request = stack_context.wrap(self._on_request)
-        self.read()
+        self.max_pipeline = max(1, max_pipeline)
+        self.request_timeout = request_timeout
+        self.server = server
+        if write_high_water is not None and write_low_water is None:
+            write_low_water = write_high_water // 2
+        self.write_high_water = write_high_water
+        self.write_low_water = write_low_water
+        self._flow_control = write_high_water is not None or (
+            server is not None and server.max_output_buffer is not None)
+        self._buffered = 0       # unflushed output, as last accounted
+        self._paused = False
+        # in-flight requests, in arrival order; pipelines are short, and
+        # a list is much smaller than a deque. Requests of connections which
+        # aren't ordered finish in any order, they are kept in a set.
+        self._requests = [] if self.ordered else _UnorderedRequests()
+        self._reading = False
+        self._batching = False   # dispatching frames parsed from the buffer
+        self._in_frame = False   # a part of the frame was read, it's not dispatched yet
+        self._write_callbacks = None
+        self._stats = server.protocol_stats(type(self)) if server is not None else None
+        self._frame_start = None
+        self._flush_start = None
+        if self._stats is not None:
+            self._stats.accepted += 1
+            self._stats.connections += 1
+        self.stream.set_close_callback(self._on_close)
+        self._maybe_read()      # unless the output of the server is over its limit
 
     def read(self):    # TODO
         """define here the start functionality of you protocol.
-        The  first callback to `stream.read*` function should be `on_requst`,
-        which is context wrapped `_on_read` function which you must to implement as an method.
+        The  first callback to `stream.read*` function should be `on_request`,
+        which you must to implement as an method. `read` is called outside of
+        any request's stack context.
           When whole data is ready, and buffered `self.make_request(data)` should be called"""
         raise NotImplementedError("read function must be implemented in derived class")
 
-    def make_request(self, data):
-        self._request = self.ReqCls(data, connection=self, remote_ip=self.address[0])
+    def on_frame(self, frame):
+        """Handles a frame decoded by `parser`."""
+        self.make_request(frame)
+
+    def max_parsed_size(self):
+        """Frames with bodies longer than this are not decoded by `parser`,
+        but read with `read`, e.g. to stream them."""
+        return None
+
+    def _start_frame(self):
+        """Marks the beginning of a frame, which protocols call when they read
+        its first part (e.g. the header). `close_gracefully` doesn't close the
+        connection until the frame is dispatched. It's timed for the parse
+        time statistics, only every `sample_every`-th frame."""
+        self._in_frame = True
+        stats = self._stats
+        if stats is not None and not stats.requests % stats.sample_every:
+            self._frame_start = time.time()
+
+    def _on_close(self):
+        if self._stats is not None:
+            self._stats.connections -= 1
+        for request in self._requests:
+            if request._response_observers is not None:
+                request._notify_response(None)     # abandoned
+        if self.server is not None:
+            self.server._paused_readers.discard(self)
+            self.server.buffered_bytes -= self._buffered
+            if self._buffered:
+                self._buffered = 0
+                self.server._resume_readers()
+            self.server._connection_closed(self)
+
+    def close_gracefully(self):
+        """Closes the connection after in-flight requests are finished and
+        their responses are flushed. A request which is already partially
+        received is read and handled first."""
+        self.keep_alive = False
+        if (not self._requests and not self._in_frame and not self.stream.writing()
+                and not getattr(self.stream, "_read_buffer_size", 0)):
+            self.stream.close()
+
+    def _read_next(self):
+        self._reading = True
+        if self.parser is not None and self._dispatch_buffered():
+            if not self._can_read():
+                return      # `_maybe_read` continues, when the pipeline has a room
+            self._reading = True
+        # Read outside of any request's stack context. This keeps contexts
+        # from one request from leaking into the next.
+        with stack_context.NullContext():
+            self.read()
+
+    def _dispatch_buffered(self):
+        """Dispatches complete frames which are already in the read buffer
+        of the stream, while the pipeline has a room for them. Returns True
+        if any frame was dispatched.
+
+        Frames are dispatched one after another, each after the handler of
+        the previous one returns, like frames read with callbacks. Frames
+        which are not decoded (malformed, too big) are left in the buffer
+        for `read`, which handles them."""
+        stream = self.stream
+        buf = peek_read_buffer(stream)
+        if not buf:
+            return False
+        parser, max_size = self.parser, self.max_parsed_size()
+        offset = 0
+        self._batching = True
+        try:
+            while self._can_read():
+                try:
+                    frames, end = parser.parse(buf, offset, max_size=max_size,
+                                               max_frames=self.max_pipeline - len(self._requests))
+                except ProtocolError:
+                    break
+                if not frames:
+                    break
+                offset = end
+                for frame in frames:
+                    if stream.closed():
+                        break
+                    self._start_frame()
+                    with stack_context.NullContext():
+                        self.on_frame(frame)
+        finally:
+            self._batching = False
+            consume_read_buffer(stream, offset)
+        return offset > 0
+
+    def _can_read(self):
+        return (self.keep_alive and not self.stream.closed()
+                and len(self._requests) < self.max_pipeline
+                and (not self._flow_control or self._output_drained()))
+
+    def _maybe_read(self):
+        """Starts reading next frame if the pipeline has a room for it."""
+        if not self._reading and not self._batching and self._can_read():
+            self._read_next()
+
+    def _output_drained(self):
+        """Checks if the unflushed output is small enough to read next
+        requests. A connection paused by its own output is resumed when its
+        requests finish or from `_on_write_complete`, when the stream flushes
+        the output (on tornado < 4 all of it), one paused
+        by <max_output_buffer> when other connections flush theirs (see
+        `PServer._resume_readers`)."""
+        server = self.server
+        if self._paused:
+            self._account_output()
+            if self.write_low_water is not None and self._buffered > self.write_low_water:
+                return False
+            self._paused = False
+        elif self.write_high_water is not None and self._buffered > self.write_high_water:
+            self._paused = True
+            logger.debug("pausing reads, %d bytes of output unflushed", self._buffered)
+            return False
+        if (server is not None and server.max_output_buffer is not None
+                and server.buffered_bytes > server.max_output_buffer):
+            self._paused = True
+            server._paused_readers.add(self)
+        return not self._paused
+
+    def unflushed(self):
+        """Returns number of bytes written to the stream but not yet sent."""
+        stream = self.stream
+        if hasattr(stream, "get_write_buffer_size"):    # aio.AsyncioStream
+            return stream.get_write_buffer_size()
+        size = getattr(stream, "_write_buffer_size", None)
+        if size is None:
+            size = sum(len(chunk) for chunk in stream._write_buffer)
+        return size
+
+    def _account_output(self):
+        """Updates size of unflushed output of this connection and the server."""
+        size = self.unflushed()
+        delta, self._buffered = size - self._buffered, size
+        if self.server is not None:
+            self.server.buffered_bytes += delta
+            if delta < 0:
+                self.server._resume_readers()
+
+    def make_request(self, data, **kwargs):
+        """Creates request from the readed frame and dispatches it.
+        <kwargs> are passed to the ReqCls constructor.
+
+        `request_callback` can handle the request asynchronously and return a
+        Future (any object with `add_done_callback`, e.g. a
+        concurrent.futures Future). When it resolves with a value, the value
+        is written as the response, when it resolves with None, the request
+        is finished (unless the handler finished it already). When it fails,
+        the exception is logged and the connection is closed, as the client
+        would otherwise wait for the response (and the responses pipelined
+        after it) forever. Other results than None and Futures (e.g.
+        coroutines which nothing runs) are logged as errors and close the
+        connection too, unless the request is already finished."""
+        self._reading = False
+        pool = None
+        if self.request_pool_size and self.server is not None:
+            pool = self.server._request_pools.get(self.ReqCls)
+        if pool:
+            request = pool.pop()
+            request.__init__(data, connection=self, remote_ip=self.address[0], **kwargs)
+        else:
+            request = self.ReqCls(data, connection=self, remote_ip=self.address[0], **kwargs)
+        self.dispatch(request)
+
+    def dispatch(self, request):
+        """Passes the <request> to `request_callback`. Protocols which
+        continue reading the frame after the request is dispatched (e.g.
+        streamed bodies) call it directly, instead of `make_request`, and
+        reset `_reading` when the frame is read."""
+        self._requests.append(request)
+        self._in_frame = False
+        stats = self._stats
+        if stats is not None:
+            stats.requests += 1
+            stats.bytes_in += len(request.body)
+            if self._frame_start is not None:
+                stats.parse_time.record_time(request._start_time - self._frame_start)
+                self._frame_start = None
+                request._sampled = True
+        if self.request_timeout:
+            request._timeout = self.stream.io_loop.add_timeout(
+                time.time() + self.request_timeout,
+                functools.partial(self._on_request_timeout, request))
         try:
-            self.request_callback(self._request)
+            result = self.request_callback(request)
         except:
-            logger.exception(b"exception was thrown from request_callback({})".format(data))
+            logger.exception(b"exception was thrown from request_callback({})".format(request.body))
+        else:
+            if result is not None:
+                self._watch_result(request, result)
+        # keep parsing frames which are already buffered. Frames decoded by
+        # `parser` are dispatched right away, so only after this one.
+        self._maybe_read()
+
+    def _watch_result(self, request, result):
+        future = to_future(result)
+        if future is None:
+            logger.error("request_callback({}) returned {!r}, neither a Future nor None".format(
+                request.body, result))
+            if not request._finished:
+                self.stream.close()     # it would never be answered
+            return
+        request._retained = True
+        io_loop = self.stream.io_loop
+        # future can be resolved in other thread
+        future.add_done_callback(lambda f: io_loop.add_callback(
+            functools.partial(self._on_result, request, f)))
+
+    def _on_result(self, request, future):
+        try:
+            result = future.result()
+        except Exception:
+            logger.exception("exception was thrown from request_callback({})".format(request.body))
+            if not request._finished:
+                self.stream.close()
+            return
+        if request._finished:
+            return
+        if result is None:
+            request.finish()
+        else:
+            request.write(result)
 
-    def write(self, chunk, callback=None):
-        """Writes a chunk of output to the stream."""
-        assert self._request, "Request closed"
-        logger.debug("writing chunk: '{}'".format(chunk))
-        if not self.stream.closed():
-            self._write_callback = callback and stack_context.wrap(callback)    # TODO
-            self.stream.write(chunk, self._on_write_complete)
+    def _on_request_timeout(self, request):
+        request._timeout = None
+        if not request._finished:
+            logger.warning("request from %s not finished in %s seconds, closing connection",
+                           self.address[0], self.request_timeout)
+            self.stream.close()
 
-    def finish(self, keep_alive=True):
+    def write(self, chunk, callback=None, request=None):
+        """Writes a chunk of output to the stream. <chunk> is a byte string
+        or a list of byte strings, which are written without joining them.
+
+        Responses are written in the request order (unless the connection is
+        not `ordered`). Output of a request which is not the oldest one in
+        the pipeline is buffered until all previous requests finish."""
+        if request is None:
+            assert self.ordered, "connections which aren't ordered need the request"
+            request = self._requests and self._requests[0]
+        assert request, "Request closed"
+        if not self.ordered or request is self._requests[0]:
+            self._write(chunk, callback)
+        else:
+            if request._pending is None:
+                request._pending = []
+            request._pending.append((chunk, callback))
+
+    def _write(self, chunk, callback=None):
+        if not self.stream.closed():
+            if callback is not None:
+                if self._write_callbacks is None:
+                    self._write_callbacks = []
+                self._write_callbacks.append(stack_context.wrap(callback))
+            if isinstance(chunk, list):
+                written = write_chunks(self.stream, chunk, self._on_write_complete)
+                if self._stats is not None:
+                    self._stats.bytes_out += written
+            else:
+                if self._stats is not None:
+                    self._stats.bytes_out += len(chunk)
+                logger.debug("writing %d bytes", len(chunk))
+                self.stream.write(chunk, self._on_write_complete)
+            if self._flow_control and not self.stream.closed():
+                self._account_output()
+
+    def finish(self, keep_alive=True, request=None):
         """Finishes the request."""
-        assert self._request, "can't finish closed request"
-        self._request_finished = True
-        if not self.stream.writing():
-            self._finish_request()
-        # elsewhere _on_write_complete will call _finish_request
-        # the IOLoop should be single threaded, so this is safe
+        if request is None:
+            assert self.ordered, "connections which aren't ordered need the request"
+            request = self._requests and self._requests[0]
+        assert request, "can't finish closed request"
+        if not keep_alive:
+            self.keep_alive = False
+        request._finished = True
+        if request._response_observers is not None:
+            request._notify_response(None)
+        if request._sampled:
+            now = time.time()
+            self._stats.handler_time.record_time(now - request._start_time)
+            if not self.stream.writing():
+                self._stats.flush_time.record(0)
+            elif self._flush_start is None:
+                self._flush_start = now
+        if request._timeout is not None:
+            self.stream.io_loop.remove_timeout(request._timeout)
+            request._timeout = None
+        self._advance(request)
+
+    def _advance(self, request):
+        """Retires finished requests from the head of the pipeline and flushes
+        output buffered by their successors."""
+        requests = self._requests
+        if not self.ordered:
+            if request in requests:     # not if it's finished again
+                requests.remove(request)
+                self._finish_request(request)
+        else:
+            while requests and requests[0]._finished:
+                self._finish_request(requests.pop(0))
+                if requests and requests[0]._pending:
+                    pending, requests[0]._pending = requests[0]._pending, None
+                    for chunk, callback in pending:
+                        self._write(chunk, callback)
+        if not self.keep_alive:
+            if not requests and not self.stream.writing():
+                self.stream.close()
+            # elsewhere _on_write_complete will close the stream
+        else:
+            self._maybe_read()
 
     def _on_write_complete(self):
-        if self._write_callback is not None:
-            callback = self._write_callback
-            self._write_callback = None
-            callback()
+        if self._flush_start is not None:
+            self._stats.flush_time.record_time(time.time() - self._flush_start)
+            self._flush_start = None
+        callbacks, self._write_callbacks = self._write_callbacks, None
+        if callbacks is not None:
+            for callback in callbacks:
+                callback()
         # _on_write_complete is enqueued on the IOLoop whenever the
         # IOStream's write buffer becomes empty, but it's possible for
         # another callback that runs on the IOLoop before it to
-        # simultaneously write more data and finish the request.  If
-        # there is still data in the IOStream, a future
-        # _on_write_complete will be responsible for calling
-        # _finish_request.
-        if self._request_finished and not self.stream.writing():
-            self._finish_request()
-
-    def _finish_request(self):
-        # possibly check if something should disconnect based on protocol function
-        self._request = None
-        self._request_finished = False
-        if self.keep_alive:
-            logger.debug("finishing request")
-            self.read()
-        else:
+        # simultaneously write more data. If there is still data in the
+        # IOStream, a future _on_write_complete will be responsible for
+        # closing the connection.
+        if not self.keep_alive and not self._requests and not self.stream.writing():
             self.stream.close()
+        elif self._flow_control:
+            self._account_output()
+            self._maybe_read()
 
+    def _finish_request(self, request):
+        # possibly check if something should disconnect based on protocol function
+        logger.debug("finishing request")
+        server = self.server
+        if self.request_pool_size and server is not None and not request._retained:
+            # the handler which finished the request can still use it, it's
+            # pooled in the next IOLoop iteration, after the handler returns
+            released = server._released_requests
+            if not released:
+                self.stream.io_loop.add_callback(server._pool_released_requests)
+            released.append((request, self.request_pool_size))
+
+
+
+class _UnorderedRequests(set):
+    """In-flight requests of a connection which isn't `ordered`. Requests
+    finish in any order, so they are removed from a set, not a list."""
+    __slots__ = ()
+    append = set.add
+
+
+def to_future(result):
+    """Returns future-like object (with `add_done_callback`) for the result
+    of request handler, or None if the result isn't a future."""
+    if hasattr(result, "add_done_callback"):
+        return result
+    return None
+
+
+# IOStream sends its buffer in pieces of this size, see `write_chunks`
+WRITE_BUFFER_CHUNK_SIZE = 128 * 1024
+
+
+def write_chunks(stream, chunks, callback=None):
+    """Writes a list of byte strings to the <stream> as a single write.
+
+    All but the last chunk are put directly to the IOStream write buffer, so
+    they are not joined (copied) here, and the stream tries to send all of
+    them at once, instead of issuing a separate send for every chunk.
+    Chunks bigger than WRITE_BUFFER_CHUNK_SIZE are split, like
+    `IOStream.write` does, otherwise the stream would copy the rest of the
+    chunk after every partial send. Returns the number of bytes written."""
+    chunks = [c for c in chunks if c]
+    last = chunks.pop() if chunks else b""
+    written = len(last)
+    logger.debug("writing %d chunks", len(chunks) + 1)
+    if hasattr(stream, "_write_buffer_size"):
+        # stream keeps accounting of the buffer, we can't bypass `write`
+        for chunk in chunks:
+            written += len(chunk)
+            stream.write(chunk)
+    else:
+        buf = stream._write_buffer
+        for chunk in chunks:
+            size = len(chunk)
+            written += size
+            if size > WRITE_BUFFER_CHUNK_SIZE:
+                for i in range(0, size, WRITE_BUFFER_CHUNK_SIZE):
+                    buf.append(chunk[i:i + WRITE_BUFFER_CHUNK_SIZE])
+            else:
+                buf.append(chunk)
+    stream.write(last, callback)
+    return written
+
+
+def unread(stream, data):
+    """Puts <data>, which was read from the <stream>, back at the beginning
+    of its read buffer, so the next `read_*` call gets it again. Streams
+    may implement it as `_unread`; IOStream's buffer is only written if it
+    has one of the layouts this knows about."""
+    if hasattr(stream, "_unread"):
+        stream._unread(data)
+        return
+    buf = getattr(stream, "_read_buffer", None)
+    if not hasattr(stream, "_read_buffer_size"):
+        buf = None
+    if isinstance(buf, collections.deque):
+        buf.appendleft(data)
+    elif isinstance(buf, bytearray):
+        pos = getattr(stream, "_read_buffer_pos", 0)
+        buf[pos:pos] = data
+    else:
+        raise NotImplementedError("can't unread data into %r" % stream)
+    stream._read_buffer_size += len(data)
+
+
+def peek_read_buffer(stream):
+    """Returns data buffered by the <stream> which wasn't read yet, without
+    consuming it. The buffer is joined into a single string, so peeking
+    at it again is cheap."""
+    buf = stream._read_buffer
+    if isinstance(buf, bytearray):
+        return buf
+    if len(buf) > 1:
+        data = b"".join(buf)
+        buf.clear()
+        buf.append(data)
+    return buf[0] if buf else b""
+
+
+def consume_read_buffer(stream, num_bytes):
+    """Removes <num_bytes> from the beginning of the <stream> read buffer."""
+    if not num_bytes:
+        return
+    if hasattr(stream, "_consume"):
+        stream._consume(num_bytes)
+    else:
+        del stream._read_buffer[:num_bytes]
 
 
 class PRequest(object):
@@ -191,6 +908,10 @@ class PRequest(object):
 
        Client's IP address
 
+    .. attribute:: request_id
+
+       Id of the request, for protocols which support it, otherwise None.
+
     .. attribute:: protocol
 
        The protocol used, either "" or "ssl".
@@ -208,8 +929,14 @@ class PRequest(object):
            <data_length>:<data>,
     """
 
+    __slots__ = ("body", "request_id", "remote_ip", "protocol", "connection",
+                 "_start_time", "_finish_time", "_finished", "_pending", "_timeout",
+                 "_cacheable", "_response_observers", "_sampled", "_retained",
+                 "__weakref__")
+
     def __init__(self, body=None, remote_ip=None, protocol=None, connection=None):
         self.body = body or ""
+        self.request_id = None   # set by protocols which multiplex requests
         self.remote_ip = remote_ip
         if protocol:
             self.protocol = protocol
@@ -221,6 +948,13 @@ class PRequest(object):
         self.connection = connection
         self._start_time = time.time()
         self._finish_time = None
+        self._finished = False   # set by connection, when request is finished
+        self._pending = None     # output buffered until previous requests finish
+        self._timeout = None     # handle of request_timeout
+        self._cacheable = None   # (cacheable, ttl) set by handler
+        self._response_observers = None
+        self._sampled = False    # latencies of this request are measured
+        self._retained = False   # referenced after it's finished, can't be reused
 
 
     def write(self, chunk, callback=None):
@@ -232,6 +966,30 @@ class PRequest(object):
         """Finishes this request on the open connection."""
         raise NotImplementedError("read function must be implemented in derived class")
 
+    def set_cacheable(self, cacheable=True, ttl=None):
+        """Marks if the response of this request can be cached by the
+        server's response cache, optionally with a custom <ttl> in seconds."""
+        self._cacheable = (cacheable, ttl)
+
+    def observe_response(self, callback):
+        """Registers <callback>, which will be called with this request and
+        the list of response chunks (without protocol framing), when the
+        response is written. The list is reused afterwards, callback must
+        not keep it. If the request is finished without a response, callback
+        gets None instead of the list, also when the request is abandoned,
+        because its connection was closed, and when the response is streamed
+        (then `response_streamed` is True). Callbacks are called once."""
+        if self._response_observers is None:
+            self._response_observers = []
+        self._response_observers.append(callback)
+
+    def _notify_response(self, chunks):
+        """Should be called by derived classes with the response chunks"""
+        if self._response_observers is not None:
+            observers, self._response_observers = self._response_observers, None
+            for callback in observers:
+                callback(self, chunks)
+
     def request_time(self):
         """Returns the amount of time it took for this request to execute."""
         if self._finish_time is None:
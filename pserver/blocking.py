@@ -0,0 +1,220 @@
+# Copyright 2012 Robert Zaremba
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Blocking (synchronous) clients for NetString and NewLiner servers.
+
+    conn = NetStringConnection("127.0.0.1", 8888)
+    response = conn.request("data")
+    responses = conn.send_many(["a", "b", "c"])   # one send, pipelined
+
+Connections read into a preallocated buffer with `recv_into`. Once the size
+of a frame is known, exactly the missing part of it is received, so frames
+split between TCP segments are handled correctly, and big frames are not
+reassembled from many small strings. Frames are decoded by the parsers of
+`framing`, and `send_many` decodes all responses which arrived together in
+a single pass.
+
+`ConnectionPool` shares connections between threads.
+"""
+
+import contextlib
+import socket
+try:
+    import queue
+except ImportError:     # Python 2
+    import Queue as queue
+
+from .framing import NetStringParser, NewLinerParser
+
+
+class ConnectionClosed(IOError):
+    """Raised when server closes the connection"""
+
+
+class BlockingConnection(object):
+    """Base class of blocking clients. Derived classes implement `frame`,
+    which returns list of chunks of the request frame, and set `parser`
+    (`framing.FrameParser`), which decodes responses."""
+    parser = None
+
+    def __init__(self, host, port, timeout=None, buffer_size=64 * 1024):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buf = bytearray(buffer_size)
+        self._start = 0     # beginning of unparsed data in the buffer
+        self._end = 0       # end of received data
+
+    def frame(self, data):
+        raise NotImplementedError("frame function must be implemented in derived class")
+
+    def _parse(self, max_frames=1):
+        """Returns list of complete frames from the buffer (advancing
+        `_start`). If there is none, sets `_missing` to number of bytes
+        needed to complete the frame, when it's known."""
+        buf, start, end = self._buf, self._start, self._end
+        frames, self._start = self.parser.parse(buf, start, end, max_frames=max_frames)
+        if not frames:
+            size = self.parser.frame_size(buf, start, end)
+            if size is not None:
+                self._missing = size - (end - start)
+        return frames
+
+    def send(self, data):
+        self.sock.sendall(b"".join(self.frame(data)))
+
+    def send_many(self, datas):
+        """Sends all requests with a single syscall, and returns the list of
+        responses."""
+        chunks = []
+        for data in datas:
+            chunks.extend(self.frame(data))
+        self.sock.sendall(b"".join(chunks))
+        return self.recv_many(len(datas))
+
+    def recv(self):
+        return self.recv_many(1)[0]
+
+    def recv_many(self, count):
+        """Returns list of <count> next responses."""
+        responses = []
+        while len(responses) < count:
+            self._missing = None
+            frames = self._parse(count - len(responses))
+            if frames:
+                responses.extend(frames)
+            else:
+                self._fill(self._missing)
+        return responses
+
+    def request(self, data):
+        self.send(data)
+        return self.recv()
+
+    def _fill(self, missing=None):
+        """Receives data to the buffer. With <missing> receives at most that
+        many bytes, making sure they fit in the buffer, otherwise as much as
+        fits in its free space."""
+        buf = self._buf
+        if self._start == self._end:
+            self._start = self._end = 0
+        needed = missing or 1
+        if self._end + needed > len(buf):
+            # compact the buffer, and grow it if the frame doesn't fit. It's
+            # at least doubled, so a frame of unknown size (e.g. a long line)
+            # isn't received in many small pieces.
+            unparsed = self._end - self._start
+            buf[:unparsed] = buf[self._start:self._end]
+            self._start, self._end = 0, unparsed
+            if unparsed + needed > len(buf):
+                buf.extend(bytearray(max(unparsed + needed, 2 * len(buf)) - len(buf)))
+        view = memoryview(buf)[self._end:]
+        num_bytes = self.sock.recv_into(view, missing or len(view))
+        if not num_bytes:
+            raise ConnectionClosed("connection closed by server")
+        self._end += num_bytes
+
+    def close(self):
+        self.sock.close()
+
+
+class NetStringConnection(BlockingConnection):
+    """Blocking NetString client"""
+    parser = NetStringParser()
+
+    def frame(self, data):
+        return [str(len(data)) + ':', data, ',']
+
+    def recv_stream(self):
+        """Yields chunks of a streamed response (see `NetStringReq.stream`),
+        until the empty NetString which ends it."""
+        while True:
+            chunk = self.recv()
+            if not chunk:
+                return
+            yield chunk
+
+
+class NewLinerConnection(BlockingConnection):
+    """Blocking NewLiner client"""
+    parser = NewLinerParser()
+
+    def __init__(self, *args, **kwargs):
+        super(NewLinerConnection, self).__init__(*args, **kwargs)
+        self._scanned = 0   # buffer before this offset has no new line
+
+    def frame(self, data):
+        return [data, '\n']
+
+    def _parse(self, max_frames=1):
+        frames, self._start = self.parser.parse(self._buf, self._start, self._end,
+                                                max_frames=max_frames, scan_from=self._scanned)
+        self._scanned = self._start if frames else self._end
+        return frames
+
+    def _fill(self, missing=None):
+        start = self._start
+        super(NewLinerConnection, self)._fill(missing)
+        self._scanned -= start - self._start    # buffer could be compacted
+
+
+class ConnectionPool(object):
+    """Thread safe pool of at most <size> connections made by
+    <factory()>, e.g. `functools.partial(NetStringConnection, host, port)`::
+
+        with pool.connection() as conn:
+            conn.request("data")
+
+    Connection which raised an exception is closed and replaced by a new one.
+    """
+    def __init__(self, factory, size=8, timeout=None):
+        self.factory = factory
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(size)
+        for _ in range(size):
+            self._pool.put(None)    # placeholders for not yet created connections
+
+    @contextlib.contextmanager
+    def connection(self):
+        try:
+            conn = self._pool.get(timeout=self.timeout)
+        except queue.Empty:
+            raise IOError("no free connection in the pool")
+        try:
+            if conn is None:
+                conn = self.factory()
+            yield conn
+        except BaseException:
+            if conn is not None:
+                conn.close()
+            conn = None
+            raise
+        finally:
+            self._pool.put(conn)
+
+    def request(self, data):
+        with self.connection() as conn:
+            return conn.request(data)
+
+    def send_many(self, datas):
+        with self.connection() as conn:
+            return conn.send_many(datas)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                return
+            if conn is not None:
+                conn.close()
@@ -0,0 +1,121 @@
+# Copyright 2012 Robert Zaremba
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Response cache for idempotent requests.
+
+    cache = ResponseCache(max_bytes=64 * 1024 * 1024, ttl=30)
+    server = PServer(handle_request, NetStringConn, cache=cache)
+
+Handler can exclude a response from caching, or give it a custom TTL::
+
+    def handle_request(request):
+        request.set_cacheable(False)
+        request.write(...)
+"""
+
+import time
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """LRU cache of responses, bounded by the total size of keys and
+    responses (<max_bytes>). Entries expire after <ttl> seconds, unless the
+    handler sets other TTL with `PRequest.set_cacheable`. With
+    <cacheable_default> = False only responses explicitly marked by
+    `set_cacheable` are stored."""
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=60, cacheable_default=True):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.cacheable_default = cacheable_default
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()    # key -> (expires, response), the oldest first
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _entry_size(key, response):
+        return len(key[1]) + len(response)
+
+    def get(self, key):
+        """Returns cached response for <key> or None."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, response = entry
+        if expires < time.time():
+            self.size -= self._entry_size(key, response)
+            self.misses += 1
+            return None
+        self._entries[key] = entry     # mark as recently used
+        self.hits += 1
+        return response
+
+    def set(self, key, response, ttl=None):
+        """Stores the <response>. <key> is a tuple of (protocol, body)."""
+        size = self._entry_size(key, response)
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= self._entry_size(key, old[1])
+        if ttl is None:
+            ttl = self.ttl
+        self._entries[key] = (time.time() + ttl, response)
+        self.size += size
+        while self.size > self.max_bytes:
+            old_key, (_, old_response) = self._entries.popitem(last=False)
+            self.size -= self._entry_size(old_key, old_response)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def snapshot(self):
+        return {"entries": len(self._entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+
+class CachingDispatcher(object):
+    """Answers requests from the <cache>, calls <callback> on cache misses
+    and stores responses written by it."""
+    def __init__(self, callback, cache):
+        self.callback = callback
+        self.cache = cache
+
+    def __call__(self, request):
+        if getattr(request, "streaming", False):
+            return self.callback(request)   # body is not known yet
+        key = (type(request).__name__, request.body)
+        response = self.cache.get(key)
+        if response is not None:
+            request.write(response)
+            return None
+        request.observe_response(lambda request, chunks: self._store(key, request, chunks))
+        return self.callback(request)
+
+    def _store(self, key, request, chunks):
+        if chunks is None:
+            return
+        cacheable, ttl = request._cacheable or (self.cache.cacheable_default, None)
+        if cacheable:
+            self.cache.set(key, chunks[0] if len(chunks) == 1 else b"".join(chunks), ttl)
@@ -1,6 +1,27 @@
 """Basic clients implementation for PServer and its connections"""
 
+import collections
+import functools
+import socket
+import time
+import zlib
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+try:
+    from tornado.concurrent import Future
+except ImportError:
+    from concurrent.futures import Future
+
 from . import logger
+from .base import write_chunks, peek_read_buffer, consume_read_buffer
+from .framing import NetStringParser, LengthPrefixParser, ProtocolError
+from .protocols import (LP_HEADER, LP_REQUEST_ID, FLAG_COMPRESSED,
+                        FLAG_REQUEST_ID, length_prefix_frame)
+
+
+def netstring_frame(data):
+    """Returns list of chunks making the NetString of <data>."""
+    return [str(len(data)) + ':', data, ',']
 
 
 class NetStringClient(object):
@@ -11,8 +32,8 @@ class NetStringClient(object):
         self.stream = stream
 
     def send(self, data):
-        logger.debug('client write: {}'.format(data))
-        self.stream.write("{}:{},".format(len(data),data), self._read_head)
+        logger.debug('client write: %d bytes', len(data))
+        write_chunks(self.stream, netstring_frame(data), self._read_head)
 
     def _read_head(self):
         self.stream.read_until(':', self._read_body)    # head is <number>":"   we need to read
@@ -29,3 +50,402 @@ class NetStringClient(object):
     def receive(self, data):
         pass
 
+
+
+class LengthPrefixClient(object):
+    """Basic LengthPrefix client
+    If you want to use it simply inherit from this class and overwrite receive method.
+    `receive` gets the response body and request id (None if not used).
+    """
+    def __init__(self, stream, compress=False):
+        self.stream = stream
+        self.compress = compress
+
+    def send(self, data, request_id=None):
+        logger.debug('client write: %d bytes', len(data))
+        flags = 0
+        if self.compress:
+            flags |= FLAG_COMPRESSED
+            data = zlib.compress(data)
+        self.stream.write(b"".join(length_prefix_frame(data, flags, request_id)),
+                          self._read_head)
+
+    def _read_head(self):
+        self.stream.read_bytes(LP_HEADER.size, self._read_body)
+
+    def _read_body(self, head):
+        self._flags, num_bytes = LP_HEADER.unpack(head)
+        if self._flags & FLAG_REQUEST_ID:
+            num_bytes += LP_REQUEST_ID.size
+        if num_bytes:
+            self.stream.read_bytes(num_bytes, self._on_body)
+        else:
+            self._on_body(b"")
+
+    def _on_body(self, data):
+        request_id = None
+        if self._flags & FLAG_REQUEST_ID:
+            request_id = LP_REQUEST_ID.unpack_from(data)[0]
+            data = data[LP_REQUEST_ID.size:]
+        if self._flags & FLAG_COMPRESSED:
+            data = zlib.decompress(data)
+        return self.receive(data, request_id)
+
+    def receive(self, data, request_id):
+        pass
+
+
+class RequestTimeout(IOError):
+    """Raised when the response doesn't come in time"""
+
+
+class _Call(object):
+    def __init__(self, data, future):
+        self.data = data
+        self.future = future
+        self.timeout = None
+        self.conn = None        # connection which sent the call
+
+
+class _PooledConnection(object):
+    """A single connection of NetStringPool. Requests are pipelined, and
+    responses are matched with them in FIFO order."""
+    parser = NetStringParser()
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.stream = None
+        self.ready = False
+        self.calls = collections.deque()    # sent calls waiting for response
+        self._reconnect_delay = pool.reconnect_delay
+        self._reconnect_timeout = None
+        self.connect()
+
+    def connect(self):
+        pool = self.pool
+        self.ready = False
+        self._reconnect_timeout = None
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        self.stream = IOStream(sock, pool.io_loop)
+        self.stream.set_close_callback(self._on_close)
+        self.stream.connect((pool.host, pool.port), self._on_connect)
+
+    def _on_connect(self):
+        if self.pool.health_check is None:
+            self._on_healthy()
+            return
+        future = Future()
+        self.send(_Call(self.pool.health_check, future))
+        future.add_done_callback(lambda f: self.pool.io_loop.add_callback(
+            functools.partial(self._on_health_check, f)))
+
+    def _on_health_check(self, future):
+        if future.exception() is None:
+            self._on_healthy()
+        else:
+            logger.warning("health check of %s:%d failed", self.pool.host, self.pool.port)
+            self.stream.close()
+
+    def _on_healthy(self):
+        self.ready = True
+        self._reconnect_delay = self.pool.reconnect_delay
+        self.pool._on_ready(self)
+
+    def send(self, call):
+        call.conn = self
+        self.calls.append(call)
+        write_chunks(self.stream, netstring_frame(call.data))
+        if len(self.calls) == 1:
+            self._read_head()
+
+    def _read_head(self):
+        self.stream.read_until(':', self._read_body)
+
+    def _read_body(self, head):
+        try:
+            num_bytes = int(head[:-1]) + 1
+        except ValueError:
+            logger.error("malformed NetString header from %s:%d", self.pool.host, self.pool.port)
+            self.stream.close()
+            return
+        self.stream.read_bytes(num_bytes, self._on_body)
+
+    def _on_body(self, data):
+        call = self.calls.popleft()
+        self.pool._resolve(call, result=data[:-1])
+        stream = self.stream
+        if self.calls and not stream.closed():
+            # responses which are already buffered are decoded in one pass
+            try:
+                frames, offset = self.parser.parse(peek_read_buffer(stream),
+                                                   max_frames=len(self.calls))
+            except ProtocolError:
+                frames, offset = [], 0      # reported by `_read_body`
+            consume_read_buffer(stream, offset)
+            for frame in frames:
+                self.pool._resolve(self.calls.popleft(), result=frame)
+        if stream is not self.stream or stream.closed():
+            return
+        if self.calls:
+            self._read_head()
+        elif self.ready:
+            self.pool._on_ready(self)
+
+    def on_timeout(self, call):
+        """FIFO matching is broken by a missing response, so the connection
+        is reset, failing all calls sent by it."""
+        self.pool._resolve(call, error=RequestTimeout("request timed out"))
+        self.stream.close()
+
+    def _on_close(self):
+        self.ready = False
+        calls, self.calls = self.calls, collections.deque()
+        error = IOError("connection to {}:{} closed".format(self.pool.host, self.pool.port))
+        for call in calls:
+            self.pool._resolve(call, error=error)
+        if self.pool.closed:
+            return
+        delay = self._reconnect_delay
+        self._reconnect_delay = min(delay * 2, self.pool.max_reconnect_delay)
+        logger.debug("reconnecting to %s:%d in %.2fs", self.pool.host, self.pool.port, delay)
+        self._reconnect_timeout = self.pool.io_loop.add_timeout(time.time() + delay,
+                                                                self.connect)
+
+    def close(self):
+        if self._reconnect_timeout is not None:
+            self.pool.io_loop.remove_timeout(self._reconnect_timeout)
+            self._reconnect_timeout = None
+        self.stream.close()
+
+
+class NetStringPool(object):
+    """Asynchronous NetString client with a pool of <size> connections to
+    a single server.
+
+    Every connection pipelines up to <max_pipeline> requests, so the pool
+    can have size * max_pipeline requests in flight; the other ones wait in
+    the pool queue. `send` returns a Future with the response body::
+
+        pool = NetStringPool("127.0.0.1", 8888, size=4)
+        pool.send("request").add_done_callback(...)
+
+    or, with tornado.gen, which gets the response or the exception::
+
+        response = yield gen.Task(pool.send, "request", timeout=1)
+
+    Requests which don't get the response within <timeout> seconds fail with
+    `RequestTimeout`. Closed connections are reconnected with exponential
+    backoff (from <reconnect_delay> to <max_reconnect_delay> seconds); if
+    <health_check> data is given it's sent on every new connection, and the
+    connection is used only after it gets a response.
+    """
+    def __init__(self, host, port, size=4, max_pipeline=64, timeout=None,
+                 health_check=None, reconnect_delay=0.1, max_reconnect_delay=10,
+                 io_loop=None):
+        self.host = host
+        self.port = port
+        self.max_pipeline = max_pipeline
+        self.timeout = timeout
+        self.health_check = health_check
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.io_loop = io_loop or IOLoop.instance()
+        self.closed = False
+        self._queue = collections.deque()     # calls waiting for a connection
+        self._connections = [_PooledConnection(self) for _ in range(size)]
+
+    def send(self, data, callback=None, timeout=None):
+        """Sends <data> and returns Future of the response.
+        <callback>, if given, is called with the response (or exception)."""
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(lambda f: callback(
+                f.exception() if f.exception() is not None else f.result()))
+        if self.closed:
+            future.set_exception(IOError("pool is closed"))
+            return future
+        call = _Call(data, future)
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is not None:
+            call.timeout = self.io_loop.add_timeout(time.time() + timeout,
+                                                    functools.partial(self._on_timeout, call))
+        conn = self._pick()
+        if conn is None:
+            self._queue.append(call)
+        else:
+            conn.send(call)
+        return future
+
+    def _pick(self):
+        best = None
+        for conn in self._connections:
+            if conn.ready and len(conn.calls) < self.max_pipeline and (
+                    best is None or len(conn.calls) < len(best.calls)):
+                best = conn
+        return best
+
+    def _on_ready(self, conn):
+        """<conn> can take more requests"""
+        queue = self._queue
+        while queue and conn.ready and len(conn.calls) < self.max_pipeline:
+            call = queue.popleft()
+            if not call.future.done():
+                conn.send(call)
+
+    def _on_timeout(self, call):
+        call.timeout = None
+        if call.future.done():
+            return
+        conn = call.conn
+        if conn is None:
+            self._queue.remove(call)
+            self._resolve(call, error=RequestTimeout("request timed out in the pool queue"))
+        else:
+            conn.on_timeout(call)
+
+    def _resolve(self, call, result=None, error=None):
+        if call.timeout is not None:
+            self.io_loop.remove_timeout(call.timeout)
+            call.timeout = None
+        if call.future.done():
+            return
+        if error is not None:
+            call.future.set_exception(error)
+        else:
+            call.future.set_result(result)
+
+    def close(self):
+        """Closes all connections, failing requests in flight, and cancels
+        pending reconnects."""
+        self.closed = True
+        for conn in self._connections:
+            conn.close()
+        queue, self._queue = self._queue, collections.deque()
+        for call in queue:
+            self._resolve(call, error=IOError("pool is closed"))
+
+
+class MuxClient(object):
+    """Asynchronous client of the multiplexed protocol (`protocols.MuxConn`).
+
+    Every request gets a unique id, and responses, which can come in any
+    order, are matched with requests by these ids. A single connection can
+    carry many concurrent requests without head-of-line blocking::
+
+        client = MuxClient("127.0.0.1", 8888)
+        future = client.send("data", timeout=1)
+
+    A request which doesn't get response in <timeout> seconds fails with
+    `RequestTimeout`, without affecting other requests. When the connection
+    is closed all requests in flight fail, and the next `send` reconnects.
+    """
+    parser = LengthPrefixParser()
+
+    def __init__(self, host, port, timeout=None, compress=False, io_loop=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.compress = compress
+        self.io_loop = io_loop or IOLoop.instance()
+        self.stream = None
+        self._calls = {}        # request id -> _Call
+        self._next_id = 0
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        self.stream = IOStream(sock, self.io_loop)
+        self.stream.set_close_callback(self._on_close)
+        # writes are buffered by IOStream until it's connected
+        self.stream.connect((self.host, self.port), self._read_head)
+
+    def send(self, data, callback=None, timeout=None):
+        """Sends <data> and returns Future of the response body.
+        <callback>, if given, is called with the response (or exception)."""
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(lambda f: callback(
+                f.exception() if f.exception() is not None else f.result()))
+        if self.stream is None or self.stream.closed():
+            self._connect()
+        request_id = self._next_id
+        self._next_id = (self._next_id + 1) & 0xffffffff
+        call = self._calls[request_id] = _Call(data, future)
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is not None:
+            call.timeout = self.io_loop.add_timeout(
+                time.time() + timeout, functools.partial(self._on_timeout, request_id))
+        flags = 0
+        if self.compress:
+            flags = FLAG_COMPRESSED
+            data = zlib.compress(data)
+        write_chunks(self.stream, length_prefix_frame(data, flags, request_id))
+        return future
+
+    def _read_head(self):
+        self.stream.read_bytes(LP_HEADER.size, self._read_body)
+
+    def _read_body(self, head):
+        self._flags, num_bytes = LP_HEADER.unpack(head)
+        if self._flags & FLAG_REQUEST_ID:
+            num_bytes += LP_REQUEST_ID.size
+        if num_bytes:
+            self.stream.read_bytes(num_bytes, self._on_body)
+        else:
+            self._on_body(b"")
+
+    def _on_body(self, data):
+        request_id = None
+        if self._flags & FLAG_REQUEST_ID:
+            request_id = LP_REQUEST_ID.unpack_from(data)[0]
+            data = data[LP_REQUEST_ID.size:]
+        if not self._on_response((self._flags, request_id, data)):
+            return
+        # responses which are already buffered are decoded in one pass
+        stream = self.stream
+        frames, offset = self.parser.parse(peek_read_buffer(stream))
+        consume_read_buffer(stream, offset)
+        for frame in frames:
+            if stream.closed() or not self._on_response(frame):
+                return
+        if stream is self.stream and not stream.closed():
+            self._read_head()
+
+    def _on_response(self, frame):
+        flags, request_id, data = frame
+        if request_id is None:
+            logger.error("response without request id from %s:%d", self.host, self.port)
+            self.stream.close()
+            return False
+        call = self._calls.pop(request_id, None)
+        if call is not None:
+            if flags & FLAG_COMPRESSED:
+                data = zlib.decompress(data)
+            self._resolve(call, result=data)
+        return True
+
+    def _on_timeout(self, request_id):
+        call = self._calls.pop(request_id, None)
+        if call is not None:
+            call.timeout = None
+            self._resolve(call, error=RequestTimeout("request timed out"))
+
+    def _on_close(self):
+        calls, self._calls = self._calls, {}
+        error = IOError("connection to {}:{} closed".format(self.host, self.port))
+        for call in calls.values():
+            self._resolve(call, error=error)
+
+    def _resolve(self, call, result=None, error=None):
+        if call.timeout is not None:
+            self.io_loop.remove_timeout(call.timeout)
+            call.timeout = None
+        if error is not None:
+            call.future.set_exception(error)
+        else:
+            call.future.set_result(result)
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
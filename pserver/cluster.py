@@ -0,0 +1,276 @@
+# Copyright 2012 Robert Zaremba
+# based on the original Tornado by Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Multi-process (prefork) mode for PServer.
+
+`PServerCluster` forks a number of worker processes, each of them running
+its own IOLoop with the same `PServer`. The parent process only supervises
+workers: it restarts the crashed ones and shuts all of them down gracefully
+on SIGTERM / SIGINT::
+
+    from pserver import PServer, NetStringConn
+    from pserver.cluster import PServerCluster
+
+    server = PServer(handle_request, NetStringConn)
+    PServerCluster(server, 8888, num_workers=4).run()
+
+On systems supporting SO_REUSEPORT every worker binds its own listening
+socket, and the kernel balances new connections between workers. Otherwise
+sockets are bound in the parent and shared by all workers.
+"""
+
+import errno
+import os
+import signal
+import socket
+import sys
+import time
+
+from tornado.ioloop import IOLoop
+from tornado import netutil
+
+from . import logger
+
+
+def bind_sockets(port, address=None, family=socket.AF_UNSPEC, backlog=128,
+                 reuse_port=False):
+    """Like `tornado.netutil.bind_sockets`, but optionally sets SO_REUSEPORT
+    on the sockets, so that many processes can bind the same port."""
+    if reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+        raise ValueError("SO_REUSEPORT is not supported on this platform")
+    sockets = []
+    if address == "":
+        address = None
+    flags = socket.AI_PASSIVE
+    if hasattr(socket, "AI_ADDRCONFIG"):
+        flags |= socket.AI_ADDRCONFIG
+    for res in set(socket.getaddrinfo(address, port, family, socket.SOCK_STREAM,
+                                      0, flags)):
+        af, socktype, proto, canonname, sockaddr = res
+        sock = socket.socket(af, socktype, proto)
+        netutil.set_close_exec(sock.fileno())
+        if os.name != 'nt':
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if af == socket.AF_INET6 and hasattr(socket, "IPPROTO_IPV6"):
+            # On linux, ipv6 sockets accept ipv4 too by default, which makes
+            # binding the same port for ipv4 fail.
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        sock.bind(sockaddr)
+        sock.listen(backlog)
+        sockets.append(sock)
+    return sockets
+
+
+class PServerCluster(object):
+    """Runs <server> in <num_workers> forked processes.
+
+    <num_workers> defaults to the number of CPUs. With <reuse_port> (the
+    default, when supported by the platform) each worker binds its own
+    socket with SO_REUSEPORT, otherwise listening sockets are bound before
+    forking and shared.
+
+    A worker which dies (by a signal or with non zero exit status) is
+    restarted. Restarts of a worker which keeps crashing are delayed,
+    starting with <restart_delay> seconds and doubling up to
+    <max_restart_delay>; crashes are counted in a row, the count is reset
+    once the worker runs for <max_restart_delay> seconds. When a worker
+    crashes more than <max_restarts> times in a row all workers are shut
+    down and the supervisor exits with status 1.
+
+    On SIGTERM or SIGINT workers are asked to `PServer.drain` and are killed
+    if they don't exit within <shutdown_timeout> seconds.
+
+    The server must not have an IOLoop assigned, each worker uses its own
+    `IOLoop.instance()`.
+    """
+    def __init__(self, server, port, address=None, num_workers=None,
+                 reuse_port=None, max_restarts=100, shutdown_timeout=10,
+                 restart_delay=0.1, max_restart_delay=10):
+        self.server = server
+        self.port = port
+        self.address = address
+        if num_workers is None or num_workers <= 0:
+            num_workers = cpu_count()
+        self.num_workers = num_workers
+        if reuse_port is None:
+            reuse_port = hasattr(socket, "SO_REUSEPORT")
+        self.reuse_port = reuse_port
+        self.max_restarts = max_restarts
+        self.shutdown_timeout = shutdown_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.worker_id = None       # set in the worker process
+        self._workers = {}          # pid -> worker_id
+        self._started = {}          # worker_id -> time of the last start
+        self._crashes = {}          # worker_id -> number of crashes in a row
+        self._restarts = {}         # worker_id -> time of the delayed restart
+        self._sockets = None
+        self._shutting_down = False
+        self._exit_status = 0
+
+    def run(self):
+        """Forks workers and supervises them. This function doesn't return,
+        neither in the parent, nor in workers."""
+        assert self.server.io_loop is None, "cluster workers need fresh IOLoops"
+        if not self.reuse_port:
+            self._sockets = bind_sockets(self.port, self.address)
+        logger.info("Starting %d PServer workers", self.num_workers)
+        for worker_id in range(self.num_workers):
+            self._spawn(worker_id)
+        signal.signal(signal.SIGTERM, self._on_shutdown_signal)
+        signal.signal(signal.SIGINT, self._on_shutdown_signal)
+        signal.signal(signal.SIGALRM, self._on_alarm)
+        self._supervise()
+
+    def _spawn(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker(worker_id)   # doesn't return
+        self._workers[pid] = worker_id
+        self._started[worker_id] = time.time()
+
+    def _supervise(self):
+        while self._workers or self._restarts:
+            self._restart_due()
+            if not self._workers:
+                if self._restarts:      # all workers wait for their restarts
+                    time.sleep(max(min(self._restarts.values()) - time.time(), 0))
+                continue
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            worker_id = self._workers.pop(pid, None)
+            if worker_id is None:
+                continue
+            if os.WIFSIGNALED(status):
+                logger.warning("worker %d (pid %d) killed by signal %d",
+                               worker_id, pid, os.WTERMSIG(status))
+            elif os.WEXITSTATUS(status) != 0:
+                logger.warning("worker %d (pid %d) exited with status %d",
+                               worker_id, pid, os.WEXITSTATUS(status))
+            else:
+                logger.info("worker %d (pid %d) exited normally", worker_id, pid)
+                continue
+            if self._shutting_down:
+                continue
+            crashes = self._count_crash(worker_id)
+            if crashes > self.max_restarts:
+                logger.error("worker %d crashed %d times in a row, shutting down",
+                             worker_id, crashes)
+                self._exit_status = 1
+                self._shutdown()
+                continue
+            self._schedule_restart(worker_id, crashes)
+        logger.info("all PServer workers finished")
+        sys.exit(self._exit_status)
+
+    def _count_crash(self, worker_id):
+        """Returns the number of crashes of the worker in a row."""
+        if time.time() - self._started[worker_id] >= self.max_restart_delay:
+            self._crashes[worker_id] = 0
+        crashes = self._crashes[worker_id] = self._crashes.get(worker_id, 0) + 1
+        return crashes
+
+    def _schedule_restart(self, worker_id, crashes):
+        delay = min(self.restart_delay * 2 ** (crashes - 1), self.max_restart_delay)
+        logger.info("restarting worker %d in %.2f seconds", worker_id, delay)
+        self._restarts[worker_id] = time.time() + delay
+        self._set_restart_alarm()
+
+    def _restart_due(self):
+        now = time.time()
+        for worker_id, due in list(self._restarts.items()):
+            if due <= now:
+                del self._restarts[worker_id]
+                self._spawn(worker_id)
+        self._set_restart_alarm()
+
+    def _set_restart_alarm(self):
+        if self._restarts:
+            delay = max(min(self._restarts.values()) - time.time(), 0.001)
+            signal.setitimer(signal.ITIMER_REAL, delay)
+
+    def _on_shutdown_signal(self, signum, frame):
+        self._shutdown()
+
+    def _shutdown(self):
+        if self._shutting_down:
+            return
+        self._shutting_down = True
+        self._restarts.clear()
+        logger.info("shutting down %d PServer workers", len(self._workers))
+        self._signal_workers(signal.SIGTERM)
+        signal.alarm(int(self.shutdown_timeout) + 1)
+
+    def _on_alarm(self, signum, frame):
+        # the alarm interrupts `os.wait` for delayed restarts, otherwise it
+        # marks the end of the shutdown timeout
+        if not self._shutting_down:
+            return
+        logger.warning("killing %d workers which didn't stop in time",
+                       len(self._workers))
+        self._signal_workers(signal.SIGKILL)
+
+    def _signal_workers(self, signum):
+        for pid in list(self._workers):
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _run_worker(self, worker_id):
+        self.worker_id = worker_id
+        self._workers = {}
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)   # the parent coordinates shutdown
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        status = 0
+        try:
+            sockets = self._sockets
+            if sockets is None:
+                sockets = bind_sockets(self.port, self.address, reuse_port=True)
+            io_loop = IOLoop.instance()
+            self.server.add_sockets(sockets)
+            signal.signal(signal.SIGTERM, lambda signum, frame: io_loop.add_callback(
+                lambda: self.server.drain(io_loop.stop, self.shutdown_timeout)))
+            logger.debug("worker %d (pid %d) started", worker_id, os.getpid())
+            io_loop.start()
+        except Exception:
+            logger.exception("worker %d failed", worker_id)
+            status = 1
+        os._exit(status)
+
+
+def cpu_count():
+    """Returns the number of processors on this machine."""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        pass
+    try:
+        return os.sysconf("SC_NPROCESSORS_CONF")
+    except ValueError:
+        pass
+    return 1
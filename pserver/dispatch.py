@@ -0,0 +1,358 @@
+# Copyright 2012 Robert Zaremba
+# based on the original Tornado by Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Request dispatchers.
+
+A dispatcher is a callable which takes a request, exactly like the
+`request_callback` of `PServer`, and which stands between connections and
+the user's handler. `PServer` builds them from its constructor arguments.
+"""
+
+import collections
+import functools
+import heapq
+import time
+from tornado.ioloop import IOLoop
+
+from . import logger
+
+
+class RequestBatcher(object):
+    """Collects requests from all connections of the server and passes them
+    to <batch_callback> as a list. A batch is dispatched when it reaches
+    <max_size> requests, or <max_delay> seconds after its first request.
+    With <max_delay> = 0 batch contains requests which arrived in the same
+    IOLoop iteration.
+
+    Every request in a batch is answered individually, by its own `write`::
+
+        def batch_handler(requests):
+            values = redis.mget([r.body for r in requests])
+            for request, value in zip(requests, values):
+                request.write(value)
+    """
+    def __init__(self, batch_callback, max_size=100, max_delay=0, io_loop=None):
+        self.batch_callback = batch_callback
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.io_loop = io_loop
+        self._batch = []
+        self._timeout = None    # None, timeout handle or True for scheduled callback
+
+    def __call__(self, request):
+        self._batch.append(request)
+        if len(self._batch) >= self.max_size:
+            self.flush()
+        elif self._timeout is None:
+            io_loop = self.io_loop or IOLoop.instance()
+            if self.max_delay:
+                self._timeout = io_loop.add_timeout(time.time() + self.max_delay,
+                                                    self.flush)
+            else:
+                self._timeout = True
+                io_loop.add_callback(self.flush)
+
+    def flush(self):
+        """Dispatches collected requests."""
+        if self._timeout is not None and self._timeout is not True:
+            (self.io_loop or IOLoop.instance()).remove_timeout(self._timeout)
+        self._timeout = None
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        try:
+            self.batch_callback(batch)
+        except:
+            logger.exception("exception was thrown from batch_callback(<%d requests>)",
+                             len(batch))
+
+
+class ExecutorDispatcher(object):
+    """Runs <function> in the <executor> (e.g. `concurrent.futures`
+    ThreadPoolExecutor or ProcessPoolExecutor), so CPU bound work doesn't
+    block the IOLoop. <function> takes the request body and returns the
+    response, which is written back with `request.write` on the IOLoop
+    thread. With ProcessPoolExecutor <function> must be picklable.
+
+    At most <max_pending> requests are submitted to the executor at once
+    (by default the number of executor workers), others wait in a queue of
+    at most <max_queue> requests. When the queue is full, new requests are
+    answered right away with the protocol's busy response
+    (`PConnection.busy_response`) and counted in `rejected`.
+    `queue_depth` is the number of requests waiting or being processed.
+    """
+    def __init__(self, function, executor, max_pending=None, io_loop=None,
+                 max_queue=1024):
+        self.function = function
+        self.executor = executor
+        if max_pending is None:
+            max_pending = getattr(executor, "_max_workers", 1)
+        self.max_pending = max_pending
+        self.max_queue = max_queue
+        self.io_loop = io_loop
+        self._queue = collections.deque()
+        self._pending = 0
+        self.rejected = 0
+
+    @property
+    def queue_depth(self):
+        return len(self._queue) + self._pending
+
+    def __call__(self, request):
+        if len(self._queue) >= self.max_queue:
+            self.rejected += 1
+            request.set_cacheable(False)
+            request.write(request.connection.busy_response)
+            return
+        request._retained = True
+        self._queue.append(request)
+        self._submit()
+
+    def _submit(self):
+        io_loop = self.io_loop or IOLoop.instance()
+        while self._queue and self._pending < self.max_pending:
+            request = self._queue.popleft()
+            if request.connection.stream.closed():
+                continue
+            self._pending += 1
+            future = self.executor.submit(self.function, request.body)
+            future.add_done_callback(lambda f, request=request: io_loop.add_callback(
+                functools.partial(self._on_done, request, f)))
+
+    def _on_done(self, request, future):
+        self._pending -= 1
+        request.connection._on_result(request, future)
+        self._submit()
+
+
+class CoalescingDispatcher(object):
+    """Coalesces concurrent requests with the same key (single-flight).
+
+    The first request with a given key (the leader) is passed to
+    <callback>, requests with the same key which arrive before it's
+    answered wait for its response, which is then written to all of them.
+    By default the key is the protocol and the request body, <key(request)>
+    can supply other one; requests for which it returns None (by default
+    requests with streamed bodies) are not coalesced.
+
+    If the handler of the leader raises, or the leader is abandoned (its
+    connection is closed), the first waiting request becomes the leader and
+    is passed to <callback> in turn. Streamed responses are not shared:
+    when the leader starts streaming, the waiting requests are passed to
+    <callback> each.
+    """
+    def __init__(self, callback, key=None):
+        self.callback = callback
+        self.key = key or self._default_key
+        self.coalesced = 0      # number of requests answered with other's response
+        self._flights = {}      # key -> [leader, requests waiting for its response]
+
+    @staticmethod
+    def _default_key(request):
+        if getattr(request, "streaming", False):
+            return None     # body is not known yet
+        return (type(request).__name__, request.body)
+
+    def __call__(self, request):
+        key = self.key(request)
+        if key is None:
+            return self.callback(request)
+        request._retained = True
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.append(request)
+            return None
+        self._flights[key] = [request]
+        return self._lead(key, request)
+
+    def _lead(self, key, request):
+        request.observe_response(lambda request, chunks: self._on_response(key, request, chunks))
+        try:
+            return self.callback(request)
+        except Exception:
+            self._hand_over(key, request)
+            raise
+
+    def _on_response(self, key, request, chunks):
+        flight = self._flights.get(key)
+        if flight is None or flight[0] is not request:
+            return      # other request leads already
+        if chunks is None and getattr(request, "response_streamed", False):
+            del self._flights[key]
+            request.connection.stream.io_loop.add_callback(
+                functools.partial(self._redispatch, flight[1:]))
+            return
+        if chunks is None and not request._finished:
+            self._hand_over(key, request)
+            return
+        del self._flights[key]
+        waiting = flight[1:]
+        if chunks is None:
+            for request in waiting:
+                request.finish()
+            return
+        self.coalesced += len(waiting)
+        response = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+        for request in waiting:
+            try:
+                request.write(response)
+            except Exception:
+                logger.exception("can't write coalesced response to %s", request.remote_ip)
+
+    def _hand_over(self, key, request):
+        """The leader <request> won't be answered, one of the waiting
+        requests will lead instead. It's done in the next IOLoop iteration,
+        so a handler which keeps failing doesn't recurse."""
+        flight = self._flights.get(key)
+        if flight is None or flight[0] is not request:
+            return
+        flight[0] = None    # requests with this key keep waiting for the next leader
+        request.connection.stream.io_loop.add_callback(functools.partial(self._promote, key))
+
+    def _promote(self, key):
+        flight = self._flights[key]
+        while len(flight) > 1:
+            request = flight.pop(1)
+            if not request.connection.stream.closed():
+                break
+        else:
+            del self._flights[key]
+            return
+        flight[0] = request
+        self._run(request, functools.partial(self._lead, key))
+
+    def _redispatch(self, requests):
+        for request in requests:
+            if not request.connection.stream.closed():
+                self._run(request, self.callback)
+
+    @staticmethod
+    def _run(request, callback):
+        try:
+            result = callback(request)
+        except Exception:
+            logger.exception("exception was thrown from request_callback({})".format(request.body))
+        else:
+            if result is not None:
+                request.connection._watch_result(request, result)
+
+
+def classify_by_ip(classes, default=None):
+    """Returns a classifier for `FairScheduler`, which assigns requests to
+    priority classes by their `remote_ip`, using the <classes> dict (IP ->
+    class). Requests from other addresses get the <default> class."""
+    return lambda request: classes.get(request.remote_ip, default)
+
+
+class _ConnQueue(object):
+    __slots__ = ("requests", "finish")
+
+    def __init__(self):
+        self.requests = collections.deque()
+        self.finish = 0.0   # virtual finish time of the last scheduled request
+
+
+class FairScheduler(object):
+    """Dispatches requests to <callback> fairly across connections.
+
+    Requests are queued per connection and dispatched in IOLoop callbacks,
+    at most <budget> requests per callback, so a client which sends a burst
+    of frames doesn't hold the IOLoop and the handler while other
+    connections wait. Queues are served by weighted fair queuing
+    (self-clocked): a request of a connection is scheduled after
+    1 / weight of virtual time since the previous one, and the request
+    with the earliest virtual finish time is dispatched first. With equal
+    weights connections are served round-robin.
+
+    <classify(request)> assigns requests to priority classes (e.g.
+    `classify_by_ip`), and <weights> maps classes to their weights (1 by
+    default), so connections of a class with weight 4 get 4 times more
+    dispatches than those of weight 1, while both have queued requests.
+    """
+    def __init__(self, callback, classify=None, weights=None, budget=64, io_loop=None):
+        self.callback = callback
+        self.classify = classify
+        self.weights = weights or {}
+        self.budget = budget
+        self.io_loop = io_loop
+        self.dispatched = 0
+        self.deferred = 0       # number of callbacks which used up the budget
+        self._queues = {}       # connection -> _ConnQueue with queued requests
+        self._heap = []         # (finish, seq, connection) of the head of every queue
+        self._seq = 0
+        self._vtime = 0.0
+        self._scheduled = False
+
+    @property
+    def queue_depth(self):
+        return sum(len(queue.requests) for queue in self._queues.values())
+
+    def __call__(self, request):
+        conn = request.connection
+        queue = self._queues.get(conn)
+        if queue is None:
+            queue = self._queues[conn] = _ConnQueue()
+        queue.requests.append(request)
+        if len(queue.requests) == 1:
+            self._push(conn, queue, max(self._vtime, queue.finish))
+        if not self._scheduled:
+            self._scheduled = True
+            (self.io_loop or IOLoop.instance()).add_callback(self._dispatch)
+
+    def _weight(self, request):
+        if self.classify is None:
+            return 1
+        return self.weights.get(self.classify(request), 1)
+
+    def _push(self, conn, queue, start):
+        queue.finish = start + 1.0 / self._weight(queue.requests[0])
+        self._seq += 1
+        heapq.heappush(self._heap, (queue.finish, self._seq, conn))
+
+    def _dispatch(self):
+        self._scheduled = False
+        heap = self._heap
+        budget = self.budget
+        while heap and budget > 0:
+            finish, _, conn = heapq.heappop(heap)
+            self._vtime = finish
+            queue = self._queues[conn]
+            request = queue.requests.popleft()
+            if queue.requests:
+                self._push(conn, queue, finish)
+            else:
+                del self._queues[conn]
+            if conn.stream.closed():
+                continue
+            budget -= 1
+            self.dispatched += 1
+            try:
+                result = self.callback(request)
+            except:
+                logger.exception("exception was thrown from request_callback({})".format(
+                    request.body))
+            else:
+                if result is not None:
+                    conn._watch_result(request, result)
+        if heap and not self._scheduled:
+            # let the IOLoop handle other events before the rest
+            self.deferred += 1
+            self._scheduled = True
+            (self.io_loop or IOLoop.instance()).add_callback(self._dispatch)
+
+    def snapshot(self):
+        return {"queue_depth": self.queue_depth,
+                "dispatched": self.dispatched,
+                "deferred": self.deferred}
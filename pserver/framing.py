@@ -0,0 +1,175 @@
+# Copyright 2012 Robert Zaremba
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Sans-IO frame parsers.
+
+Parsers don't do any I/O, they decode frames from a buffer filled by the
+caller. `parse` scans the buffer in a single pass and returns the list of
+all complete frames, and the offset just after the last of them::
+
+    frames, offset = NetStringParser().parse(buf)
+    del buf[:offset]
+
+The buffer is anything with `find` and slicing: bytes or bytearray. Parsers
+keep no state between calls, so one parser can be shared by many
+connections. A new framing is a subclass of `FrameParser`.
+"""
+
+import struct
+
+
+class ProtocolError(ValueError):
+    """Raised on malformed frame"""
+
+
+class FrameParser(object):
+    def parse(self, buf, start=0, end=None, max_frames=None, max_size=None):
+        """Returns a tuple (frames, offset) of complete frames in
+        <buf>[<start>:<end>] and the offset where the unparsed data begins.
+
+        Parsing stops after <max_frames> frames, and before a frame with a
+        body longer than <max_size> bytes. Such frame isn't an error: the
+        caller can read it in some other way (e.g. stream it). Raises
+        ProtocolError on malformed data, frames before it are lost."""
+        raise NotImplementedError("parse function must be implemented in derived class")
+
+    def frame_size(self, buf, start=0, end=None):
+        """Returns the size of the frame at <start> if it's known from the
+        available data (e.g. the header is complete), otherwise None."""
+        return None
+
+
+def _bytes(data):
+    return data if type(data) is bytes else bytes(data)
+
+
+class NetStringParser(FrameParser):
+    """NetString (http://cr.yp.to/proto/netstrings.txt) frames. Frames are
+    the bodies, as byte strings."""
+    def __init__(self, max_header_size=20):
+        self.max_header_size = max_header_size    # digits of the length
+
+    def _header(self, buf, start, end):
+        """Returns (colon offset, body length), or None if the header is
+        incomplete."""
+        colon = buf.find(b':', start, end)
+        if colon == -1:
+            if end - start > self.max_header_size:
+                raise ProtocolError("NetString header too long")
+            return None
+        if colon - start > self.max_header_size:
+            raise ProtocolError("NetString header too long")
+        try:
+            length = int(_bytes(buf[start:colon]))
+        except ValueError:
+            raise ProtocolError("malformed NetString header")
+        if length < 0:
+            raise ProtocolError("negative NetString length")
+        return colon, length
+
+    def parse(self, buf, start=0, end=None, max_frames=None, max_size=None):
+        if end is None:
+            end = len(buf)
+        frames = []
+        while start < end and (max_frames is None or len(frames) < max_frames):
+            header = self._header(buf, start, end)
+            if header is None:
+                break
+            colon, length = header
+            if max_size is not None and length > max_size:
+                break
+            frame_end = colon + length + 2
+            if frame_end > end:
+                break
+            if buf[frame_end - 1:frame_end] != b',':
+                raise ProtocolError("NetString doesn't end with ','")
+            frames.append(_bytes(buf[colon + 1:frame_end - 1]))
+            start = frame_end
+        return frames, start
+
+    def frame_size(self, buf, start=0, end=None):
+        if end is None:
+            end = len(buf)
+        header = self._header(buf, start, end)
+        if header is None:
+            return None
+        colon, length = header
+        return colon + length + 2 - start
+
+
+class NewLinerParser(FrameParser):
+    """Frames ended with <delimiter>. Frames are lines without it."""
+    def __init__(self, delimiter=b'\n'):
+        self.delimiter = delimiter
+
+    def parse(self, buf, start=0, end=None, max_frames=None, max_size=None, scan_from=None):
+        """See `FrameParser.parse`. <scan_from> is the offset up to which the
+        caller already scanned the buffer without finding the delimiter, so
+        long lines received in many parts are not scanned again."""
+        if end is None:
+            end = len(buf)
+        delimiter, size = self.delimiter, len(self.delimiter)
+        frames = []
+        pos = start if scan_from is None else max(start, scan_from - size + 1)
+        while max_frames is None or len(frames) < max_frames:
+            eol = buf.find(delimiter, pos, end)
+            if eol == -1 or (max_size is not None and eol - start > max_size):
+                break
+            frames.append(_bytes(buf[start:eol]))
+            start = pos = eol + size
+        return frames, start
+
+
+# <flags: 1 byte><length: 4 bytes, big-endian>[<request_id: 4 bytes>]<body>
+LP_HEADER = struct.Struct("!BI")
+LP_REQUEST_ID = struct.Struct("!I")
+FLAG_COMPRESSED = 0x01    # body is compressed with zlib
+FLAG_REQUEST_ID = 0x02    # request_id follows the header (not counted in length)
+
+
+class LengthPrefixParser(FrameParser):
+    """LengthPrefix frames (see `protocols.LengthPrefixConn`). Frames are
+    tuples (flags, request_id, body), request_id is None if the frame
+    doesn't have it. Compressed bodies are returned as they are."""
+    def parse(self, buf, start=0, end=None, max_frames=None, max_size=None):
+        if end is None:
+            end = len(buf)
+        header_size, id_size = LP_HEADER.size, LP_REQUEST_ID.size
+        frames = []
+        while end - start >= header_size and (max_frames is None or len(frames) < max_frames):
+            flags, length = LP_HEADER.unpack_from(buf, start)
+            if max_size is not None and length > max_size:
+                break
+            body_start = start + header_size
+            request_id = None
+            if flags & FLAG_REQUEST_ID:
+                if end - body_start < id_size:
+                    break
+                request_id = LP_REQUEST_ID.unpack_from(buf, body_start)[0]
+                body_start += id_size
+            if end - body_start < length:
+                break
+            start = body_start + length
+            frames.append((flags, request_id, _bytes(buf[body_start:start])))
+        return frames, start
+
+    def frame_size(self, buf, start=0, end=None):
+        if end is None:
+            end = len(buf)
+        if end - start < LP_HEADER.size:
+            return None
+        flags, length = LP_HEADER.unpack_from(buf, start)
+        if flags & FLAG_REQUEST_ID:
+            length += LP_REQUEST_ID.size
+        return LP_HEADER.size + length
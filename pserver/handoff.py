@@ -0,0 +1,203 @@
+# Copyright 2012 Robert Zaremba
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Zero-downtime restart of PServer.
+
+The running process starts its successor, which inherits the listening
+sockets (their file descriptors are passed in the PSERVER_LISTEN_FDS
+environment variable), so the listening port is never closed. When the
+successor reports that it's accepting connections, the old process drains:
+it stops accepting, finishes in-flight requests and closes keep-alive
+connections on request boundaries::
+
+    server = PServer(handle_request, NetStringConn)
+    handoff.listen(server, 8888)          # inherited sockets or a new bind
+    handoff.restart_on_signal(server)     # SIGHUP starts the successor
+    IOLoop.instance().start()
+
+If the successor exits or doesn't become ready within <ready_timeout>
+seconds, the restart is aborted and the old process keeps serving.
+"""
+
+import errno
+import fcntl
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from tornado.ioloop import IOLoop
+
+from . import logger
+from .cluster import bind_sockets
+
+LISTEN_FDS = "PSERVER_LISTEN_FDS"   # <fd>:<family>,... of inherited sockets
+READY_FD = "PSERVER_READY_FD"       # pipe to notify the previous process
+
+
+def inherited_sockets():
+    """Returns the listening sockets inherited from the previous process
+    (an empty list if there are none). Consumes the environment variable,
+    so the sockets aren't passed on to unrelated child processes."""
+    value = os.environ.pop(LISTEN_FDS, "")
+    sockets = []
+    for item in filter(None, value.split(",")):
+        fd, family = [int(x) for x in item.split(":")]
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        os.close(fd)    # fromfd duplicates the descriptor
+        _set_close_exec(sock.fileno(), True)
+        sock.setblocking(0)
+        sockets.append(sock)
+    return sockets
+
+
+def notify_ready():
+    """Tells the previous process that this one accepts connections, so it
+    can drain. Does nothing if the process wasn't started by `restart`."""
+    fd = os.environ.pop(READY_FD, None)
+    if fd is not None:
+        try:
+            os.write(int(fd), b"1")
+        finally:
+            os.close(int(fd))
+
+
+def listen(server, port, address=None):
+    """Makes <server> accept connections on the inherited sockets, or on
+    new ones bound to <port> and <address>, and notifies the previous
+    process, if any."""
+    sockets = inherited_sockets()
+    if sockets:
+        logger.info("inherited %d listening sockets", len(sockets))
+    else:
+        sockets = bind_sockets(port, address)
+    server.add_sockets(sockets)
+    notify_ready()
+
+
+def spawn_successor(sockets, args=None, env=None):
+    """Starts <args> (by default the command line of this process) as a new
+    process which inherits listening <sockets>. Returns a tuple of the
+    `subprocess.Popen` object and the read end of the readiness pipe."""
+    if args is None:
+        args = [sys.executable] + sys.argv
+    ready_r, ready_w = os.pipe()
+    _set_close_exec(ready_r, True)
+    fds = [sock.fileno() for sock in sockets]
+    env = dict(os.environ if env is None else env)
+    env[LISTEN_FDS] = ",".join("%d:%d" % (sock.fileno(), sock.family) for sock in sockets)
+    env[READY_FD] = str(ready_w)
+
+    def inherit_fds():
+        # only listening sockets, connections stay with this process
+        keep = set(fds + [ready_w])
+        for fd in _open_fds():
+            if fd > 2:
+                try:
+                    _set_close_exec(fd, fd not in keep)
+                except (IOError, OSError):
+                    pass
+    try:
+        process = subprocess.Popen(args, env=env, close_fds=False, preexec_fn=inherit_fds)
+    except:
+        os.close(ready_r)
+        raise
+    finally:
+        os.close(ready_w)
+    return process, ready_r
+
+
+def restart(server, args=None, drain_timeout=None, ready_timeout=10, callback=None):
+    """Starts the successor of <server>'s process (see `spawn_successor`),
+    and drains <server> when the successor is ready. <callback> is called
+    with True when the server is drained, or with False if the successor
+    failed and the server keeps serving."""
+    io_loop = server.io_loop or IOLoop.instance()
+    process, ready_fd = spawn_successor(list(server._sockets.values()), args)
+    logger.info("started successor process %d", process.pid)
+    state = {}
+
+    def done(ready):
+        io_loop.remove_handler(ready_fd)
+        io_loop.remove_timeout(state["timeout"])
+        os.close(ready_fd)
+        if ready:
+            logger.info("successor %d is ready, draining", process.pid)
+            server.drain(callback and (lambda: callback(True)), drain_timeout)
+        else:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            logger.error("successor %d failed to start (status %s), restart aborted",
+                         process.pid, process.returncode)
+            if callback is not None:
+                callback(False)
+
+    def on_ready(fd, events):
+        try:
+            data = os.read(fd, 1)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = b""
+        done(bool(data))    # EOF - the successor exited without notifying
+
+    state["timeout"] = io_loop.add_timeout(time.time() + ready_timeout,
+                                           lambda: done(False))
+    io_loop.add_handler(ready_fd, on_ready, IOLoop.READ | IOLoop.ERROR)
+    return process
+
+
+def restart_on_signal(server, signum=signal.SIGHUP, args=None, drain_timeout=None,
+                      ready_timeout=10):
+    """Installs a handler of <signum>, which restarts the process of
+    <server> (see `restart`), and stops the IOLoop when the server is
+    drained."""
+    io_loop = server.io_loop or IOLoop.instance()
+    restarting = []
+
+    def on_restarted(drained):
+        if drained:
+            io_loop.stop()
+        else:
+            restarting.pop()
+
+    def start_restart():
+        if restarting:
+            logger.warning("restart is already in progress")
+            return
+        restarting.append(True)
+        restart(server, args, drain_timeout, ready_timeout, on_restarted)
+
+    signal.signal(signum, lambda signum, frame: io_loop.add_callback(start_restart))
+
+
+def _set_close_exec(fd, close_exec):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    if close_exec:
+        flags |= fcntl.FD_CLOEXEC
+    else:
+        flags &= ~fcntl.FD_CLOEXEC
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+
+
+def _open_fds():
+    for path in ("/proc/self/fd", "/dev/fd"):
+        try:
+            return [int(fd) for fd in os.listdir(path)]
+        except OSError:
+            pass
+    return range(os.sysconf("SC_OPEN_MAX"))
@@ -1,8 +1,19 @@
+import functools
+import re
 import time
+import zlib
 from tornado.util import bytes_type
 
 from . import logger
-from .base import PConnection, PRequest
+from .base import PConnection, PRequest, to_future, unread
+from .framing import (NetStringParser, NewLinerParser, LengthPrefixParser,
+                      LP_HEADER, LP_REQUEST_ID, FLAG_COMPRESSED, FLAG_REQUEST_ID)
+
+try:
+    _StopAsyncIteration = StopAsyncIteration
+except NameError:   # Python 2, no async generators
+    class _StopAsyncIteration(Exception):
+        pass
 
 
 class NetStringReq(PRequest):
@@ -12,39 +23,212 @@ class NetStringReq(PRequest):
        When Request is finished, then the writed chunks are send back to client in the
        netstring (http://cr.yp.to/proto/netstrings.txt) format
            <data_length>:<data>,
+
+       Big responses can be streamed instead (see `start_stream` and
+       `stream`): every chunk is sent as soon as it's written, as a separate
+       NetString, and the response ends with an empty NetString `0:,`.
     """
-    def __init__(self, *args, **kwargs):
-        super(NetStringReq, self).__init__(*args, **kwargs)
-        self._response_data =[]
+    __slots__ = ("_response_data", "_response_length", "response_streamed", "streaming",
+                 "body_length", "_body_unread")
+
+    def __init__(self, body=None, body_length=None, **kwargs):
+        super(NetStringReq, self).__init__(body, **kwargs)
+        self._response_data = []
+        self._response_length = 0
+        self.response_streamed = False
+        # streamed request: body is read with `read_body`
+        self.streaming = body_length is not None
+        self.body_length = len(self.body) if body_length is None else body_length
+        self._body_unread = self.streaming
+
+    def read_body(self, chunk_callback, end_callback=None):
+        """Reads body of a streamed request (when `streaming` is True).
+        <chunk_callback> is called with every chunk of the body, as it
+        arrives, and <end_callback> when the whole body is read. If the
+        request is finished without reading its body, the body is skipped."""
+        assert self._body_unread, "body is not streamed or already read"
+        self._body_unread = False
+        self.connection.read_body_chunks(chunk_callback, end_callback)
 
 
     def write(self, chunk, callback=None):
         """Writes data to the response stream and finish response."""
-        assert isinstance(chunk, bytes_type)
         assert self._response_data is not None, "Writes after finish"
-
-        self._response_data.append(chunk)
-        self._response_data.append(',')     # NetString
-        data = ''.join(self._response_data)
-        self.connection.write(str(len(data)-1) + ':')
-        self.connection.write(data, callback=callback)
-        self._response_data = None
-
+        if self.response_streamed:
+            self.write_chunk(chunk, callback)
+        else:
+            self.write_chunk(chunk)
+            self._flush(callback)
         self.finish()
 
-    def write_chunk(self, chunk):
+    def write_chunk(self, chunk, callback=None):
         """Writes the given chunk to the response stream.
-        This function must be followed by call write or finish method"""
+        This function must be followed by call write or finish method.
+
+        In a streamed response the chunk is sent immediately, and <callback>
+        is called when it's flushed to the socket."""
         assert isinstance(chunk, bytes_type)
+        if self.response_streamed:
+            if chunk:   # empty NetString ends the response
+                self.connection.write([str(len(chunk)) + ':', chunk, ','],
+                                      callback=callback, request=self)
+            elif callback is not None:
+                self.connection.stream.io_loop.add_callback(callback)
+            return
         self._response_data.append(chunk)
+        self._response_length += len(chunk)
+
+    def start_stream(self):
+        """Switches the response to the streamed framing. Chunks written so
+        far are sent immediately. Streamed responses aren't cached nor shared
+        with coalesced requests."""
+        assert self._response_data is not None, "Writes after finish"
+        if self.response_streamed:
+            return
+        self.response_streamed = True
+        self._notify_response(None)     # not shared with observers
+        data, self._response_data = self._response_data, []
+        for chunk in data:
+            self.write_chunk(chunk)
+
+    def stream(self, chunks, callback=None):
+        """Streams the response from an iterable, generator or async
+        iterator of <chunks> and finishes the request, then calls
+        <callback>. `__anext__` of the async iterator returns Futures, or
+        awaitables (e.g. of an async generator) on `aio.AsyncioPServer`,
+        which runs them on its loop. The next chunk is taken only when the connection has less
+        than `NetStringConn.stream_buffer` bytes of unflushed output, so
+        a slow client doesn't make the response pile up in memory."""
+        self.start_stream()
+        _ResponseStreamer(self, chunks, callback).next()
+
+    def _flush(self, callback=None):
+        # NetString header is computed from the chunks lengths, and chunks are
+        # passed to the connection as a list, so the response is never joined
+        data, self._response_data = self._response_data, None
+        self._notify_response(data)
+        data.insert(0, str(self._response_length) + ':')
+        data.append(',')
+        self.connection.write(data, callback=callback, request=self)
 
 
     def finish(self, keep_alive=True):
         """Finishes this request on the open connection."""
-        if self._response_data:
-            self.write()
-        self.connection.finish(keep_alive)
+        if self.response_streamed:
+            if self._response_data is not None:
+                self.connection.write('0:,', request=self)
+        elif self._response_data:
+            self._flush()
+        self._response_data = None
+        if self._body_unread:
+            self._body_unread = False
+            self.connection.read_body_chunks(None)    # skip the body
         self._finish_time = time.time()
+        self.connection.finish(keep_alive, request=self)
+
+
+class _ResponseStreamer(object):
+    """Writes chunks taken from an iterator or async iterator to a streamed
+    NetString response, respecting the output buffer of the connection."""
+    def __init__(self, request, chunks, callback=None):
+        request._retained = True
+        self.request = request
+        self.callback = callback
+        self.io_loop = request.connection.stream.io_loop
+        if hasattr(chunks, "__aiter__"):
+            self.chunks = None
+            self.anext = chunks.__aiter__().__anext__
+        else:
+            self.chunks = iter(chunks)
+
+    def next(self):
+        if self.request.connection.stream.closed():
+            if hasattr(self.chunks, "close"):
+                self.chunks.close()
+            return
+        if self.chunks is None:
+            try:
+                result = self.anext()
+                future = to_future(result)
+                if future is None:
+                    # an awaitable, e.g. of an async generator, is run as
+                    # a task of the asyncio loop
+                    if not hasattr(self.io_loop, "ensure_future"):
+                        raise TypeError("awaitables need the asyncio backend, "
+                                        "pserver.aio.AsyncioPServer")
+                    future = self.io_loop.ensure_future(result)
+            except Exception:
+                self._fail()
+                return
+            future.add_done_callback(lambda f: self.io_loop.add_callback(
+                functools.partial(self._on_anext, f)))
+            return
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self._finish()
+        except Exception:
+            self._fail()
+        else:
+            self._send(chunk)
+
+    def _on_anext(self, future):
+        try:
+            chunk = future.result()
+        except _StopAsyncIteration:
+            self._finish()
+        except Exception:
+            self._fail()
+        else:
+            self._send(chunk)
+
+    def _send(self, chunk):
+        request = self.request
+        conn = request.connection
+        if ((not conn.ordered or request is conn._requests[0])
+                and conn.unflushed() < conn.stream_buffer):
+            request.write_chunk(chunk)
+            self.io_loop.add_callback(self.next)
+        else:
+            request.write_chunk(chunk, callback=self.next)
+
+    def _finish(self):
+        self.request.finish()
+        if self.callback is not None:
+            self.callback()
+
+    def _fail(self):
+        # the response is cut, so the client must not take it as complete
+        logger.exception("exception was thrown while streaming response to %s",
+                         self.request.remote_ip)
+        self.request.connection.stream.close()
+
+
+_netstring_headers = {}
+
+
+def _netstring_header(max_digits):
+    """Returns a regex matching the NetString header of at most <max_digits>
+    digits, or the point where it's known to be malformed (a non digit
+    character, or too many digits). Reading the header with it doesn't
+    buffer an endless header."""
+    regex = _netstring_headers.get(max_digits)
+    if regex is None:
+        regex = _netstring_headers[max_digits] = re.compile(
+            b"^[0-9]{0,%d}[^0-9]|^[0-9]{%d}" % (max_digits, max_digits + 1))
+    return regex
+
+
+_netstring_parsers = {}
+
+
+def _netstring_parser(max_digits):
+    """Returns a NetStringParser shared by connections with headers of at
+    most <max_digits> digits."""
+    parser = _netstring_parsers.get(max_digits)
+    if parser is None:
+        parser = _netstring_parsers[max_digits] = NetStringParser(max_digits)
+    return parser
 
 
 class NetStringConn(PConnection):
@@ -55,24 +239,115 @@ class NetStringConn(PConnection):
     When PRequest calls write or finish method, the request is finish and response is flushed back to socket.
     If keep_alive is true, then the connection is keep open, and PConnection waits for
     another comand (NetString data from socket)
+
+    Frames longer than `max_frame_size` are rejected (connection is closed)
+    before their body is read. Streamed responses are written while the
+    connection has less than `stream_buffer` bytes of unflushed output.
+    Bodies longer than `stream_threshold` are not
+    buffered: request is dispatched with empty body and `streaming` flag,
+    and handler reads the body in chunks of `chunk_size` with
+    `NetStringReq.read_body`. Set these in a derived class::
+
+        class UploadConn(NetStringConn):
+            max_frame_size = 1024 ** 3
+            stream_threshold = 1024 ** 2
     """
+    __slots__ = ("_body_remaining", "_chunk_callback", "_end_callback")
     ReqCls = NetStringReq
+    max_frame_size = None
+    stream_threshold = None
+    chunk_size = 64 * 1024
+    stream_buffer = 64 * 1024
+    max_header_size = 20    # digits of the length
+
+    @property
+    def parser(self):
+        """NetStringParser with the `max_header_size` of the class"""
+        return _netstring_parser(self.max_header_size)
 
     def read(self):
-        self.stream.read_until(":", self.on_request)
+        self.stream.read_until_regex(_netstring_header(self.max_header_size),
+                                     self.on_request)
+
+    def max_parsed_size(self):
+        limits = [l for l in (self.max_frame_size, self.stream_threshold) if l is not None]
+        return min(limits) if limits else None
 
     def on_request(self, data):
-        logger.debug("readed head: " + data)
+        self._start_frame()
         try:
-            num_bytes = int(data[:-1]) + 1                       #need to read additional ','
-            self.stream.read_bytes(num_bytes, self.on_body)
-        except:
-            logger.exception('Mallformed data, expected number, received: {}'.format(data[:-1]))
+            if data[-1:] != b':' or len(data) > self.max_header_size + 1:
+                raise ValueError("header too long or malformed")
+            num_bytes = int(data[:-1])
+            if num_bytes < 0:
+                raise ValueError("negative length")
+        except ValueError:
+            logger.error('Mallformed data from %s, expected number, received: %r',
+                         self.address[0], data[:self.max_header_size])
+            self.stream.close()
+            return
+        if self.max_frame_size is not None and num_bytes > self.max_frame_size:
+            logger.error('Frame of %d bytes from %s exceeds the limit of %d bytes',
+                         num_bytes, self.address[0], self.max_frame_size)
+            self.stream.close()
+            return
+        if self.stream_threshold is not None and num_bytes > self.stream_threshold:
+            self._body_remaining = num_bytes
+            self.dispatch(self.ReqCls(b"", body_length=num_bytes, connection=self,
+                                      remote_ip=self.address[0]))
+        else:
+            self.stream.read_bytes(num_bytes + 1, self.on_body)   #need to read additional ','
 
     def on_body(self, data):
-        logger.debug("Request handled with data: '{}'".format(data))
+        logger.debug("Request handled with %d bytes of data", len(data) - 1)
+        if data[-1:] != b',':
+            logger.error("Mallformed data from %s, NetString doesn't end with ','",
+                         self.address[0])
+            self.stream.close()
+            return
         self.make_request(data[:-1])     # remove ','
 
+    def read_body_chunks(self, chunk_callback, end_callback=None):
+        """Reads the rest of the streamed body. See `NetStringReq.read_body`."""
+        self._chunk_callback = chunk_callback
+        self._end_callback = end_callback
+        self._read_body_chunk()
+
+    def _read_body_chunk(self):
+        if self.stream.closed():
+            return
+        if self._body_remaining:
+            self.stream.read_bytes(min(self._body_remaining, self.chunk_size),
+                                   self._on_body_chunk)
+        else:
+            self.stream.read_bytes(1, self._on_body_end)
+
+    def _on_body_chunk(self, data):
+        self._body_remaining -= len(data)
+        if self._stats is not None:
+            self._stats.bytes_in += len(data)
+        if self._chunk_callback is not None:
+            try:
+                self._chunk_callback(data)
+            except:
+                logger.exception("exception was thrown from body chunk callback")
+                self.stream.close()
+                return
+        self._read_body_chunk()
+
+    def _on_body_end(self, data):
+        if data != b',':
+            logger.error("Mallformed data from %s, NetString doesn't end with ','",
+                         self.address[0])
+            self.stream.close()
+            return
+        end_callback = self._end_callback
+        self._chunk_callback = self._end_callback = None
+        self._reading = False
+        if end_callback is not None:
+            end_callback()
+        self._maybe_read()
+
 
 ########################################
 
@@ -85,6 +360,8 @@ class NewLinerReq(PRequest):
        data format:
            <data>\n
     """
+    __slots__ = ("_response_data",)
+
     def __init__(self, *args, **kwargs):
         super(NewLinerReq, self).__init__(*args, **kwargs)
         self._response_data =[]
@@ -93,22 +370,240 @@ class NewLinerReq(PRequest):
     def write(self, data, callback=None):
         """Writes data to the response stream and finish response."""
         assert isinstance(data, bytes_type)
-        self.connection.write(data)
-        self.connection.write('\n', callback=callback)
+        self._notify_response([data])
+        self.connection.write([data, '\n'], callback=callback, request=self)
         self.finish()
 
 
     def finish(self, keep_alive=True):
         """Finishes this request on the open connection."""
-        self.connection.finish(keep_alive)
         self._finish_time = time.time()
+        self.connection.finish(keep_alive, request=self)
 
 
 class NewLinerConn(PConnection):
+    __slots__ = ()
     ReqCls = NewLinerReq
+    parser = NewLinerParser()
 
     def read(self):
         self.stream.read_until("\n", self.on_request)
 
     def on_request(self, data):
+        self._start_frame()
         self.make_request(data[:-1]) # remove '\n'
+
+
+
+########################################
+
+
+def length_prefix_frame(data, flags=0, request_id=None):
+    """Returns list of chunks making the LengthPrefix frame of <data>.
+    FLAG_REQUEST_ID is set based on <request_id>."""
+    if request_id is None:
+        flags &= ~FLAG_REQUEST_ID
+        return [LP_HEADER.pack(flags, len(data)), data]
+    flags |= FLAG_REQUEST_ID
+    return [LP_HEADER.pack(flags, len(data)) + LP_REQUEST_ID.pack(request_id), data]
+
+
+class LengthPrefixReq(PRequest):
+    """A single request object for LengthPrefixConn.
+
+       Request is finished by either calling `write` or `finish` method.
+       The response frame has the same format as the request: 1 byte of flags,
+       4 bytes of big-endian body length, optional 4 bytes of request id and
+       the body. Response echoes request_id and is compressed if the request was.
+    """
+    __slots__ = ("flags", "_response_data")
+
+    def __init__(self, body=None, flags=0, request_id=None, **kwargs):
+        super(LengthPrefixReq, self).__init__(body, **kwargs)
+        self.flags = flags
+        self.request_id = request_id
+        self._response_data = []
+
+
+    def write(self, chunk, callback=None):
+        """Writes data to the response stream and finish response."""
+        assert self._response_data is not None, "Writes after finish"
+        self.write_chunk(chunk)
+        self._flush(callback)
+        self.finish()
+
+    def write_chunk(self, chunk):
+        """Writes the given chunk to the response stream.
+        This function must be followed by call write or finish method"""
+        assert isinstance(chunk, bytes_type)
+        self._response_data.append(chunk)
+
+    def _flush(self, callback=None):
+        data, self._response_data = self._response_data, None
+        self._notify_response(data)
+        data = data[0] if len(data) == 1 else b"".join(data)
+        flags = self.flags & FLAG_COMPRESSED
+        if flags:
+            data = zlib.compress(data)
+        self.connection.write(length_prefix_frame(data, flags, self.request_id),
+                              callback=callback, request=self)
+
+
+    def finish(self, keep_alive=True):
+        """Finishes this request on the open connection."""
+        if self._response_data:
+            self._flush()
+        self._response_data = None
+        self._finish_time = time.time()
+        self.connection.finish(keep_alive, request=self)
+
+
+class LengthPrefixConn(PConnection):
+    """Binary protocol, where each frame starts with a fixed size header:
+    a byte of flags and 4 bytes of big-endian body length. Header and body are
+    read with exactly sized reads, so there is no need of scanning for
+    delimiters, and body can contain arbitrary bytes.
+
+    Flags:
+      * FLAG_COMPRESSED - body is compressed with zlib
+      * FLAG_REQUEST_ID - header is followed by 4 bytes of request id, which
+        is available as `request.request_id` and is echoed in the response.
+    """
+    __slots__ = ("_flags",)
+    ReqCls = LengthPrefixReq
+    parser = LengthPrefixParser()
+    # Frames with bigger bodies are rejected before they are read, and
+    # compressed bodies are rejected when they decompress to more bytes.
+    max_frame_size = 64 << 20
+
+    def read(self):
+        self.stream.read_bytes(LP_HEADER.size, self.on_request)
+
+    def max_parsed_size(self):
+        return self.max_frame_size
+
+    def on_request(self, data):
+        self._start_frame()
+        self._flags, num_bytes = LP_HEADER.unpack(data)
+        if self.max_frame_size is not None and num_bytes > self.max_frame_size:
+            logger.error('Frame of %d bytes from %s exceeds the limit of %d bytes',
+                         num_bytes, self.address[0], self.max_frame_size)
+            self.stream.close()
+            return
+        if self._flags & FLAG_REQUEST_ID:
+            num_bytes += LP_REQUEST_ID.size
+        if num_bytes:
+            self.stream.read_bytes(num_bytes, self.on_body)
+        else:
+            self.on_body(b"")
+
+    def on_body(self, data):
+        request_id = None
+        if self._flags & FLAG_REQUEST_ID:
+            request_id = LP_REQUEST_ID.unpack_from(data)[0]
+            data = data[LP_REQUEST_ID.size:]
+        self.on_frame((self._flags, request_id, data))
+
+    def on_frame(self, frame):
+        flags, request_id, data = frame
+        if flags & FLAG_COMPRESSED:
+            max_size = self.max_frame_size
+            try:
+                if max_size is None:
+                    data = zlib.decompress(data)
+                else:
+                    decompressor = zlib.decompressobj()
+                    data = decompressor.decompress(data, max_size)
+                    if decompressor.unconsumed_tail:
+                        logger.error('Frame from %s decompresses to more than %d bytes',
+                                     self.address[0], max_size)
+                        self.stream.close()
+                        return
+            except zlib.error:
+                logger.exception("Mallformed data, can't decompress the body")
+                self.stream.close()
+                return
+        self.make_request(data, flags=flags, request_id=request_id)
+
+
+class MuxConn(LengthPrefixConn):
+    """Multiplexed LengthPrefix protocol. Every frame carries a request id
+    (FLAG_REQUEST_ID), and responses are written as soon as their requests
+    are finished, in any order, so a slow request doesn't hold up others.
+    Use it with a big `max_pipeline` of the PServer, and a client which
+    matches responses by ids, e.g. `client.MuxClient`.
+    """
+    __slots__ = ()
+    ordered = False
+
+    def on_frame(self, frame):
+        if not frame[0] & FLAG_REQUEST_ID:
+            logger.error("Mallformed data, request without id from %s", self.address[0])
+            self.stream.close()
+            return
+        super(MuxConn, self).on_frame(frame)
+
+
+
+########################################
+
+
+class DetectingConn(object):
+    """Serves many protocols on a single port. Use it as the `protocol_conn`
+    of PServer. It peeks at the first bytes of a new stream, and hands the
+    stream to the connection class of the detected protocol:
+
+      * digits followed by ':' - `netstring` (NetStringConn)
+      * a byte of LengthPrefix flags (0x00 - 0x03) - `binary` (LengthPrefixConn)
+      * anything else - `newliner` (NewLinerConn)
+
+    Set these class attributes in a derived class to use other connection
+    classes, e.g. `binary = MuxConn`. Stats are collected for the detected
+    connection classes.
+    """
+    __slots__ = ("stream", "address", "request_callback", "args", "kwargs", "server",
+                 "_head", "_requests", "__weakref__")
+    netstring = NetStringConn
+    newliner = NewLinerConn
+    binary = LengthPrefixConn
+    max_header_size = NetStringConn.max_header_size
+
+    def __init__(self, stream, address, request_callback, *args, **kwargs):
+        self.stream = stream
+        self.address = address
+        self.request_callback = request_callback
+        self.args = args
+        self.kwargs = kwargs
+        self.server = kwargs.get("server")
+        self._head = b""
+        self._requests = ()     # for PServer.in_flight, no requests until detected
+        stream.set_close_callback(self._on_close)
+        stream.read_bytes(1, self._on_byte)
+
+    def _on_byte(self, byte):
+        head = self._head = self._head + byte
+        if len(head) == 1 and ord(byte) <= (FLAG_COMPRESSED | FLAG_REQUEST_ID):
+            self._detected(self.binary)
+        elif byte.isdigit() and len(head) <= self.max_header_size:
+            self.stream.read_bytes(1, self._on_byte)
+        elif byte == b':' and len(head) > 1:
+            self._detected(self.netstring)
+        else:
+            self._detected(self.newliner)
+
+    def _detected(self, conn_cls):
+        logger.debug("detected %s on a connection with %s", conn_cls.__name__, self.address)
+        unread(self.stream, self._head)
+        conn = conn_cls(self.stream, self.address, self.request_callback,
+                        *self.args, **self.kwargs)
+        if self.server is not None:
+            self.server._connections.discard(self)
+            if not self.stream.closed():
+                self.server._connections.add(conn)
+
+    def close_gracefully(self):
+        self.stream.close()
+
+    def _on_close(self):
+        if self.server is not None:
+            self.server._connection_closed(self)
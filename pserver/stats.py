@@ -0,0 +1,148 @@
+# Copyright 2012 Robert Zaremba
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Low overhead counters and latency histograms for PServer.
+
+`PServer` keeps one `ProtocolStats` object per protocol connection class,
+which is updated by connections. `PServer.stats()` returns a snapshot of all
+of them as a dict.
+"""
+
+
+class Histogram(object):
+    """HDR-style histogram of non negative integers (latencies are recorded
+    in microseconds).
+
+    Values below 2**<sub_bits> are counted exactly, bigger ones fall into
+    buckets with relative width of 2**(1-<sub_bits>), so with the default
+    <sub_bits> = 6 percentiles have ~3% precision in any range. Recording is
+    O(1) and memory is proportional to the number of distinct buckets.
+    """
+    def __init__(self, sub_bits=6):
+        self.sub_bits = sub_bits
+        self._half = 1 << (sub_bits - 1)
+        self._exact = 1 << sub_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value < self._exact:
+            return value
+        shift = value.bit_length() - self.sub_bits
+        return shift * self._half + (value >> shift)
+
+    def _lowest(self, index):
+        """the lowest value of bucket <index>"""
+        if index < self._exact:
+            return index
+        shift = index // self._half - 1
+        return (index - shift * self._half) << shift
+
+    def record(self, value):
+        value = int(value)
+        index = self._index(value)
+        counts = self.counts
+        counts[index] = counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def record_time(self, seconds):
+        """records time interval given in seconds"""
+        self.record(seconds * 1e6)
+
+    def percentile(self, p):
+        """Returns value at the <p> percentile (0 - 100)."""
+        if not self.count:
+            return 0
+        target = self.count * p / 100.0
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(max(self._lowest(index), self.min), self.max)
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count,
+                "min": self.min or 0,
+                "max": self.max or 0,
+                "mean": self.total / float(self.count) if self.count else 0,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "p999": self.percentile(99.9)}
+
+
+class ProtocolStats(object):
+    """Counters of a single protocol.
+
+    Latencies (in microseconds):
+      * parse - from the beginning of a frame to the dispatch of the request
+      * handler - from dispatch of the request to its finish
+      * flush - from finish of the request, to the moment its output is
+        flushed to the socket
+
+    Counters count all requests, but latencies are measured only for every
+    <sample_every>-th request, which keeps clock reads and histogram updates
+    off the path of most requests.
+    """
+    __slots__ = ("sample_every", "accepted", "connections", "requests", "bytes_in",
+                 "bytes_out", "parse_time", "handler_time", "flush_time")
+
+    def __init__(self, sample_every=1):
+        self.sample_every = sample_every
+        self.accepted = 0       # number of all connections
+        self.connections = 0    # number of active connections
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.parse_time = Histogram()
+        self.handler_time = Histogram()
+        self.flush_time = Histogram()
+
+    def snapshot(self):
+        return {"accepted": self.accepted,
+                "connections": self.connections,
+                "requests": self.requests,
+                "sample_every": self.sample_every,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "parse_time": self.parse_time.snapshot(),
+                "handler_time": self.handler_time.snapshot(),
+                "flush_time": self.flush_time.snapshot()}
+
+
+class TLSStats(object):
+    """Counters of TLS handshakes of a server. A handshake is resumed when
+    the client reused a session (from the session cache or a ticket), and
+    full otherwise. Handshake latency (in microseconds) is measured from
+    the accept of the connection to the end of the handshake."""
+    def __init__(self):
+        self.full_handshakes = 0
+        self.resumed_handshakes = 0
+        self.failed_handshakes = 0
+        self.handshake_time = Histogram()
+
+    def snapshot(self):
+        return {"full_handshakes": self.full_handshakes,
+                "resumed_handshakes": self.resumed_handshakes,
+                "failed_handshakes": self.failed_handshakes,
+                "handshake_time": self.handshake_time.snapshot()}
@@ -0,0 +1,108 @@
+# Copyright 2012 Robert Zaremba
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""TLS support of PServer.
+
+PServer builds a single `ssl.SSLContext` from its <ssl_options> and wraps
+every accepted socket with it, instead of creating a new context for every
+connection. Sessions are kept in the context, so clients which reconnect
+can resume them, from the server session cache or with session tickets,
+and skip the full handshake::
+
+    server = PServer(handle_request, NetStringConn,
+                     ssl_options=dict(certfile="server.crt", keyfile="server.key"))
+
+<ssl_options> can also be a prebuilt SSLContext. Handshakes are counted
+in `PServer.stats()["tls"]`, see `stats.TLSStats`.
+"""
+
+import socket
+import ssl
+import time
+from tornado.iostream import SSLIOStream
+
+OP_NO_TICKET = getattr(ssl, "OP_NO_TICKET", 0x4000)
+
+
+def make_ssl_context(ssl_options, session_tickets=True):
+    """Returns SSLContext for the server side, made from <ssl_options> dict
+    (the keyword arguments of `ssl.wrap_socket`: certfile, keyfile,
+    cert_reqs, ca_certs, ssl_version and ciphers), or <ssl_options> itself
+    if it's already an SSLContext. With <session_tickets> = False clients
+    can resume sessions only from the server session cache."""
+    if isinstance(ssl_options, ssl.SSLContext):
+        context = ssl_options
+    else:
+        options = dict(ssl_options)
+        context = ssl.SSLContext(options.pop("ssl_version", ssl.PROTOCOL_SSLv23))
+        context.load_cert_chain(options.pop("certfile"), options.pop("keyfile", None))
+        if "ca_certs" in options:
+            context.load_verify_locations(options.pop("ca_certs"))
+        context.verify_mode = options.pop("cert_reqs", ssl.CERT_NONE)
+        if "ciphers" in options:
+            context.set_ciphers(options.pop("ciphers"))
+        if options:
+            raise ValueError("unsupported ssl_options: " + ", ".join(sorted(options)))
+    if not session_tickets:
+        context.options |= OP_NO_TICKET
+    return context
+
+
+class TLSStream(SSLIOStream):
+    """SSLIOStream of an accepted connection, which records its handshake
+    in <tls_stats> (`stats.TLSStats`)."""
+    def __init__(self, *args, **kwargs):
+        self._tls_stats = kwargs.pop("tls_stats", None)
+        self._accept_time = time.time()
+        self._session_hit = False
+        super(TLSStream, self).__init__(*args, **kwargs)
+
+    def _do_ssl_handshake(self):
+        stats = self._tls_stats
+        if stats is None:
+            return super(TLSStream, self)._do_ssl_handshake()
+        sock = self.socket
+        # Python < 3.6 doesn't tell if the session was reused. The handshake
+        # takes a few calls, and the session is looked up within one of
+        # them, so the hits counter of the context tells if it was found.
+        hits = None
+        if not hasattr(sock, "session_reused"):
+            hits = sock.context.session_stats()["hits"]
+        super(TLSStream, self)._do_ssl_handshake()
+        if hits is not None and sock.context.session_stats()["hits"] > hits:
+            self._session_hit = True
+        if not self._ssl_accepting:
+            self._tls_stats = None
+            if hits is None:
+                resumed = sock.session_reused
+            else:
+                resumed = self._session_hit
+            if resumed:
+                stats.resumed_handshakes += 1
+            else:
+                stats.full_handshakes += 1
+            stats.handshake_time.record_time(time.time() - self._accept_time)
+        elif self.closed():
+            self._tls_stats = None
+            stats.failed_handshakes += 1
+
+    def close(self):
+        # OpenSSL drops sessions of connections which weren't shut down
+        # from the cache, so their clients couldn't resume them
+        if self.socket is not None and not self._ssl_accepting:
+            try:
+                self.socket.unwrap()
+            except (ssl.SSLError, socket.error):
+                pass    # close_notify is sent even if the peer's isn't received
+        super(TLSStream, self).close()
@@ -99,7 +99,7 @@ setup(
     install_requires=['tornado < 4.0'],
     zip_safe=True,
     test_suite="nose.collector",
-    tests_require=['nose', 'pyfunctional'],
+    tests_require=['nose', 'pyfunctional', 'trollius; python_version < "3.4"'],
     classifiers=[
         'Development Status :: 4 - Beta',
         # "Development Status :: 3 - Alpha",
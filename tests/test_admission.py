@@ -0,0 +1,110 @@
+# coding: utf-8
+import socket
+import time
+from threading import Thread
+
+from tornado.testing import get_unused_port
+
+from pserver import PServer, NetStringConn
+from pserver.admission import AdmissionController
+from testutils import AsyncTestCase
+
+
+class FakeRequest(object):
+    def __init__(self, request_time):
+        self._request_time = request_time
+        self.observers = []
+
+    def request_time(self):
+        return self._request_time
+
+    def observe_response(self, callback):
+        self.observers.append(callback)
+
+    def answer(self):
+        for callback in self.observers:
+            callback(self, ["response"])
+
+
+def test_in_flight_budget():
+    controller = AdmissionController(max_in_flight=2)
+    requests = [FakeRequest(0), FakeRequest(0)]
+    for request in requests:
+        assert not controller.overloaded()
+        controller.admit(request)
+    assert controller.overloaded()
+    requests[0].answer()
+    assert not controller.overloaded()
+    assert (controller.in_flight, controller.admitted) == (1, 2)
+
+
+def test_latency_budget():
+    controller = AdmissionController(max_latency=0.05, window=0.02)
+    for request_time in (0.01, 0.01, 0.1):
+        request = FakeRequest(request_time)
+        controller.admit(request)
+        request.answer()
+    assert not controller.overloaded()      # the window isn't complete yet
+    time.sleep(0.025)
+    assert controller.overloaded()
+    assert 95000 < controller.snapshot()["latency"] <= 100000
+    time.sleep(0.045)                       # nothing answered in the last window
+    assert not controller.overloaded()
+
+
+class TestAdmission(AsyncTestCase):
+    def start_server(self, admission):
+        self.requests = []
+        self.server = PServer(self.delayed_echo, NetStringConn, io_loop=self.io_loop,
+                              max_pipeline=4, admission=admission)
+        self.port = get_unused_port()
+        self.server.listen(self.port, "127.0.0.1")
+
+    def delayed_echo(self, request):
+        self.requests.append(request.body)
+        self.io_loop.add_timeout(time.time() + .05, lambda: request.write(request.body))
+
+    def request(self, frames, expected):
+        sock = socket.create_connection(("127.0.0.1", self.port), 1)
+        sock.send(''.join(frames))
+        received = ''
+        while len(received) < expected:
+            received += sock.recv(1024)
+        sock.close()
+        return received
+
+    def run_clients(self, *clients):
+        """runs <clients> in threads, one after another, until all of them finish"""
+        out = [None] * len(clients)
+
+        def target(i):
+            out[i] = clients[i]()
+            if None not in out:
+                self.io_loop.add_callback(self.stop)
+        threads = [Thread(target=target, args=(i,)) for i in range(len(clients))]
+        for i, thread in enumerate(threads):
+            self.io_loop.add_timeout(time.time() + i * .02, thread.start)
+        self.wait(timeout=2)
+        for thread in threads:
+            thread.join()
+        return out
+
+    def test_busy_response(self):
+        self.start_server(AdmissionController(max_in_flight=2))
+        frames = ["2:d1,", "2:d2,", "2:d3,", "2:d4,"]
+        received, = self.run_clients(lambda: self.request(frames, 24))
+        assert received == "2:d1,2:d2,4:BUSY,4:BUSY,"
+        assert self.requests == ['d1', 'd2']
+        admission = self.server.stats()["admission"]
+        assert (admission["admitted"], admission["rejected"]) == (2, 2)
+        assert admission["in_flight"] == 0
+
+    def test_pause_accepting(self):
+        self.start_server(AdmissionController(max_in_flight=1, reject=False,
+                                              pause_accepting=True))
+        received = self.run_clients(lambda: self.request(["2:d1,"], 5),
+                                    lambda: self.request(["2:d2,"], 5))
+        assert received == ["2:d1,", "2:d2,"]
+        assert self.requests == ['d1', 'd2']
+        assert self.server.stats()["admission"]["pauses"] == 2
+        assert self.server.stats()["protocols"]["NetStringConn"]["accepted"] == 2
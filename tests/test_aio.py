@@ -0,0 +1,124 @@
+# coding: utf-8
+import socket
+from threading import Thread
+
+import pytest
+from tornado.testing import get_unused_port
+
+try:
+    import asyncio
+except ImportError:     # Python 2
+    asyncio = pytest.importorskip("trollius")
+
+from pserver import NetStringConn, NewLinerConn, LengthPrefixConn
+from pserver.aio import AsyncioPServer
+from pserver.blocking import NetStringConnection, NewLinerConnection
+from pserver.protocols import length_prefix_frame, _StopAsyncIteration
+from pserver.framing import LengthPrefixParser
+
+
+def echo_handler(request):
+    request.write(request.body)
+
+
+def serve(conn_cls, work, handler=echo_handler, **kwargs):
+    """runs <work(port)> in a thread, while AsyncioPServer handles requests"""
+    loop = asyncio.new_event_loop()
+    server = AsyncioPServer(handler, conn_cls, loop=loop, **kwargs)
+    port = get_unused_port()
+    server.listen(port, "127.0.0.1")
+    done = asyncio.Future(loop=loop)
+    out = []
+
+    def target():
+        try:
+            out.append(work(port))
+        finally:
+            loop.call_soon_threadsafe(done.set_result, None)
+    thread = Thread(target=target)
+    loop.call_soon(thread.start)
+    try:
+        loop.call_later(2, done.cancel)
+        loop.run_until_complete(done)
+    finally:
+        thread.join()
+        stats = server.stats()
+        server.stop()
+        loop.close()
+    return out[0], stats
+
+
+def test_netstring():
+    data = ["x" * 100000] + [str(i) * i for i in range(1, 20)]
+
+    def work(port):
+        conn = NetStringConnection("127.0.0.1", port, timeout=1)
+        return [conn.request("hello")] + conn.send_many(data)
+    responses, stats = serve(NetStringConn, work, max_pipeline=16)
+    assert responses == ["hello"] + data
+    assert stats["requests"] == len(data) + 1
+
+
+def test_newliner():
+    def work(port):
+        return NewLinerConnection("127.0.0.1", port, timeout=1).send_many(["a", "", "b"])
+    assert serve(NewLinerConn, work)[0] == ["a", "", "b"]
+
+
+def test_length_prefix():
+    def work(port):
+        conn = NetStringConnection("127.0.0.1", port, timeout=1)
+        conn.frame = lambda data: length_prefix_frame(data, request_id=7)
+        conn.parser = LengthPrefixParser()
+        return conn.request("data")
+    assert serve(LengthPrefixConn, work)[0] == (0x02, 7, "data")
+
+
+class CoroutineChunks(object):
+    """async iterator of <data> characters, `__anext__` returns coroutines,
+    like an async generator does"""
+    def __init__(self, data):
+        self.chars = iter(data)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return next_char(self.chars)
+
+
+@asyncio.coroutine
+def next_char(chars):
+    for char in chars:
+        return char
+    raise _StopAsyncIteration()
+
+
+def test_stream_async_generator():
+    def work(port):
+        conn = NetStringConnection("127.0.0.1", port, timeout=1)
+        conn.send("abc")
+        return list(conn.recv_stream())
+    stream_handler = lambda request: request.stream(CoroutineChunks(request.body))
+    assert serve(NetStringConn, work, handler=stream_handler)[0] == ["a", "b", "c"]
+
+
+def test_input_is_bounded():
+    # the client doesn't read responses, so reads of the server are paused by
+    # flow control, and the server stops receiving the pipelined requests
+    frames = "1000:%s," % ("x" * 1000) * 64
+
+    def work(port):
+        sock = socket.create_connection(("127.0.0.1", port), 1)
+        sock.settimeout(.3)
+        sent = 0
+        try:
+            while sent < 32 << 20:
+                sock.sendall(frames)
+                sent += len(frames)
+        except socket.timeout:
+            pass
+        sock.close()
+        return sent
+    sent, stats = serve(NetStringConn, work, max_pipeline=4, write_high_water=64 * 1024)
+    assert sent < 32 << 20
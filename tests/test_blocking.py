@@ -0,0 +1,147 @@
+# coding: utf-8
+import functools
+from threading import Thread
+
+import pytest
+from tornado.testing import get_unused_port
+
+from pserver import PServer, NetStringConn, NewLinerConn
+from pserver.blocking import NetStringConnection, NewLinerConnection, ConnectionPool
+from pserver.protocols import _StopAsyncIteration
+from testutils import AsyncTestCase
+
+
+def echo_handler(request):
+    request.write(request.body)
+
+
+def stream_handler(request):
+    """streams the body back, one character per chunk"""
+    request.stream(iter(request.body))
+
+
+class FutureChunks(object):
+    """async iterator of <data> characters, `__anext__` returns Futures
+    (of <future_cls>) resolved in the next IOLoop iteration"""
+    def __init__(self, data, io_loop, future_cls):
+        self.chars = iter(data)
+        self.io_loop = io_loop
+        self.future_cls = future_cls
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = self.future_cls()
+        def resolve():
+            try:
+                future.set_result(next(self.chars))
+            except StopIteration:
+                future.set_exception(_StopAsyncIteration())
+        self.io_loop.add_callback(resolve)
+        return future
+
+
+class CountingSocket(object):
+    """counts `recv_into` calls of the wrapped socket"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.recv_calls = 0
+
+    def recv_into(self, *args):
+        self.recv_calls += 1
+        return self.sock.recv_into(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class BlockingClientTest(object):
+    conn_cls = NotImplemented
+    client_cls = NotImplemented
+    handler = staticmethod(echo_handler)
+
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.server = PServer(self.handler, self.conn_cls, io_loop=self.io_loop,
+                              max_pipeline=16)
+        self.port = get_unused_port()
+        self.server.listen(self.port)
+        self.server.start()
+
+    def run_client(self, work):
+        """runs <work(port)> in a thread, while the server handles requests"""
+        out = []
+        def target():
+            try:
+                out.append(work(self.port))
+            finally:
+                self.io_loop.add_callback(self.stop)
+        thread = Thread(target=target)
+        thread.start()
+        self.wait(timeout=2)
+        thread.join()   # don't close the IOLoop while the thread wakes it up
+        return out[0]
+
+    def test_request(self):
+        def work(port):
+            conn = self.client_cls("127.0.0.1", port, timeout=1, buffer_size=8)
+            return [conn.request("hello"), conn.request("x" * 100000)]
+        assert self.run_client(work) == ["hello", "x" * 100000]
+
+    def test_big_frame(self):
+        def work(port):
+            conn = self.client_cls("127.0.0.1", port, timeout=1, buffer_size=8)
+            conn.sock = CountingSocket(conn.sock)
+            return conn.request("x" * 1000000), conn.sock.recv_calls
+        response, recv_calls = self.run_client(work)
+        assert response == "x" * 1000000
+        assert recv_calls < 100
+
+    def test_send_many(self):
+        data = [str(i) * i for i in range(1, 20)]
+        def work(port):
+            return self.client_cls("127.0.0.1", port, timeout=1).send_many(data)
+        assert self.run_client(work) == data
+
+    def test_pool(self):
+        def work(port):
+            pool = ConnectionPool(functools.partial(self.client_cls, "127.0.0.1", port,
+                                                    timeout=1), size=2)
+            return [pool.request(str(i)) for i in range(5)]
+        assert self.run_client(work) == [str(i) for i in range(5)]
+
+
+class TestNetStringConnection(BlockingClientTest, AsyncTestCase):
+    conn_cls = NetStringConn
+    client_cls = NetStringConnection
+
+
+class TestNewLinerConnection(BlockingClientTest, AsyncTestCase):
+    conn_cls = NewLinerConn
+    client_cls = NewLinerConnection
+
+
+class TestStreamedResponse(BlockingClientTest, AsyncTestCase):
+    conn_cls = NetStringConn
+    client_cls = NetStringConnection
+    handler = staticmethod(stream_handler)
+
+    def test_request(self):
+        def work(port):
+            conn = self.client_cls("127.0.0.1", port, timeout=1)
+            conn.send("abc")
+            return list(conn.recv_stream())
+        assert self.run_client(work) == ["a", "b", "c"]
+
+    def test_async_iterator(self):
+        futures = pytest.importorskip("concurrent.futures")
+        def work(port):
+            conn = self.client_cls("127.0.0.1", port, timeout=1)
+            conn.send("abc")
+            return list(conn.recv_stream())
+        self.server.request_callback = lambda request: request.stream(
+            FutureChunks(request.body, self.io_loop, futures.Future))
+        assert self.run_client(work) == ["a", "b", "c"]
+
+    test_send_many = test_pool = test_big_frame = None
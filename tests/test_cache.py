@@ -0,0 +1,88 @@
+# coding: utf-8
+import socket
+import time
+
+from tornado import iostream
+from tornado.testing import get_unused_port
+
+from pserver import PServer, NetStringConn
+from pserver.cache import ResponseCache
+from testutils import AsyncTestCase
+
+
+def test_hit_miss():
+    cache = ResponseCache()
+    key = ('NetStringReq', 'k1')
+    assert cache.get(key) is None
+    cache.set(key, 'v1')
+    assert cache.get(key) == 'v1'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_lru_eviction():
+    cache = ResponseCache(max_bytes=12)       # entry size is len(body) + len(response)
+    cache.set(('P', 'k1'), '1111')
+    cache.set(('P', 'k2'), '2222')
+    cache.get(('P', 'k1'))                    # k2 is now the least recently used
+    cache.set(('P', 'k3'), '3333')
+    assert cache.get(('P', 'k2')) is None
+    assert cache.get(('P', 'k1')) == '1111'
+    assert cache.evictions == 1
+    assert cache.size == 12
+
+
+def test_ttl():
+    cache = ResponseCache(ttl=60)
+    cache.set(('P', 'k1'), 'v', ttl=0.01)
+    cache.set(('P', 'k2'), 'v')
+    time.sleep(0.02)
+    assert cache.get(('P', 'k1')) is None
+    assert cache.get(('P', 'k2')) == 'v'
+    assert len(cache) == 1
+
+
+def test_too_big_response():
+    cache = ResponseCache(max_bytes=4)
+    cache.set(('P', 'k'), 'vvvvv')
+    assert len(cache) == 0
+
+
+class TestCachingServer(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.calls = []
+        self.server = PServer(self.handler, NetStringConn, io_loop=self.io_loop,
+                              cache=ResponseCache())
+        self.port = get_unused_port()
+        self.server.listen(self.port)
+        self.server.start()
+        self.stream = iostream.IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0),
+                                        self.io_loop)
+        self.stream.connect(("127.0.0.1", self.port), self.stop)
+        self.wait(timeout=1)
+
+    def handler(self, request):
+        """answers with the request body and the number of handler calls"""
+        self.calls.append(request.body)
+        if request.body.startswith("private"):
+            request.set_cacheable(False)
+        request.write("%s %d" % (request.body, len(self.calls)))
+
+    def req_resp(self, data):
+        self.stream.write("%d:%s," % (len(data), data))
+        self.stream.read_until(",", self.stop)
+        return self.wait(timeout=1)
+
+    def test_hit_skips_handler(self):
+        assert self.req_resp("k1") == "4:k1 1,"
+        assert self.req_resp("k2") == "4:k2 2,"
+        assert self.req_resp("k1") == "4:k1 1,"
+        assert self.calls == ["k1", "k2"]
+        cache = self.server.stats()["cache"]
+        assert (cache["hits"], cache["misses"]) == (1, 2)
+
+    def test_not_cacheable(self):
+        assert self.req_resp("private") == "9:private 1,"
+        assert self.req_resp("private") == "9:private 2,"
+        assert self.calls == ["private", "private"]
+        assert len(self.server.cache) == 0
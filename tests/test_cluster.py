@@ -0,0 +1,96 @@
+# coding: utf-8
+import os
+import signal
+import socket
+import time
+from multiprocessing import Process, Value
+
+from tornado.testing import get_unused_port
+
+from pserver import PServer, NetStringConn
+from pserver.cluster import PServerCluster
+
+
+def echo(request):
+    request.write(request.body)
+
+
+class CrashingServer(PServer):
+    def add_sockets(self, sockets):
+        raise RuntimeError("worker crashed")
+
+
+class SlowlyCrashingServer(PServer):
+    """crashes after running for <uptime> seconds, counting the crashes"""
+    def __init__(self, uptime, *args, **kwargs):
+        PServer.__init__(self, *args, **kwargs)
+        self.uptime = uptime
+        self.crashes = Value('i', 0)
+
+    def add_sockets(self, sockets):
+        time.sleep(self.uptime)
+        with self.crashes.get_lock():
+            self.crashes.value += 1
+        raise RuntimeError("worker crashed")
+
+
+def run_cluster(server, port, **kwargs):
+    """runs the cluster supervisor in a new process"""
+    cluster = PServerCluster(server, port, address="127.0.0.1", **kwargs)
+    process = Process(target=cluster.run)
+    process.start()
+    return process
+
+
+def request(port, data, timeout=2):
+    """sends a NetString request, retrying until workers are up"""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            sock = socket.create_connection(("127.0.0.1", port), .5)
+            break
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(.02)
+    sock.send("%d:%s," % (len(data), data))
+    response = sock.recv(100)
+    sock.close()
+    return response
+
+
+def test_restart_backoff_and_exit_status():
+    start = time.time()
+    process = run_cluster(CrashingServer(echo, NetStringConn), get_unused_port(),
+                          num_workers=1, max_restarts=3, restart_delay=.05)
+    process.join(5)
+    # restarts after .05, .1 and .2 seconds, then the supervisor gives up
+    assert process.exitcode == 1
+    assert time.time() - start >= .35
+
+
+def test_restarts_are_counted_in_a_row():
+    server = SlowlyCrashingServer(.06, echo, NetStringConn)
+    process = run_cluster(server, get_unused_port(), num_workers=1, max_restarts=2,
+                          restart_delay=.01, max_restart_delay=.05)
+    time.sleep(.5)
+    try:
+        # every crash follows .06 seconds of uptime, so it starts a new row
+        assert process.is_alive()
+        assert server.crashes.value > 3
+    finally:
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGTERM)
+        process.join(5)
+    assert process.exitcode == 0
+
+
+def test_shutdown():
+    port = get_unused_port()
+    process = run_cluster(PServer(echo, NetStringConn), port, num_workers=2)
+    try:
+        assert request(port, "hello") == "5:hello,"
+    finally:
+        os.kill(process.pid, signal.SIGTERM)
+        process.join(5)
+    assert process.exitcode == 0
@@ -0,0 +1,89 @@
+# coding: utf-8
+import collections
+
+from pserver.dispatch import FairScheduler, classify_by_ip
+
+
+class FakeIOLoop(object):
+    def __init__(self):
+        self.callbacks = collections.deque()
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def run_once(self):
+        """runs callbacks which were added before this call"""
+        for _ in range(len(self.callbacks)):
+            self.callbacks.popleft()()
+
+
+class FakeStream(object):
+    def __init__(self):
+        self._closed = False
+
+    def closed(self):
+        return self._closed
+
+
+class FakeConnection(object):
+    def __init__(self, remote_ip="127.0.0.1"):
+        self.stream = FakeStream()
+        self.remote_ip = remote_ip
+
+
+class FakeRequest(object):
+    def __init__(self, connection, body):
+        self.connection = connection
+        self.remote_ip = connection.remote_ip
+        self.body = body
+
+
+def make_scheduler(**kwargs):
+    io_loop = FakeIOLoop()
+    dispatched = []
+    scheduler = FairScheduler(lambda request: dispatched.append(request.body),
+                              io_loop=io_loop, **kwargs)
+    return scheduler, io_loop, dispatched
+
+
+def send(scheduler, connection, bodies):
+    for body in bodies:
+        scheduler(FakeRequest(connection, body))
+
+
+def test_round_robin():
+    scheduler, io_loop, dispatched = make_scheduler()
+    a, b, c = FakeConnection(), FakeConnection(), FakeConnection()
+    send(scheduler, a, ["a1", "a2", "a3", "a4"])
+    send(scheduler, b, ["b1", "b2"])
+    send(scheduler, c, ["c1"])
+    assert dispatched == []             # requests are dispatched in a callback
+    io_loop.run_once()
+    assert dispatched == ["a1", "b1", "c1", "a2", "b2", "a3", "a4"]
+    assert scheduler.snapshot() == {"queue_depth": 0, "dispatched": 7, "deferred": 0}
+
+
+def test_weights():
+    scheduler, io_loop, dispatched = make_scheduler(
+        classify=classify_by_ip({"10.0.0.1": "gold"}), weights={"gold": 2})
+    a, b = FakeConnection(), FakeConnection("10.0.0.1")
+    send(scheduler, a, ["a1", "a2", "a3"])
+    send(scheduler, b, ["b1", "b2", "b3", "b4", "b5", "b6"])
+    io_loop.run_once()
+    # ties go to the connection which was queued first
+    assert dispatched == ["b1", "a1", "b2", "b3", "a2", "b4", "b5", "a3", "b6"]
+
+
+def test_budget():
+    scheduler, io_loop, dispatched = make_scheduler(budget=2)
+    a, b = FakeConnection(), FakeConnection()
+    send(scheduler, a, ["a1", "a2", "a3"])
+    io_loop.run_once()
+    assert dispatched == ["a1", "a2"]
+    send(scheduler, b, ["b1"])          # arrived while a3 was waiting
+    b.stream._closed = True
+    send(scheduler, FakeConnection(), ["c1"])
+    io_loop.run_once()
+    assert dispatched == ["a1", "a2", "a3", "c1"]   # b closed
+    assert scheduler.queue_depth == 0
+    assert scheduler.deferred == 1
@@ -0,0 +1,47 @@
+# coding: utf-8
+import pytest
+
+from pserver.framing import (NetStringParser, NewLinerParser, LengthPrefixParser,
+                             ProtocolError)
+from pserver.protocols import length_prefix_frame
+
+
+def test_netstring():
+    buf = bytearray(b"2:ab,0:,3:cd")
+    parser = NetStringParser()
+    assert parser.parse(buf) == ([b"ab", b""], 8)
+    assert parser.frame_size(buf, 8) == 6
+    assert parser.parse(buf, 8) == ([], 8)
+    buf += b"e,"
+    assert parser.parse(buf, 8) == ([b"cde"], 14)
+
+
+def test_netstring_limits():
+    buf = b"1:a,1:b,5:abcde,1:c,"
+    parser = NetStringParser()
+    assert parser.parse(buf, max_frames=1) == ([b"a"], 4)
+    assert parser.parse(buf, max_size=4) == ([b"a", b"b"], 8)
+    with pytest.raises(ProtocolError):
+        parser.parse(b"1:a,x:b,")
+    with pytest.raises(ProtocolError):
+        parser.parse(b"1:ab")
+    with pytest.raises(ProtocolError):
+        NetStringParser(max_header_size=3).parse(b"1234")
+
+
+def test_newliner():
+    parser = NewLinerParser()
+    buf = bytearray(b"a\n\nbc")
+    assert parser.parse(buf) == ([b"a", b""], 3)
+    assert parser.parse(buf, 3, scan_from=len(buf)) == ([], 3)
+    buf += b"\n"
+    assert parser.parse(buf, 3, scan_from=5) == ([b"bc"], 6)
+    assert NewLinerParser(b"\r\n").parse(b"a\r\nb\r") == ([b"a"], 3)
+
+
+def test_length_prefix():
+    buf = bytearray(b"".join(length_prefix_frame(b"a") + length_prefix_frame(b"bc", 1, 7)))
+    parser = LengthPrefixParser()
+    assert parser.parse(buf) == ([(0, None, b"a"), (3, 7, b"bc")], len(buf))
+    assert parser.parse(buf[:-1]) == ([(0, None, b"a")], 6)
+    assert parser.frame_size(buf, 6) == 11
@@ -0,0 +1,72 @@
+# coding: utf-8
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+from tornado.testing import get_unused_port
+
+from pserver.blocking import NetStringConnection, ConnectionClosed
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# responds with the pid of the server process, 'slow' requests after a second
+SERVER = """
+import os, sys, time
+sys.path.insert(0, %r)
+from tornado.ioloop import IOLoop
+from pserver import PServer, NetStringConn, handoff
+
+def handler(request):
+    delay = 1 if request.body == 'slow' else 0
+    IOLoop.instance().add_timeout(time.time() + delay,
+                                  lambda: request.write(str(os.getpid())))
+
+server = PServer(handler, NetStringConn)
+handoff.listen(server, int(sys.argv[1]), '127.0.0.1')
+handoff.restart_on_signal(server, drain_timeout=5, ready_timeout=5)
+IOLoop.instance().start()
+""" % ROOT
+
+
+def connect(port, timeout=5):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return NetStringConnection("127.0.0.1", port, timeout=timeout)
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(.05)
+
+
+@pytest.fixture
+def server_script():
+    fd, path = tempfile.mkstemp(suffix=".py")
+    os.write(fd, SERVER.encode())
+    os.close(fd)
+    yield path
+    os.remove(path)
+
+
+def test_restart(server_script):
+    port = get_unused_port()
+    # in a new process group, which is killed with the successor at the end
+    old = subprocess.Popen([sys.executable, server_script, str(port)], preexec_fn=os.setsid)
+    try:
+        conn = connect(port)
+        assert conn.request("x") == str(old.pid)
+        conn.send("slow")       # in flight during the restart
+        os.kill(old.pid, signal.SIGHUP)
+        assert conn.recv() == str(old.pid)
+        with pytest.raises(ConnectionClosed):   # closed on the request boundary
+            conn.recv()
+        assert old.wait() == 0
+
+        assert connect(port).request("x") != str(old.pid)
+    finally:
+        os.killpg(old.pid, signal.SIGKILL)
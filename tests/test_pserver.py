@@ -1,17 +1,24 @@
 # coding: utf-8
+import collections
+import functools
 from multiprocessing import Process
+import threading
 from threading import Thread, Event as TEvent
 import time
 import random
 import socket
+import zlib
 from tornado import iostream
 
-from tornado.testing import AsyncTestCase, main, get_unused_port
+from tornado.testing import main, get_unused_port
 import pytest
-from testutils import SpyMethod
+from testutils import SpyMethod, SpyCallbackMethod, AsyncTestCase
 
-from pserver import PServer, NetStringConn
-from pserver.client import NetStringClient
+from pserver import PServer, NetStringConn, LengthPrefixConn, MuxConn, DetectingConn
+from pserver.client import (NetStringClient, LengthPrefixClient, NetStringPool, MuxClient,
+                            RequestTimeout)
+from pserver.base import write_chunks, unread, WRITE_BUFFER_CHUNK_SIZE
+from pserver.protocols import length_prefix_frame, NetStringReq, FLAG_COMPRESSED
 from . import logger
 
 
@@ -93,7 +100,10 @@ class TestPServer2(AsyncTestCase):
                 f_stop = io_loop.stop
             sock2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
             stream2 = iostream.IOStream(sock2, io_loop)
-            stream2.connect(self.server_address, f_stop)
+            def on_connect():
+                stream2.close()
+                f_stop()
+            stream2.connect(self.server_address, on_connect)
             if io_loop != self.io_loop:                       # we get other event loop
                 logger.debug("Mam nowy  event loop. Startuje go")
                 io_loop.start()
@@ -208,6 +218,924 @@ class TestPServer2(AsyncTestCase):
         assert d_in == d_out
 
 
+class PipelinedTestCase(AsyncTestCase):
+    """sends pipelined frames to a server started by `start_server`"""
+    def start_server(self, handler=None, conn_cls=NetStringConn, **kwargs):
+        """starts PServer with <handler> (by default `delayed_echo`) and
+        <kwargs>, with a pipeline of 4 requests unless they say otherwise"""
+        kwargs.setdefault("max_pipeline", 4)
+        self.max_in_flight = 0
+        self.server = PServer(handler or self.delayed_echo, conn_cls, io_loop=self.io_loop,
+                              **kwargs)
+        self.port = get_unused_port()
+        self.server.listen(self.port)
+        self.server.start()
+
+    def delayed_echo(self, request):
+        """the first request is answered as the last one"""
+        in_flight = len(request.connection._requests)
+        self.max_in_flight = max(self.max_in_flight, in_flight)
+        delay = .1 if request.body == 'd1' else .01
+        self.io_loop.add_timeout(time.time()+delay, lambda: request.write(request.body))
+
+    def socket_pipelined(self, d_in, frames):
+        sock = socket.create_connection(("127.0.0.1", self.port), .5)
+        sock.send(''.join(frames))
+        expected = len(''.join(frames))
+        received = ''
+        while len(received) < expected:
+            received += sock.recv(1024)
+        sock.close()
+        d_in.append(received)
+        self.io_loop.add_callback(self.stop)
+
+    def send_pipelined(self, frames):
+        """sends <frames> at once, returns all the responses"""
+        d_in = []
+        t = Thread(target=self.socket_pipelined, args=(d_in, frames))
+        self.io_loop.add_callback(t.start)
+        self.wait(timeout=1.5)
+        t.join()
+        return d_in[0]
+
+
+class TestPipelining(PipelinedTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.start_server(stats_sample=1)
+
+    def test_responses_order(self):
+        frames = ["2:d1,", "2:d2,", "2:d3,", "2:d4,", "2:d5,"]
+        assert self.send_pipelined(frames) == ''.join(frames)
+        assert self.max_in_flight == 4
+        stats = self.server.stats()
+        assert stats["requests"] == 5
+        assert stats["protocols"]["NetStringConn"]["handler_time"]["count"] == 5
+
+
+class TestDrain(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.server = PServer(self.delayed_echo, NetStringConn, io_loop=self.io_loop)
+        self.port = get_unused_port()
+        self.server.listen(self.port, "127.0.0.1")
+        self.drained = []
+
+    def delayed_echo(self, request):
+        if request.body == self.drain_on:
+            self.drained.append(False)
+            self.server.drain(self.on_drained)
+        self.io_loop.add_timeout(time.time() + .05, lambda: request.write(request.body))
+
+    def on_drained(self):
+        self.drained.append(True)
+        self.io_loop.add_callback(self.stop)
+
+    def run_client(self, data):
+        """sends <data>, returns all data received until the server closed
+        the connection"""
+        out = []
+
+        def client():
+            sock = socket.create_connection(("127.0.0.1", self.port), 1)
+            sock.send(data)
+            received = ''
+            while True:
+                chunk = sock.recv(1024)
+                if not chunk:
+                    break
+                received += chunk
+            sock.close()
+            out.append(received)
+        t = Thread(target=client)
+        self.io_loop.add_callback(t.start)
+        self.wait(timeout=1)
+        t.join()
+        return out[0]
+
+    def test_in_flight_request_is_answered(self):
+        self.drain_on = 'd1'
+        assert self.run_client("2:d1,") == "2:d1,"
+        assert self.drained == [False, True]
+        assert self.server.in_flight() == 0
+        with pytest.raises(socket.error):
+            socket.create_connection(("127.0.0.1", self.port), .2)
+
+    def test_pipelined_requests_are_answered(self):
+        self.server.max_pipeline = 2
+        self.drain_on = 'd2'
+        assert self.run_client("2:d1,2:d2,") == "2:d1,2:d2,"
+        assert self.drained == [False, True]
+
+    def test_idle_connection_is_closed(self):
+        self.server.drain(lambda: self.drained.append(True))
+        assert self.drained == [True]
+
+    def test_drain_timeout(self):
+        self.server.request_callback = lambda request: None    # never answers
+        sock = socket.create_connection(("127.0.0.1", self.port), 1)
+        sock.send("2:d1,")
+        self.io_loop.add_timeout(time.time() + .05, lambda: self.server.drain(
+            lambda: self.io_loop.add_callback(self.stop), timeout=.05))
+        self.wait(timeout=1)
+        assert sock.recv(10) == ''
+        sock.close()
+
+
+class TestCloseGracefully(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.server = PServer(self.echo, NetStringConn, io_loop=self.io_loop)
+        self.port = get_unused_port()
+        self.server.listen(self.port, "127.0.0.1")
+
+    def echo(self, request):
+        request.write(request.body)
+
+    def connection(self):
+        while not self.server._connections:
+            self.io_loop.add_timeout(time.time() + .01, self.stop)
+            self.wait(timeout=1)
+        conn, = self.server._connections
+        return conn
+
+    def test_partial_request_is_handled(self):
+        sock = socket.create_connection(("127.0.0.1", self.port), 1)
+        sock.send("5:hel")
+        conn = self.connection()
+        self.io_loop.add_timeout(time.time() + .05, self.stop)
+        self.wait(timeout=1)
+        conn.close_gracefully()
+        assert not conn.stream.closed()
+        sock.send("lo,")
+        self.io_loop.add_timeout(time.time() + .05, self.stop)
+        self.wait(timeout=1)
+        assert conn.stream.closed()
+        assert sock.recv(100) == "5:hello,"
+        assert sock.recv(100) == ''
+        sock.close()
+
+    def test_header_read(self):
+        # the read buffer is empty, but the body of the frame is still expected
+        sock = socket.create_connection(("127.0.0.1", self.port), 1)
+        sock.send("5:")
+        conn = self.connection()
+        self.io_loop.add_timeout(time.time() + .05, self.stop)
+        self.wait(timeout=1)
+        conn.close_gracefully()
+        assert not conn.stream.closed()
+        sock.send("hello,")
+        self.io_loop.add_timeout(time.time() + .05, self.stop)
+        self.wait(timeout=1)
+        assert conn.stream.closed()
+        assert sock.recv(100) == "5:hello,"
+        sock.close()
+
+    def test_idle_connection(self):
+        sock = socket.create_connection(("127.0.0.1", self.port), 1)
+        conn = self.connection()
+        conn.close_gracefully()
+        assert conn.stream.closed()
+        sock.close()
+
+
+class PooledConn(NetStringConn):
+    request_pool_size = 8
+
+
+class TestRequestPool(PipelinedTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.request_ids = set()
+        self.start_server(self.recording_echo, PooledConn)
+
+    def recording_echo(self, request):
+        self.request_ids.add(id(request))
+        self.delayed_echo(request)
+
+    def test_requests_are_reused(self):
+        responses = [self.send_pipelined(frames)
+                     for frames in (["2:d1,", "2:d2,"], ["2:d3,", "2:d4,"])]
+        assert responses == ["2:d1,2:d2,", "2:d3,2:d4,"]
+        assert len(self.request_ids) == 2     # the second client reused finished requests
+        assert len(self.server._request_pools[NetStringReq]) == 2
+        # pools belong to the server
+        assert PServer(self.delayed_echo, PooledConn)._request_pools == {}
+
+    def test_request_used_after_write(self):
+        # the next buffered frame is dispatched by `write`, while the handler runs
+        def echo(request):
+            request.write(request.body)
+            self.bodies.append(request.body)
+        self.bodies = []
+        self.server.request_callback = echo
+        assert self.send_pipelined(["2:d1,", "2:d2,"]) == "2:d1,2:d2,"
+        assert sorted(self.bodies) == ['d1', 'd2']
+
+    def test_retained_requests(self):
+        futures = pytest.importorskip("concurrent.futures")
+
+        def future_echo(request):
+            self.request_ids.add(id(request))
+            future = futures.Future()
+            self.io_loop.add_timeout(time.time() + .01,
+                                     lambda: future.set_result(request.body))
+            return future
+        self.server.request_callback = future_echo
+        frames = ["2:d1,", "2:d2,", "2:d3,", "2:d4,", "2:d5,"]
+        assert self.send_pipelined(frames) == ''.join(frames)
+        assert len(self.request_ids) == 5     # futures keep requests, they aren't reused
+        assert not self.server._request_pools.get(NetStringReq)
+
+
+class TestBatching(PipelinedTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.batches = []
+        self.start_server(batch_callback=self.batch_echo, batch_size=3, batch_delay=.05)
+
+    def batch_echo(self, requests):
+        self.batches.append([r.body for r in requests])
+        for r in requests:
+            r.write(r.body)
+
+    def test_batch_boundaries(self):
+        # a full batch is dispatched at once, the rest after batch_delay
+        frames = ["2:d1,", "2:d2,", "2:d3,", "2:d4,"]
+        assert self.send_pipelined(frames) == ''.join(frames)
+        assert self.batches == [['d1', 'd2', 'd3'], ['d4']]
+
+
+class TestCoalescing(PipelinedTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.calls = []
+        self.start_server(self.counting_echo, coalesce=True)
+
+    def counting_echo(self, request):
+        self.calls.append(request.body)
+        self.io_loop.add_timeout(time.time()+.05, lambda: request.write(request.body))
+
+    def test_coalesced_count(self):
+        # requests for d1 wait for the first one, which is still handled
+        frames = ["2:d1,", "2:d1,", "2:d2,", "2:d1,"]
+        assert self.send_pipelined(frames) == ''.join(frames)
+        assert self.calls == ['d1', 'd2']
+        assert self.server.stats()["coalesced"] == 2
+
+
+class TestCoalescingLeaderFailure(AsyncTestCase):
+    """the first request isn't answered, the request waiting for it still is"""
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.calls = []
+        self.server = PServer(self.dispatch, NetStringConn, io_loop=self.io_loop,
+                              coalesce=True)
+        self.port = get_unused_port()
+        self.server.listen(self.port, "127.0.0.1")
+
+    def dispatch(self, request):
+        self.calls.append(request.body)
+        if len(self.calls) == 1:
+            self.handle_leader(request)
+        else:
+            self.answer_later(request)
+
+    def answer_later(self, request):
+        self.io_loop.add_timeout(time.time() + .05, lambda: request.write(request.body))
+
+    def run_clients(self, expected="1:k,"):
+        """the first client sends 'k' and closes the connection after .1s,
+        the second sends 'k' while the first one is handled and reads
+        <expected> response"""
+        received = []
+        def first():
+            sock = socket.create_connection(("127.0.0.1", self.port), 1)
+            sock.send("1:k,")
+            time.sleep(.1)
+            sock.close()
+        def second():
+            time.sleep(.03)
+            sock = socket.create_connection(("127.0.0.1", self.port), 1)
+            sock.send("1:k,")
+            data = ''
+            while len(data) < len(expected):
+                data += sock.recv(100)
+            received.append(data)
+            sock.close()
+            self.io_loop.add_callback(self.stop)
+        threads = [Thread(target=first), Thread(target=second)]
+        for t in threads:
+            self.io_loop.add_callback(t.start)
+        self.wait(timeout=2)
+        for t in threads:
+            t.join()
+        return received
+
+    def test_leader_raises(self):
+        def handle_leader(request):
+            raise ValueError("handler failed")
+        self.handle_leader = handle_leader
+        assert self.run_clients() == ["1:k,"]
+        assert self.calls == ["k", "k"]
+
+    def test_leader_abandoned(self):
+        self.handle_leader = lambda request: None     # never answered, the client leaves
+        assert self.run_clients() == ["1:k,"]
+        assert self.calls == ["k", "k"]
+        assert self.server.stats()["coalesced"] == 0
+
+    def test_streamed_leader(self):
+        # streamed responses aren't shared, the second request is handled on its own
+        def stream_later(request):
+            self.io_loop.add_timeout(time.time() + .05, lambda: request.stream(["ab", "cd"]))
+        self.handle_leader = self.answer_later = stream_later
+        assert self.run_clients("2:ab,2:cd,0:,") == ["2:ab,2:cd,0:,"]
+        assert self.calls == ["k", "k"]
+
+
+class TestFairScheduling(PipelinedTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.start_server(fair_scheduling=True, dispatch_budget=2)
+
+    def test_scheduler_budget(self):
+        # 4 pipelined requests are queued at once, 2 are dispatched per callback
+        frames = ["2:d1,", "2:d2,", "2:d3,", "2:d4,", "2:d5,"]
+        assert self.send_pipelined(frames) == ''.join(frames)
+        assert self.max_in_flight == 4
+        scheduler = self.server.stats()["scheduler"]
+        assert scheduler["dispatched"] == 5
+        assert scheduler["deferred"] >= 1
+
+
+class TestAsyncHandler(PipelinedTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.futures = pytest.importorskip("concurrent.futures")
+        self.start_server(self.future_echo, request_timeout=.2)
+
+    def future_echo(self, request):
+        if request.body == 'string':
+            return request.body
+        future = self.futures.Future()
+        if request.body == 'fail':
+            self.io_loop.add_callback(lambda: future.set_exception(ValueError("fail")))
+        elif request.body != 'never':
+            delay = .1 if request.body == 'd1' else .01
+            self.io_loop.add_timeout(time.time()+delay,
+                                     lambda: future.set_result(request.body))
+        return future
+
+    def test_futures_resolved_out_of_order(self):
+        # d1 is resolved as the last one, responses keep the request order
+        frames = ["2:d1,", "2:d2,", "2:d3,"]
+        assert self.send_pipelined(frames) == ''.join(frames)
+
+    def test_request_timeout(self):
+        def client():
+            sock = socket.create_connection(("127.0.0.1", self.port), .5)
+            sock.send("5:never,")
+            closed.append(sock.recv(10) == '')
+            self.io_loop.add_callback(self.stop)
+        closed = []
+        t = Thread(target=client)
+        self.io_loop.add_callback(t.start)
+
+        self.wait(timeout=1.5)
+        assert closed == [True]
+
+    def test_failed_future(self):
+        self.check_closed("4:fail,2:d2,")
+
+    def test_not_a_future(self):
+        self.check_closed("6:string,2:d2,")
+
+    def check_closed(self, frames):
+        """the connection is closed right after <frames> are sent"""
+        def client():
+            sock = socket.create_connection(("127.0.0.1", self.port), .5)
+            start = time.time()
+            sock.send(frames)
+            closed.append(sock.recv(10) == '')
+            closed.append(time.time() - start < .15)     # not by request_timeout
+            self.io_loop.add_callback(self.stop)
+        closed = []
+        t = Thread(target=client)
+        self.io_loop.add_callback(t.start)
+
+        self.wait(timeout=1.5)
+        assert closed == [True, True]
+
+
+class TestExecutor(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        futures = pytest.importorskip("concurrent.futures")
+        self.executor = futures.ThreadPoolExecutor(1)
+        self.release = TEvent()
+        self.threads = []
+        self.server = PServer(self.work, NetStringConn, io_loop=self.io_loop, max_pipeline=4,
+                              executor=self.executor, executor_max_pending=1,
+                              executor_max_queue=1)
+        self.port = get_unused_port()
+        self.server.listen(self.port, "127.0.0.1")
+
+    def tearDown(self):
+        self.release.set()
+        self.executor.shutdown()
+        AsyncTestCase.tearDown(self)
+
+    def work(self, body):
+        self.threads.append(threading.current_thread())
+        self.release.wait(1)
+        return body.upper()
+
+    def request(self, data, expected):
+        out = []
+
+        def client():
+            sock = socket.create_connection(("127.0.0.1", self.port), 1)
+            sock.send(data)
+            received = ''
+            while len(received) < expected:
+                received += sock.recv(1024)
+            sock.close()
+            out.append(received)
+            self.io_loop.add_callback(self.stop)
+        t = Thread(target=client)
+        self.io_loop.add_callback(t.start)
+        self.wait(timeout=2)
+        t.join()
+        return out[0]
+
+    def test_runs_in_thread(self):
+        self.release.set()
+        assert self.request("2:d1,", 5) == "2:D1,"
+        assert self.threads and threading.current_thread() not in self.threads
+
+    def test_full_queue(self):
+        # d1 is processed, d2 waits in the queue, there's no room for d3
+        self.io_loop.add_timeout(time.time() + .1, self.release.set)
+        assert self.request("2:d1,2:d2,2:d3,", 17) == "2:D1,2:D2,4:BUSY,"
+        stats = self.server.stats()
+        assert stats["executor_rejected"] == 1
+        assert stats["executor_queue_depth"] == 0
+
+
+class TestFlowControl(AsyncTestCase):
+    big = 'x' * (4 << 20)     # more than socket buffers can take
+
+    def start_server(self, **kwargs):
+        self.requests = []
+        self.unflushed = []     # output of the connection when a request is read
+        self.server = PServer(self.handler, NetStringConn, io_loop=self.io_loop,
+                              max_pipeline=4, **kwargs)
+        self.port = get_unused_port()
+        self.server.listen(self.port, "127.0.0.1")
+
+    def handler(self, request):
+        self.requests.append(request.body)
+        self.unflushed.append(request.connection.unflushed())
+        request.write(self.big if request.body == 'big' else request.body)
+
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.settimeout(2)
+        sock.connect(("127.0.0.1", self.port))
+        return sock
+
+    def receive(self, sock, expected, out):
+        received = []
+        size = 0
+        while size < expected:
+            data = sock.recv(65536)
+            received.append(data)
+            size += len(data)
+        out.append(''.join(received))
+        self.io_loop.add_callback(self.stop)
+
+    def sleep(self, seconds):
+        self.io_loop.add_timeout(time.time() + seconds, self.stop)
+        self.wait(timeout=seconds + 1)
+
+    def big_response(self):
+        return '%d:%s,' % (len(self.big), self.big)
+
+    def test_high_and_low_water(self):
+        self.start_server(write_high_water=65536, write_low_water=16384)
+        sock = self.connect()
+        sock.send("3:big,2:d2,")
+        self.sleep(.1)
+        assert self.requests == ['big']       # reads paused above high water
+        conn, = self.server._connections
+        assert conn._paused
+        assert self.server.buffered_bytes > 65536
+
+        out = []
+        expected = len(self.big_response()) + len("2:d2,")
+        t = Thread(target=self.receive, args=(sock, expected, out))
+        t.start()
+        self.wait(timeout=2)
+        t.join()
+        assert out == [self.big_response() + "2:d2,"]
+        assert self.requests == ['big', 'd2']  # resumed after the output drained
+        assert self.unflushed[1] <= 16384
+        assert not conn._paused
+        sock.close()
+
+    def test_max_output_buffer(self):
+        self.start_server(max_output_buffer=65536)
+        slow = self.connect()
+        slow.send("3:big,")
+        self.sleep(.1)
+        other = self.connect()
+        other.send("2:d2,")
+        self.sleep(.1)
+        assert self.requests == ['big']       # the server buffer is full
+
+        out = []
+        t = Thread(target=self.receive, args=(slow, len(self.big_response()), out))
+        t.start()
+        self.wait(timeout=2)
+        t.join()
+        self.sleep(.05)
+        assert self.requests == ['big', 'd2']  # resumed by output of the other connection
+        assert other.recv(10) == "2:d2,"
+        assert self.server.buffered_bytes == 0
+        slow.close()
+        other.close()
+
+
+class TestNetStringPool(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.pings = 0
+        self.failed_pings = 0
+        self.server = PServer(self.handler, NetStringConn, io_loop=self.io_loop,
+                              max_pipeline=8)
+        self.port = get_unused_port()
+        self.server.listen(self.port)
+        self.server.start()
+
+    def handler(self, request):
+        """echoes requests, except that "slow" isn't answered and "close"
+        and the first <failed_pings> health checks close the connection"""
+        if request.body == "ping":
+            self.pings += 1
+            if self.pings <= self.failed_pings:
+                request.connection.stream.close()
+                return
+        if request.body == "close":
+            request.connection.stream.close()
+        elif request.body != "slow":
+            request.write(request.body)
+
+    def wait_for(self, future):
+        future.add_done_callback(lambda f: self.io_loop.add_callback(self.stop))
+        self.wait(timeout=1)
+        return future
+
+    def sleep(self, seconds):
+        self.io_loop.add_timeout(time.time() + seconds, self.stop)
+        self.wait(timeout=seconds + 1)
+
+    def test_send_many(self):
+        pool = NetStringPool("127.0.0.1", self.port, size=2, health_check="ping",
+                             io_loop=self.io_loop)
+        requests = [str(i) for i in range(20)]
+        responses = {}
+        def on_response(request, future):
+            responses[request] = future.result()
+            if len(responses) == len(requests):
+                self.stop()
+        for r in requests:
+            pool.send(r).add_done_callback(functools.partial(on_response, r))
+
+        self.wait(timeout=1)
+        pool.close()
+        assert all(responses[r] == r for r in requests)
+
+    def test_timeout(self):
+        pool = NetStringPool("127.0.0.1", self.port, size=1, timeout=.05,
+                             reconnect_delay=.01, io_loop=self.io_loop)
+        slow, pipelined = pool.send("slow"), pool.send("fast", timeout=1)
+        self.wait_for(pipelined)
+        assert isinstance(slow.exception(), RequestTimeout)
+        # the connection is reset, failing the request sent after the slow one
+        assert type(pipelined.exception()) is IOError
+        assert self.wait_for(pool.send("fast")).result() == "fast"
+        pool.close()
+
+    def test_reconnect(self):
+        pool = NetStringPool("127.0.0.1", self.port, size=1, reconnect_delay=.01,
+                             io_loop=self.io_loop)
+        dropped = self.wait_for(pool.send("close"))
+        assert type(dropped.exception()) is IOError
+        assert self.wait_for(pool.send("hello")).result() == "hello"
+        assert self.server.stats()["protocols"]["NetStringConn"]["accepted"] == 2
+        pool.close()
+
+    def test_reconnect_backoff(self):
+        pool = NetStringPool("127.0.0.1", get_unused_port(), size=1, reconnect_delay=.01,
+                             max_reconnect_delay=.03, io_loop=self.io_loop)
+        conn, = pool._connections
+        spy = SpyCallbackMethod()
+        conn.connect = functools.partial(spy, conn.connect)
+        self.sleep(.1)
+        # refused connections are retried after .01, .02, .03, .03... seconds
+        assert 2 <= spy.num_calls <= 5
+        assert conn._reconnect_delay == .03
+        pool.close()
+        num_calls = spy.num_calls
+        self.sleep(.05)
+        assert spy.num_calls == num_calls
+
+    def test_health_check_failure(self):
+        self.failed_pings = 2
+        pool = NetStringPool("127.0.0.1", self.port, size=1, health_check="ping",
+                             reconnect_delay=.01, io_loop=self.io_loop)
+        # the request waits in the pool queue until a health check passes
+        assert self.wait_for(pool.send("hello")).result() == "hello"
+        assert self.pings == 3
+        assert self.server.stats()["protocols"]["NetStringConn"]["accepted"] == 3
+        pool.close()
+
+
+class SmallLengthPrefixConn(LengthPrefixConn):
+    max_frame_size = 100
+
+
+class TestLengthPrefix(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.server = PServer(echo_handler, LengthPrefixConn, io_loop=self.io_loop)
+        self.port = get_unused_port()
+        self.server.listen(self.port)
+        self.server.start()
+        self.stream = iostream.IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0),
+                                        self.io_loop)
+
+    def req_resp(self, client, data, request_id=None):
+        received = []
+        def receive(body, rid):
+            received.append((body, rid))
+            self.stop()
+        client.receive = receive
+        self.stream.connect(("127.0.0.1", self.port), lambda: client.send(data, request_id))
+        self.wait(timeout=1)
+        return received
+
+    def test_req_resp(self):
+        client = LengthPrefixClient(self.stream)
+        assert self.req_resp(client, b"\x00binary\n,:data") == [(b"\x00binary\n,:data", None)]
+
+    def test_request_id_and_compression(self):
+        client = LengthPrefixClient(self.stream, compress=True)
+        data = b"abc" * 1000
+        assert self.req_resp(client, data, request_id=7) == [(data, 7)]
+
+    def test_empty_body(self):
+        client = LengthPrefixClient(self.stream)
+        assert self.req_resp(client, b"") == [(b"", None)]
+
+    def check_rejected(self, frame):
+        """<frame> is sent after a valid one, which is the only one answered"""
+        self.server.protocol_conn = SmallLengthPrefixConn
+        ok = b''.join(length_prefix_frame(b"ok"))
+        received = []
+        def send():
+            self.stream.write(ok + b''.join(frame))
+            self.stream.read_until_close(received.append, received.append)
+        self.stream.set_close_callback(self.stop)
+        self.stream.connect(("127.0.0.1", self.port), send)
+        self.wait(timeout=1)
+        assert b''.join(received) == ok
+
+    def test_frame_too_big(self):
+        self.check_rejected(length_prefix_frame(b"x" * 101))
+
+    def test_decompressed_frame_too_big(self):
+        self.check_rejected(length_prefix_frame(zlib.compress(b"x" * 101), FLAG_COMPRESSED))
+
+
+class TestMux(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.server = PServer(self.delayed_echo, MuxConn, io_loop=self.io_loop,
+                              max_pipeline=100)
+        self.port = get_unused_port()
+        self.server.listen(self.port)
+        self.server.start()
+
+    def delayed_echo(self, request):
+        """the first request is answered as the last one"""
+        delay = .1 if request.body == 'slow' else .01
+        self.io_loop.add_timeout(time.time()+delay, lambda: request.write(request.body))
+
+    def test_out_of_order(self):
+        client = MuxClient("127.0.0.1", self.port, io_loop=self.io_loop)
+        order = []
+        def on_response(response):
+            order.append(response)
+            if len(order) == 3:
+                self.stop()
+        for data in ('slow', 'fast1', 'fast2'):
+            client.send(data, callback=on_response)
+
+        self.wait(timeout=1)
+        client.close()
+        assert order[-1] == 'slow'
+        assert sorted(order[:2]) == ['fast1', 'fast2']
+        conn, = self.server._connections
+        assert not conn._requests
+
+    def test_finish_after_write(self):
+        def write_and_close(request):
+            request.write(request.body)
+            try:
+                request.finish(keep_alive=False)
+            except Exception as e:
+                errors.append(e)
+        def client():
+            sock = socket.create_connection(("127.0.0.1", self.port), 1)
+            sock.send(frame)
+            while True:
+                chunk = sock.recv(100)
+                if not chunk:
+                    break
+                received.append(chunk)
+            sock.close()
+            self.io_loop.add_callback(self.stop)
+        self.server.request_callback = write_and_close
+        frame = ''.join(length_prefix_frame('data', request_id=7))
+        received, errors = [], []
+        t = Thread(target=client)
+        self.io_loop.add_callback(t.start)
+        self.wait(timeout=1)
+        t.join()
+        assert ''.join(received) == frame     # answered, then closed
+        assert errors == []
+
+
+class StreamingConn(NetStringConn):
+    max_frame_size = 1000
+    stream_threshold = 100
+    chunk_size = 16
+
+
+class ShortHeaderConn(NetStringConn):
+    max_header_size = 3
+
+
+class TestStreamingBody(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.server = PServer(self.length_handler, StreamingConn, io_loop=self.io_loop)
+        self.port = get_unused_port()
+        self.server.listen(self.port)
+        self.server.start()
+        self.stream = iostream.IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0),
+                                        self.io_loop)
+        self.chunks = []
+
+    def length_handler(self, request):
+        """responds with the number of chunks of streamed bodies"""
+        if not request.streaming:
+            request.write(request.body)
+        elif self.chunks is None:
+            request.write('skipped')
+        else:
+            request.read_body(self.chunks.append,
+                              lambda: request.write(str(len(self.chunks))))
+
+    def pipelined(self, frames, expected):
+        """sends <frames> at once, returns <expected> bytes of responses"""
+        received = []
+        def on_response(data):
+            received.append(data)
+            self.stop()
+        def send():
+            self.stream.write(''.join(frames))
+            self.stream.read_bytes(len(expected), on_response)
+        self.stream.connect(("127.0.0.1", self.port), send)
+        self.wait(timeout=1)
+        return received[0]
+
+    def test_streamed_and_buffered(self):
+        body = 'x' * 200
+        assert self.pipelined(['200:' + body + ',', '5:small,'], '2:13,5:small,') \
+            == '2:13,5:small,'
+        assert ''.join(self.chunks) == body
+        assert self.server.stats()["bytes_in"] == 205
+
+    def test_skipped_body(self):
+        self.chunks = None
+        assert self.pipelined(['200:' + 'x' * 200 + ',', '5:small,'], '7:skipped,5:small,') \
+            == '7:skipped,5:small,'
+
+    def test_frame_too_big(self):
+        self.stream.set_close_callback(self.stop)
+        self.stream.connect(("127.0.0.1", self.port),
+                            lambda: self.stream.write('1001:'))
+        self.wait(timeout=1)
+        assert self.stream.closed()
+
+    def test_header_too_long(self):
+        # no ':' comes, the server must not buffer the header until it does
+        self.stream.set_close_callback(self.stop)
+        self.stream.connect(("127.0.0.1", self.port),
+                            lambda: self.stream.write('1' * 100))
+        self.wait(timeout=1)
+        assert self.stream.closed()
+
+    def test_buffered_header_too_long(self):
+        # the second frame is decoded by the parser of the connection
+        self.server.protocol_conn = ShortHeaderConn
+        received = []
+        def send():
+            self.stream.write('2:d1,0001:x,')
+            self.stream.read_until_close(received.append, received.append)
+        self.stream.set_close_callback(self.stop)
+        self.stream.connect(("127.0.0.1", self.port), send)
+        self.wait(timeout=1)
+        assert ''.join(received) == '2:d1,'
+
+    def test_malformed_header(self):
+        self.stream.set_close_callback(self.stop)
+        self.stream.connect(("127.0.0.1", self.port),
+                            lambda: self.stream.write('12x'))
+        self.wait(timeout=1)
+        assert self.stream.closed()
+
+
+class TestDetectingConn(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.server = PServer(echo_handler, DetectingConn, io_loop=self.io_loop)
+        self.port = get_unused_port()
+        self.server.listen(self.port)
+        self.server.start()
+
+    def req_resp(self, frame):
+        """sends the <frame>, returns as many bytes of the response"""
+        stream = iostream.IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0),
+                                   self.io_loop)
+        received = []
+        def on_response(data):
+            received.append(data)
+            self.stop()
+        def send():
+            stream.write(frame)
+            stream.read_bytes(len(frame), on_response)
+        stream.connect(("127.0.0.1", self.port), send)
+        self.wait(timeout=1)
+        stream.close()
+        return received[0]
+
+    def test_protocols(self):
+        netstring = '11:hello world,'
+        assert self.req_resp(netstring) == netstring
+        lp = b''.join(length_prefix_frame(b'\x00binary', request_id=3))
+        assert self.req_resp(lp) == lp
+        for line in ['12 is not a netstring\n', 'hello\n', '\n']:
+            assert self.req_resp(line) == line
+        assert sorted(self.server.stats()["protocols"]) == \
+            ["LengthPrefixConn", "NetStringConn", "NewLinerConn"]
+
+
+class BufferStream(object):
+    """the part of tornado 2.x IOStream used by write_chunks"""
+    def __init__(self):
+        self._write_buffer = collections.deque()
+
+    def write(self, data, callback=None):
+        self._write_buffer.append(data)
+
+
+def test_write_chunks_splits_big_chunks():
+    stream = BufferStream()
+    big = 'x' * (WRITE_BUFFER_CHUNK_SIZE * 2 + 1)
+    write_chunks(stream, ['5:', big, 'small', ''])
+    assert [len(c) for c in stream._write_buffer] == \
+        [2, WRITE_BUFFER_CHUNK_SIZE, WRITE_BUFFER_CHUNK_SIZE, 1, 5]
+    assert ''.join(stream._write_buffer) == '5:' + big + 'small'
+
+
+def test_unread():
+    stream = BufferStream()
+    stream._read_buffer, stream._read_buffer_size = collections.deque(['lo']), 2
+    unread(stream, 'hel')
+    assert list(stream._read_buffer) == ['hel', 'lo'] and stream._read_buffer_size == 5
+    # tornado 4+ keeps consumed bytes before _read_buffer_pos
+    stream._read_buffer, stream._read_buffer_pos = bytearray('xxlo'), 2
+    unread(stream, 'hel')
+    assert stream._read_buffer == 'xxhello' and stream._read_buffer_size == 8
+    with pytest.raises(NotImplementedError):
+        unread(BufferStream(), 'hel')
+
+
 def echo_handler(request):
     request.write(request.body)
 
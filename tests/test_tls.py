@@ -0,0 +1,124 @@
+# coding: utf-8
+import os
+import socket
+import ssl
+import subprocess
+from threading import Thread
+
+import pytest
+from tornado.testing import get_unused_port
+
+from pserver import PServer, NetStringConn
+from pserver.blocking import NetStringConnection
+from testutils import AsyncTestCase
+
+CERT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tls")
+SSL_OPTIONS = dict(certfile=os.path.join(CERT_DIR, "test.crt"),
+                   keyfile=os.path.join(CERT_DIR, "test.key"))
+
+
+def echo_handler(request):
+    request.write(request.body)
+
+
+def has_openssl():
+    try:
+        subprocess.check_output(["openssl", "version"])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+class TLSConnection(NetStringConnection):
+    def __init__(self, host, port, timeout=None):
+        NetStringConnection.__init__(self, host, port, timeout)
+        self.sock = ssl.wrap_socket(self.sock)
+
+
+class TestTLS(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.server = PServer(echo_handler, NetStringConn, io_loop=self.io_loop,
+                              ssl_options=SSL_OPTIONS)
+        self.port = get_unused_port()
+        self.server.listen(self.port, "127.0.0.1")
+
+    def run_client(self, work):
+        """runs <work(port)> in a thread, while the server handles requests"""
+        out = []
+        def target():
+            try:
+                out.append(work(self.port))
+            finally:
+                self.io_loop.add_callback(self.stop)
+        thread = Thread(target=target)
+        thread.start()
+        self.wait(timeout=5)
+        thread.join()
+        return out[0]
+
+    def test_full_handshakes(self):
+        def work(port):
+            responses = []
+            for data in ("a", "b"):
+                conn = TLSConnection("127.0.0.1", port, timeout=2)
+                responses.append(conn.request(data))
+                conn.close()
+            return responses
+        assert self.run_client(work) == ["a", "b"]
+        tls = self.server.stats()["tls"]
+        assert (tls["full_handshakes"], tls["resumed_handshakes"]) == (2, 0)
+        assert tls["handshake_time"]["count"] == 2
+        assert self.server.stats()["protocols"]["NetStringConn"]["requests"] == 2
+
+    def test_prebuilt_context(self):
+        self.server.stop()
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.load_cert_chain(SSL_OPTIONS["certfile"], SSL_OPTIONS["keyfile"])
+        self.server = PServer(echo_handler, NetStringConn, io_loop=self.io_loop,
+                              ssl_options=context)
+        self.server.listen(self.port, "127.0.0.1")
+        def work(port):
+            conn = TLSConnection("127.0.0.1", port, timeout=2)
+            try:
+                return conn.request("hello")
+            finally:
+                conn.close()
+        assert self.run_client(work) == "hello"
+        assert self.server.ssl_context is context
+        assert self.server.stats()["tls"]["full_handshakes"] == 1
+
+    def check_resumed_handshakes(self, args):
+        def work(port):
+            # a full handshake followed by 5 reconnections resuming the session
+            # (with TLS 1.3 s_client closes before it receives a ticket)
+            process = subprocess.Popen(
+                ["openssl", "s_client", "-connect", "127.0.0.1:%d" % port, "-reconnect",
+                 "-tls1_2"] + args,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            return process.communicate(b"")[0]
+        self.run_client(work)
+        tls = self.server.stats()["tls"]
+        assert tls["full_handshakes"] == 1
+        assert tls["resumed_handshakes"] == 5
+
+    @pytest.mark.skipif(not has_openssl(), reason="needs openssl command")
+    def test_session_tickets(self):
+        self.check_resumed_handshakes([])
+
+    @pytest.mark.skipif(not has_openssl(), reason="needs openssl command")
+    def test_session_cache(self):
+        self.check_resumed_handshakes(["-no_ticket"])
+
+    def test_failed_handshake(self):
+        def work(port):
+            sock = socket.create_connection(("127.0.0.1", port), 2)
+            sock.sendall(b"5:hello,")
+            try:
+                return sock.recv(10)
+            except socket.error:    # reset, the request wasn't read
+                return b""
+            finally:
+                sock.close()
+        assert self.run_client(work) == b""
+        assert self.server.stats()["tls"]["failed_handshakes"] == 1
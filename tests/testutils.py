@@ -1,5 +1,24 @@
 from multiprocessing import Event
 from functional import curry
+from tornado import testing
+
+
+class AsyncTestCase(testing.AsyncTestCase):
+    """Closes `self.server`, its connections and `self.stream` before the
+    IOLoop is closed. IOLoop.close(all_fds=True) closes raw descriptors of
+    streams which are still open, and their sockets close the descriptors
+    again when collected - possibly after they were reused by another test."""
+    def tearDown(self):
+        server = getattr(self, "server", None)
+        if server is not None:
+            for conn in list(server._connections):
+                conn.stream.close()
+            server.stop()
+            server._sockets = {}
+        stream = getattr(self, "stream", None)
+        if stream is not None:
+            stream.close()
+        testing.AsyncTestCase.tearDown(self)
 
 
 @curry